@@ -0,0 +1,480 @@
+import numpy as np
+from functools import lru_cache, wraps
+from scipy.linalg import expm
+
+"""
+Shared contraction kernels for applying a local operator to a subset of the qudits of a state. The reshape and
+transpose recipe for a given state dimension, set of qudits and local dimension is computed once and cached, as is the
+reordering of operators given on an unsorted set of qudits, and the spectral decomposition of operators which are
+exponentiated. Each code calls these with its own local dimension,
+``d`` for physical codes and ``d ** n`` for logical codes.
+"""
+__all__ = ['left_multiply', 'right_multiply', 'sort_operator', 'accumulate', 'batch_rotation', 'diagonal',
+           'spectral_decomposition', 'exponential', 'superoperator_multiply', 'kraus_superoperator', 'kraus', 'chunks']
+
+# Number of entries of a memory-mapped state processed at once
+chunk_size = 2 ** 20
+# Largest dimension of the qudits acted on for which Kraus operators are fused into a single superoperator, whose size
+# grows as the fourth power of this dimension
+superoperator_dimension = 4
+
+
+def chunks(length: int, size: int = None):
+    """
+    Yields slices covering ``range(length)`` in consecutive blocks, used to process memory-mapped states without
+    loading them into memory.
+
+    :param length: Length of the axis to cover.
+    :type length: int
+    :param size: Number of entries per block, defaults to ``chunk_size``.
+    :type size: int
+    """
+    if size is None:
+        size = chunk_size
+    for start in range(0, length, size):
+        yield slice(start, min(start + size, length))
+
+
+def accumulate(func):
+    """
+    Decorator adding ``out`` and ``coefficient`` keyword arguments to a code's ``left_multiply``, ``right_multiply`` or
+    ``multiply``. The product is scaled in place by ``coefficient``, and if ``out`` is given it is added into ``out``,
+    which is returned, so that sums of many terms only hold a single product at a time.
+    """
+    @wraps(func)
+    def wrapper(state, apply_to, op, out=None, coefficient=1):
+        result = func(state, apply_to, op)
+        if coefficient != 1:
+            result *= coefficient
+        if out is None:
+            return result
+        out += result
+        return out
+
+    return wrapper
+
+
+@lru_cache(maxsize=256)
+def _left_plan(dimension: int, apply_to: tuple, d: int):
+    """Returns the shapes and axis orders used to left multiply an operator on the sorted qudits ``apply_to``."""
+    n_op = len(apply_to)
+    preshape = d * np.ones((2, n_op), dtype=int)
+    preshape[1, 0] = dimension // (d ** (1 + apply_to[n_op - 1]))
+    if n_op > 1:
+        preshape[1, 1:] = np.flip(d ** np.diff(apply_to)) // d
+
+    shape1 = np.zeros(2 * n_op + 1, dtype=int)
+    shape2 = np.zeros(2 * n_op + 1, dtype=int)
+    order1 = np.zeros(2 * n_op + 1, dtype=int)
+    order2 = np.zeros(2 * n_op + 1, dtype=int)
+
+    shape1[:-1] = np.flip(preshape, axis=0).reshape((2 * n_op), order='F')
+    shape1[-1] = -1
+    shape2[:-1] = preshape.reshape((-1), order='C')
+    shape2[-1] = -1
+
+    preorder = np.arange(2 * n_op)
+    order1[:-1] = np.flip(preorder.reshape((-1, 2), order='C'), axis=1).reshape((-1), order='F')
+    order2[:-1] = np.flip(preorder.reshape((2, -1), order='C'), axis=0).reshape((-1), order='F')
+    order1[-1] = 2 * n_op
+    order2[-1] = 2 * n_op
+    return tuple(shape1), tuple(order1), tuple(shape2), tuple(order2)
+
+
+@lru_cache(maxsize=256)
+def _right_plan(dimension: int, apply_to: tuple, d: int):
+    """Returns the shapes and axis orders used to right multiply an operator on the sorted qudits ``apply_to``."""
+    n_op = len(apply_to)
+    preshape = d * np.ones((2, n_op), dtype=int)
+    preshape[0, 0] = dimension // (d ** (1 + apply_to[n_op - 1]))
+    if n_op > 1:
+        preshape[0, 1:] = np.flip(d ** np.diff(apply_to)) // d
+
+    shape3 = np.zeros(2 * n_op + 2, dtype=int)
+    shape3[0] = dimension
+    shape3[1:-1] = np.reshape(preshape, (2 * n_op), order='F')
+    shape3[-1] = -1
+
+    shape4 = np.zeros(2 * n_op + 2, dtype=int)
+    shape4[0] = dimension
+    shape4[1:n_op + 1] = preshape[0]
+    shape4[n_op + 1] = -1
+    shape4[n_op + 2:] = preshape[1]
+
+    order3 = np.zeros(2 * n_op + 2, dtype=int)
+    order3[0] = 0
+    order3[1:n_op + 2] = 2 * np.arange(n_op + 1) + 1
+    order3[n_op + 2:] = 2 * np.arange(1, n_op + 1)
+
+    order4 = np.zeros(2 * n_op + 2, dtype=int)
+    order4[0] = 0
+    order4[1] = 1
+    order4[2:] = np.flip(np.arange(2, 2 * n_op + 2).reshape((2, -1), order='C'), axis=0).reshape((-1), order='F')
+    return tuple(shape3), tuple(order3), tuple(shape4), tuple(order4)
+
+
+@lru_cache(maxsize=64)
+def _sorted_operator(apply_to: tuple, d: int, dtype: str, op_bytes: bytes):
+    n_op = len(apply_to)
+    op = np.frombuffer(op_bytes, dtype=dtype).reshape((d ** n_op, d ** n_op))
+    permut = np.argsort(apply_to)
+    transpose_ord = np.zeros(2 * n_op, dtype=int)
+    transpose_ord[:n_op] = (n_op - 1) - np.flip(permut, axis=0)
+    transpose_ord[n_op:] = (2 * n_op - 1) - np.flip(permut, axis=0)
+    sorted_op = np.reshape(np.transpose(np.reshape(op, d * np.ones(2 * n_op, dtype=int), order='F'),
+                                        axes=transpose_ord), (d ** n_op, d ** n_op), order='F')
+    sorted_op.flags.writeable = False
+    return tuple(np.asarray(apply_to)[permut]), sorted_op
+
+
+def sort_operator(apply_to, op, d: int):
+    """
+    Reorder an operator acting on the qudits ``apply_to`` so that it acts on the same qudits in increasing order.
+
+    :param apply_to: zero-based indices of qudit locations the operator acts on
+    :type apply_to: list of int
+    :param op: Operator to reorder.
+    :type op: np.ndarray (2-dimensional)
+    :param d: Local dimension of each qudit.
+    :type d: int
+    :return: The sorted qudit indices and the reordered operator, which should not be modified in place.
+    """
+    op = np.ascontiguousarray(op)
+    return _sorted_operator(tuple(int(i) for i in apply_to), d, op.dtype.str, op.tobytes())
+
+
+@lru_cache(maxsize=64)
+def _diagonal(number_qudits: int, apply_to: tuple, d: int, dtype: str, diagonal_bytes: bytes):
+    local_diagonal = np.frombuffer(diagonal_bytes, dtype=dtype).reshape((d,) * len(apply_to))
+    # Order the axes by qudit, and give every other qudit a unit axis
+    shape = [1] * number_qudits
+    for i in apply_to:
+        shape[i] = d
+    out = np.transpose(local_diagonal, np.argsort(apply_to)).reshape(shape)
+    out.flags.writeable = False
+    return out
+
+
+def diagonal(number_qudits: int, apply_to, op_diagonal, d: int):
+    """
+    Reshape the diagonal of an operator acting on the qudits ``apply_to`` so that it broadcasts against a state
+    reshaped to one axis of length :math:`d` per qudit, which gives the diagonal of the operator on the full Hilbert
+    space without storing it. Results are cached, and have only :math:`d^k` entries for an operator on :math:`k`
+    qudits.
+
+    :param number_qudits: Number of qudits of the full Hilbert space.
+    :type number_qudits: int
+    :param apply_to: zero-based indices of qudit locations the operator acts on, in the order of its tensor factors
+    :type apply_to: list of int
+    :param op_diagonal: Diagonal of the local operator.
+    :type op_diagonal: np.ndarray
+    :param d: Local dimension of each qudit.
+    :type d: int
+    :return: Array with one axis per qudit, which should not be modified in place.
+    """
+    op_diagonal = np.ascontiguousarray(op_diagonal)
+    return _diagonal(number_qudits, tuple(int(i) for i in apply_to), d, op_diagonal.dtype.str,
+                     op_diagonal.tobytes())
+
+
+def diagonal_multiply(state: np.ndarray, apply_to, op_diagonal, d: int, left=True, right=False):
+    """
+    Multiply a ket or density matrix by a diagonal operator acting on the qudits ``apply_to``, broadcasting its
+    diagonal over the state.
+
+    :param state: input wavefunction or density matrix
+    :type state: np.ndarray
+    :param apply_to: zero-based indices of qudit locations the operator acts on, in the order of its tensor factors
+    :type apply_to: list of int
+    :param op_diagonal: Diagonal of the local operator.
+    :type op_diagonal: np.ndarray
+    :param d: Local dimension of each qudit.
+    :type d: int
+    :param left: Whether to left multiply by the operator, defaults to ``True``.
+    :type left: bool
+    :param right: Whether to right multiply by the conjugate of the operator, defaults to ``False``.
+    :type right: bool
+    """
+    state = np.asarray(state)
+    number_qudits = int(round(np.log(state.shape[0]) / np.log(d)))
+    factor = diagonal(number_qudits, apply_to, op_diagonal, d)
+    out = state
+    if left:
+        out = (factor[..., np.newaxis] * out.reshape((d,) * number_qudits + (-1,))).reshape(state.shape)
+    if right:
+        out = (out.reshape((-1,) + (d,) * number_qudits) * factor.conj()).reshape(state.shape)
+    return out
+
+
+def _match_precision(op, state):
+    """Casts ``op`` to single precision when ``state`` is single precision, so that products are not upcast."""
+    if state.dtype == np.complex64 and op.dtype != np.complex64:
+        return op.astype(np.complex64)
+    return op
+
+
+def _chunked_left_multiply(state: np.ndarray, i: int, op, d: int):
+    """Left multiplies a memory-mapped ket by an operator on the single qudit ``i`` in place, in blocks of about
+    ``chunk_size`` entries."""
+    # The middle axis indexes qudit i; the last also holds the columns of a batch of kets
+    view = np.asarray(state).reshape((d ** i, d, -1))
+    inner = min(view.shape[2], max(1, chunk_size // d))
+    outer = max(1, chunk_size // (d * inner))
+    for o in chunks(view.shape[0], outer):
+        for k in chunks(view.shape[2], inner):
+            view[o, :, k] = np.einsum('ab,obk->oak', op, view[o, :, k])
+    return state
+
+
+def left_multiply(state: np.ndarray, apply_to, op, d: int):
+    """
+    Left multiply a ket or density matrix by an operator acting on the qudits ``apply_to``.
+
+    :param state: input wavefunction or density matrix
+    :type state: np.ndarray
+    :param apply_to: zero-based indices of qudit locations to apply the operator
+    :type apply_to: list of int
+    :param op: Operator to act with.
+    :type op: np.ndarray (2-dimensional)
+    :param d: Local dimension of each qudit.
+    :type d: int
+    :return: :math:`A\\rho` as a numpy array. Memory-mapped kets are instead updated in place, one chunk at a time,
+        for single qudit operators.
+    """
+    apply_to = tuple(int(i) for i in apply_to)
+    if len(apply_to) == 1 and getattr(state, 'is_memmap', False) and state.is_ket:
+        return _chunked_left_multiply(state, apply_to[0], _match_precision(op, state), d)
+    if not all(apply_to[i] < apply_to[i + 1] for i in range(len(apply_to) - 1)):
+        apply_to, op = sort_operator(apply_to, op, d)
+    op = _match_precision(op, state)
+    shape1, order1, shape2, order2 = _left_plan(state.shape[0], apply_to, d)
+    out = np.asarray(state).reshape(shape1, order='F').transpose(order1)
+    out = np.dot(op, out.reshape((op.shape[0], -1), order='F'))
+    out = out.reshape(shape2, order='F').transpose(order2)
+    return out.reshape(state.shape, order='F')
+
+
+def right_multiply(state: np.ndarray, apply_to, op, d: int):
+    """
+    Right multiply a density matrix by the conjugate transpose of an operator acting on the qudits ``apply_to``.
+
+    :param state: input density matrix
+    :type state: np.ndarray
+    :param apply_to: zero-based indices of qudit locations to apply the operator
+    :type apply_to: list of int
+    :param op: Operator to act with.
+    :type op: np.ndarray (2-dimensional)
+    :param d: Local dimension of each qudit.
+    :type d: int
+    :return: :math:`\\rho A^\\dagger` as a numpy array.
+    """
+    apply_to = tuple(int(i) for i in apply_to)
+    if not all(apply_to[i] < apply_to[i + 1] for i in range(len(apply_to) - 1)):
+        apply_to, op = sort_operator(apply_to, op, d)
+    op = _match_precision(op, state)
+    shape3, order3, shape4, order4 = _right_plan(state.shape[0], apply_to, d)
+    out = np.asarray(state).reshape(shape3, order='F').transpose(order3)
+    out = np.dot(out.reshape((-1, op.shape[0]), order='F'), op.conj().T)
+    out = out.reshape(shape4, order='F').transpose(order4)
+    return out.reshape(state.shape, order='F')
+
+
+@lru_cache(maxsize=64)
+def _spectral(dtype: str, size: int, op_bytes: bytes):
+    op = np.frombuffer(op_bytes, dtype=dtype).reshape((size, size))
+    # Only operators which are Hermitian to within rounding are diagonalized by a unitary
+    if np.max(np.abs(op - op.conj().T)) <= 1e-12 * max(1, np.max(np.abs(op))):
+        eigenvalues, eigenvectors = np.linalg.eigh(op)
+        inverse = eigenvectors.conj().T
+        well_conditioned = True
+    else:
+        eigenvalues, eigenvectors = np.linalg.eig(op)
+        inverse = np.linalg.inv(eigenvectors)
+        # Nearly defective operators are exponentiated directly instead
+        well_conditioned = np.linalg.cond(eigenvectors) < 1e8
+    for array in (eigenvalues, eigenvectors, inverse):
+        array.flags.writeable = False
+    return eigenvalues, eigenvectors, inverse, well_conditioned
+
+
+def spectral_decomposition(op):
+    """
+    Compute the eigendecomposition :math:`A = V \\Lambda V^{-1}` of an operator. Results are cached, so each operator
+    is only diagonalized once.
+
+    :param op: Diagonalizable operator :math:`A`.
+    :type op: np.ndarray (2-dimensional)
+    :return: The eigenvalues, the eigenvectors :math:`V` as columns and :math:`V^{-1}`, which should not be modified in
+        place.
+    """
+    op = np.ascontiguousarray(op)
+    return _spectral(op.dtype.str, op.shape[0], op.tobytes())[:3]
+
+
+@lru_cache(maxsize=256)
+def _exponential(dtype: str, size: int, op_bytes: bytes, angle):
+    op = np.frombuffer(op_bytes, dtype=dtype).reshape((size, size))
+    if np.array_equal(op @ op, np.identity(size)):
+        # Involutory operators, such as Pauli strings, are exponentiated exactly
+        out = np.cos(angle) * np.identity(size) - op * 1j * np.sin(angle)
+        out.flags.writeable = False
+        return out
+    eigenvalues, eigenvectors, inverse, well_conditioned = _spectral(dtype, size, op_bytes)
+    if well_conditioned:
+        out = (eigenvectors * np.exp(-1j * angle * eigenvalues)) @ inverse
+    else:
+        out = expm(-1j * angle * op)
+    out.flags.writeable = False
+    return out
+
+
+def exponential(op, angle):
+    """
+    Compute :math:`e^{-i \\alpha A}` from the cached spectral decomposition of :math:`A`, or as
+    :math:`\\cos(\\alpha)I-i\\sin(\\alpha)A` if :math:`A^2=I`. Results are cached, so repeated rotations by the same
+    operator and angle are free.
+
+    :param op: Operator :math:`A` to exponentiate.
+    :type op: np.ndarray (2-dimensional)
+    :param angle: The angle :math:`\\alpha`.
+    :type angle: float
+    :return: :math:`e^{-i \\alpha A}`, which should not be modified in place.
+    """
+    op = np.ascontiguousarray(op)
+    if isinstance(angle, np.generic):
+        angle = angle.item()
+    return _exponential(op.dtype.str, op.shape[0], op.tobytes(), angle)
+
+
+@lru_cache(maxsize=256)
+def _superoperator_plan(dimension: int, apply_to: tuple, d: int):
+    """Returns the shape splitting out the qudits ``apply_to`` on both indices of a density matrix, and the axes of
+    the ket and bra index of each of those qudits in the order given."""
+    number_qudits = int(round(np.log(dimension) / np.log(d)))
+    shape = []
+    site_axis = {}
+    previous = -1
+    for i in sorted(apply_to):
+        shape.append(d ** (i - previous - 1))
+        site_axis[i] = len(shape)
+        shape.append(d)
+        previous = i
+    shape.append(d ** (number_qudits - previous - 1))
+    ket_axes = tuple(site_axis[i] for i in apply_to)
+    bra_axes = tuple(site_axis[i] + len(shape) for i in apply_to)
+    return tuple(shape) * 2, ket_axes + bra_axes
+
+
+def superoperator_multiply(state: np.ndarray, apply_to, superoperator, d: int):
+    """
+    Apply a superoperator acting on the qudits ``apply_to`` to a density matrix in a single tensor contraction over
+    the ket and bra indices of those qudits. The superoperator acts on row-major vectorized density matrices, so that
+    :math:`A\\rho B` corresponds to :math:`A \\otimes B^T`.
+
+    :param state: input density matrix
+    :type state: np.ndarray
+    :param apply_to: zero-based indices of qudit locations to apply the superoperator, in the order of its tensor
+        factors
+    :type apply_to: list of int
+    :param superoperator: Superoperator to act with.
+    :type superoperator: np.ndarray (2-dimensional)
+    :param d: Local dimension of each qudit.
+    :type d: int
+    :return: The transformed density matrix as a numpy array.
+    """
+    apply_to = tuple(int(i) for i in apply_to)
+    n_op = len(apply_to)
+    shape, axes = _superoperator_plan(state.shape[0], apply_to, d)
+    superoperator = np.reshape(_match_precision(superoperator, state), (d,) * (4 * n_op))
+    out = np.tensordot(superoperator, np.asarray(state).reshape(shape), axes=(tuple(range(2 * n_op, 4 * n_op)), axes))
+    out = np.moveaxis(out, tuple(range(2 * n_op)), axes)
+    return out.reshape(state.shape)
+
+
+@lru_cache(maxsize=64)
+def _kraus_superoperator(dtype: str, shape: tuple, ops_bytes: bytes):
+    ops = np.frombuffer(ops_bytes, dtype=dtype).reshape(shape)
+    out = np.zeros((shape[1] ** 2, shape[1] ** 2), dtype=np.result_type(dtype, np.complex128))
+    for op in ops:
+        out += np.kron(op, op.conj())
+    out.flags.writeable = False
+    return out
+
+
+def kraus_superoperator(ops):
+    """
+    Build the superoperator :math:`\\sum_k K_k \\otimes K_k^*` of a list of Kraus operators, for use with
+    :py:func:`superoperator_multiply`. Results are cached.
+
+    :param ops: Kraus operators :math:`K_k`.
+    :type ops: list of np.ndarray
+    :return: The superoperator, which should not be modified in place.
+    """
+    ops = np.ascontiguousarray(np.asarray(ops))
+    if ops.ndim == 2:
+        ops = ops[np.newaxis, ...]
+    return _kraus_superoperator(ops.dtype.str, ops.shape, ops.tobytes())
+
+
+def kraus(state: np.ndarray, apply_to, ops, d: int):
+    """
+    Compute :math:`\\sum_k K_k \\rho K_k^\\dagger` for Kraus operators acting on the qudits ``apply_to``. When the
+    qudits acted on have dimension at most ``superoperator_dimension``, this is a single pass over the density matrix;
+    otherwise each Kraus operator is applied from the left and right in turn.
+
+    :param state: input density matrix
+    :type state: np.ndarray
+    :param apply_to: zero-based indices of qudit locations to apply the operators
+    :type apply_to: list of int
+    :param ops: Kraus operators :math:`K_k`.
+    :type ops: list of np.ndarray
+    :param d: Local dimension of each qudit.
+    :type d: int
+    :return: :math:`\\sum_k K_k \\rho K_k^\\dagger` as a numpy array.
+    """
+    ops = np.asarray(ops)
+    if ops.ndim == 2:
+        ops = ops[np.newaxis, ...]
+    if ops.shape[-1] <= superoperator_dimension:
+        return superoperator_multiply(state, apply_to, kraus_superoperator(ops), d)
+    out = np.zeros(state.shape, dtype=np.result_type(state.dtype, ops.dtype))
+    for op in ops:
+        out += right_multiply(left_multiply(state, apply_to, op, d), apply_to, op, d)
+    return out
+
+
+def batch_rotation(left_multiply, state: np.ndarray, apply_to, angle, op):
+    """
+    Apply :math:`e^{-i \\alpha_b A}` to column :math:`b` of a batch of kets of shape ``(dimension, B)``, using the
+    spectral decomposition :math:`A=\\sum_k \\lambda_k P_k` so that every column shares the same
+    ``left_multiply`` calls.
+
+    :param left_multiply: The code's ``left_multiply``.
+    :param state: Batch of kets, one per column.
+    :type state: np.ndarray
+    :param apply_to: zero-based indices of qudit locations to apply the operator
+    :type apply_to: list of int
+    :param angle: The angles :math:`\\alpha_b`, one per column.
+    :type angle: np.ndarray
+    :param op: Diagonalizable operator :math:`A` to rotate by.
+    :type op: np.ndarray (2-dimensional)
+    :return: The rotated batch of kets.
+    """
+    assert state.is_ket
+    angle = np.asarray(angle)
+    assert angle.shape == (state.shape[-1],)
+    eigenvalues, eigenvectors, inverse = spectral_decomposition(op)
+    # Group degenerate eigenvalues so that each eigenspace costs a single multiplication
+    eigenspaces = np.unique(np.round(eigenvalues, decimals=10))
+    out = None
+    for eigenvalue in eigenspaces:
+        indices = np.isclose(eigenvalues, eigenvalue)
+        projector = eigenvectors[:, indices] @ inverse[indices, :]
+        phases = np.exp(-1j * np.asarray(angle) * eigenvalue)[np.newaxis, :]
+        term = left_multiply(state, apply_to, projector)
+        term *= phases
+        if out is None:
+            out = term
+        else:
+            out += term
+    return out
@@ -1,15 +1,62 @@
 import math
 import numpy as np
+from contextlib import contextmanager
 from qsim.codes import qubit
 from qsim.tools import tools
 
+__all__ = ['State', 'set_precision', 'using_precision', 'complex_dtype', 'real_dtype', 'memmap']
+
+_complex_dtype = np.complex128
+
+
+def set_precision(precision: str = 'double'):
+    """
+    Set the floating point precision used for states, Hamiltonian storage and solver buffers created from now on.
+
+    :param precision: ``'single'`` for complex64/float32 or ``'double'`` for complex128/float64, defaults to
+        ``'double'``.
+    :type precision: str
+    """
+    global _complex_dtype
+    if precision == 'single':
+        _complex_dtype = np.complex64
+    elif precision == 'double':
+        _complex_dtype = np.complex128
+    else:
+        raise Exception('precision must be single or double')
+
+
+@contextmanager
+def using_precision(precision: str):
+    """Context manager setting the precision, as in :py:func:`set_precision`, for the duration of a simulation.
+    Hamiltonians should be constructed inside the context so that their storage is in the same precision."""
+    global _complex_dtype
+    previous = _complex_dtype
+    set_precision(precision)
+    try:
+        yield
+    finally:
+        _complex_dtype = previous
+
+
+def complex_dtype():
+    """Returns the complex dtype of the current precision."""
+    return _complex_dtype
+
+
+def real_dtype():
+    """Returns the real dtype of the current precision."""
+    return np.float32 if _complex_dtype == np.complex64 else np.float64
+
 
 class State(np.ndarray):
-    def __new__(cls, state, is_ket=None, code=qubit, IS_subspace=False, graph=None):
+    def __new__(cls, state, is_ket=None, code=qubit, IS_subspace=False, graph=None, dtype=None):
         # TODO: add code manipulation tools as class attributes
         # Input array is an already formed ndarray instance
-        # We first cast to be our class type
-        arr = state.view(cls).astype(np.complex128, copy=False)
+        # We first cast to be our class type, in the current precision unless a dtype is given
+        if dtype is None:
+            dtype = _complex_dtype
+        arr = state.view(cls).astype(dtype, copy=False)
         # add the new attribute to the created instance
         # Assume is_ket is a static attribute
         if is_ket is None:
@@ -40,3 +87,38 @@ class State(np.ndarray):
         self.graph = getattr(arr, 'graph', None)
         self.number_logical_qudits = getattr(arr, 'number_logical_qudits', None)
         self.number_physical_qudits = getattr(arr, 'number_physical_qudits', None)
+
+    @property
+    def batch_size(self):
+        """Number of kets stacked as columns. Kets of shape ``(dimension, B)`` are treated as a batch of ``B``
+        independent states by the code modules, so that one operator is applied to all of them at once."""
+        if self.is_ket:
+            return self.shape[-1]
+        return 1
+
+    @property
+    def is_memmap(self):
+        """``True`` if and only if the state is backed by a memory-mapped file. Such states are updated in place, one
+        chunk at a time, by the code modules and diagonal Hamiltonians."""
+        base = self.base
+        while base is not None:
+            if isinstance(base, np.memmap):
+                return True
+            base = base.base
+        return False
+
+
+def memmap(filename, shape, mode='w+', is_ket=None, code=qubit, IS_subspace=False, graph=None):
+    """
+    Create a :py:class:`State` backed by a memory-mapped file, for states too large to hold in memory.
+
+    :param filename: File backing the state.
+    :type filename: str
+    :param shape: Shape of the state, ``(dimension, 1)`` for a ket.
+    :type shape: tuple
+    :param mode: File mode, as in ``np.memmap``, defaults to ``'w+'`` which creates a zero-initialized file.
+    :type mode: str
+    :return: The memory-mapped state.
+    """
+    return State(np.memmap(filename, dtype=_complex_dtype, mode=mode, shape=tuple(shape)), is_ket=is_ket, code=code,
+                 IS_subspace=IS_subspace, graph=graph)
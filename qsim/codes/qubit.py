@@ -1,7 +1,7 @@
 import numpy as np
-from qsim.tools.tools import X, Y, Z, tensor_product, outer_product, is_sorted
-from scipy.linalg import expm
+from qsim.tools.tools import X, Y, Z, tensor_product, outer_product, bit_parity
 from qsim.codes.quantum_state import State
+from qsim.codes import contraction
 from typing import Union
 from qsim.tools.tools import int_to_nary
 
@@ -22,6 +22,84 @@ code_space_projector = outer_product(logical_basis[0], logical_basis[0]) + outer
                                                                                          logical_basis[1])
 
 
+def pauli_masks(apply_to: Union[int, list], op: list, N: int):
+    """
+    Represent a Pauli string as :math:`c X^{x} Z^{z}`, where :math:`x` and :math:`z` are bit masks over the basis
+    indices. Qubit :math:`i` corresponds to bit :math:`N-i-1` of the basis index. Factors are applied in the order
+    given, so repeated qubits are allowed.
+
+    :param apply_to: zero-based indices of qubit locations to apply the Pauli operators
+    :type apply_to: list of int
+    :param op: Pauli operators to act with, each one of ``'X'``, ``'Y'``, ``'Z'``.
+    :type op: list of str
+    :param N: Number of physical qubits.
+    :type N: int
+    :return: The flip mask :math:`x`, the phase mask :math:`z`, and the global phase :math:`c`.
+    """
+    if isinstance(apply_to, int):
+        apply_to = [apply_to]
+    x_mask = 0
+    z_mask = 0
+    phase = 1
+    for i in range(len(apply_to)):
+        bit = 1 << (N - apply_to[i] - 1)
+        if op[i] == 'X':
+            x, z, c = bit, 0, 1
+        elif op[i] == 'Y':
+            # Y = iXZ
+            x, z, c = bit, bit, 1j
+        elif op[i] == 'Z':
+            x, z, c = 0, bit, 1
+        else:
+            continue
+        # Commute the new Z factor past the X factors already present
+        if z & x_mask:
+            c = -c
+        x_mask ^= x
+        z_mask ^= z
+        phase *= c
+    return x_mask, z_mask, phase
+
+
+def _pauli_kernel(block: slice, N: int, x_mask: int, z_mask: int):
+    """Returns the permutation and sign vector such that :math:`(X^{x} Z^{z} \\psi)_j=s_j\\psi_{f_j}` for the indices
+    :math:`j` in ``block``."""
+    flip = np.arange(block.start, block.stop, dtype=np.int64) ^ x_mask
+    sign = 1 - 2 * bit_parity(flip & z_mask, width=N).astype(np.int8)
+    return flip, sign
+
+
+def _pauli_multiply(state: State, apply_to: Union[int, list], op: list, side='left'):
+    """
+    Apply a Pauli string as a gather, independent of the number of factors. The permutation and signs are computed
+    on the fly in blocks of ``contraction.chunk_size`` indices rather than stored for the full state.
+
+    :param side: One of ``'left'``, ``'right'`` or ``'both'``, for :math:`P\\rho`, :math:`\\rho P^\\dagger` and
+        :math:`P\\rho P^\\dagger` respectively.
+    """
+    N = state.number_physical_qudits
+    x_mask, z_mask, phase = pauli_masks(apply_to, op, N)
+    state = np.asarray(state)
+    out = np.empty(state.shape, dtype=state.dtype if side == 'both' else np.result_type(state.dtype, phase))
+    if side == 'left':
+        for block in contraction.chunks(state.shape[0]):
+            flip, sign = _pauli_kernel(block, N, x_mask, z_mask)
+            out[block] = state[flip] * (phase * sign)[:, np.newaxis]
+    elif side == 'right':
+        for block in contraction.chunks(state.shape[-1]):
+            flip, sign = _pauli_kernel(block, N, x_mask, z_mask)
+            out[:, block] = state[:, flip] * (np.conj(phase) * sign)[np.newaxis, :]
+    else:
+        # The global phase cancels
+        for rows in contraction.chunks(state.shape[0]):
+            row_flip, row_sign = _pauli_kernel(rows, N, x_mask, z_mask)
+            for columns in contraction.chunks(state.shape[-1]):
+                column_flip, column_sign = _pauli_kernel(columns, N, x_mask, z_mask)
+                out[rows, columns] = (state[np.ix_(row_flip, column_flip)] * row_sign[:, np.newaxis]
+                                      * column_sign[np.newaxis, :])
+    return out
+
+
 def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_involutary=False, is_idempotent=False):
     """
     Apply a single qubit rotation :math:`e^{-i \\alpha A}` to the input ``codes``.
@@ -31,7 +109,8 @@ def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_invo
     :param is_involutary:
     :param state: input wavefunction or density matrix
     :type state: np.ndarray
-    :param angle: The angle :math:`\\alpha`` to rotate by.
+    :param angle: The angle :math:`\\alpha`` to rotate by. For a batch of kets stacked as columns, this may be an
+        array with one angle per column.
     :type angle: float
     :param op: Operator to act with.
     :type op: np.ndarray
@@ -58,9 +137,14 @@ def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_invo
             elif op[i] == 'Z':
                 temp.append(Z)
         temp = tensor_product(temp)
+        if np.ndim(angle) > 0:
+            # Rotate each ket in a batch by its own angle
+            return contraction.batch_rotation(left_multiply, state, apply_to, angle, temp)
         temp = np.cos(angle) * np.identity(temp.shape[0]) - temp * 1j * np.sin(angle)
         return multiply(state, apply_to, temp)
     else:
+        if np.ndim(angle) > 0:
+            return contraction.batch_rotation(left_multiply, state, apply_to, angle, op)
         if is_involutary:
             op = np.cos(angle) * np.identity(op.shape[0]) - op * 1j * np.sin(angle)
             return multiply(state, apply_to, op)
@@ -68,9 +152,10 @@ def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_invo
             op = (np.exp(-1j * angle) - 1) * op + np.identity(op.shape[0])
             return multiply(state, apply_to, op)
         else:
-            return multiply(state, apply_to, expm(-1j * angle * op))
+            return multiply(state, apply_to, contraction.exponential(op, angle))
 
 
+@contraction.accumulate
 def left_multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -80,6 +165,10 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     # Handle typing
     if isinstance(apply_to, int):
@@ -90,85 +179,16 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
             pauli = True
         else:
             op = tensor_product(op)
-    n_op = len(apply_to)
     if not pauli:
-        if is_sorted(apply_to):
-            # Generate all shapes for left multiplication
-            preshape = d * np.ones((2, n_op), dtype=int)
-            preshape[1, 0] = int(state.dimension / (d ** (1 + apply_to[n_op - 1])))
-            if n_op > 1:
-                preshape[1, 1:] = np.flip(d ** np.diff(apply_to)) / 2
-
-            shape1 = np.zeros(2 * n_op + 1, dtype=int)
-            shape2 = np.zeros(2 * n_op + 1, dtype=int)
-            order1 = np.zeros(2 * n_op + 1, dtype=int)
-            order2 = np.zeros(2 * n_op + 1, dtype=int)
-
-            shape1[:-1] = np.flip(preshape, axis=0).reshape((2 * n_op), order='F')
-            shape1[-1] = -1
-            shape2[:-1] = preshape.reshape((-1), order='C')
-            shape2[-1] = -1
-
-            preorder = np.arange(2 * n_op)
-            order1[:-1] = np.flip(preorder.reshape((-1, 2), order='C'), axis=1).reshape((-1), order='F')
-            order2[:-1] = np.flip(preorder.reshape((2, -1), order='C'), axis=0).reshape((-1), order='F')
-            order1[-1] = 2 * n_op
-            order2[-1] = 2 * n_op
-
-            # Now left multiply
-            out = state.reshape(shape1, order='F').transpose(order1)
-            out = np.dot(op, out.reshape((d ** n_op, -1), order='F'))
-            out = out.reshape(shape2, order='F').transpose(order2)
-            out = out.reshape(state.shape, order='F')
-            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
-        else:
-            # Need to reshape the operator given
-            apply_to = np.asarray(apply_to, dtype=int)
-            new_shape = d * np.ones(2 * n_op, dtype=int)
-            permut = np.argsort(apply_to)
-            transpose_ord = np.zeros(2 * n_op, dtype=int)
-
-            transpose_ord[:n_op] = (n_op - 1) * np.ones(n_op, dtype=int) - np.flip(permut, axis=0)
-            transpose_ord[n_op:] = (2 * n_op - 1) * np.ones(n_op, dtype=int) - np.flip(permut, axis=0)
-
-            sorted_op = np.reshape(np.transpose(np.reshape(op, new_shape, order='F'), axes=transpose_ord),
-                                   (d ** n_op, d ** n_op), order='F')
-            sorted_apply_to = apply_to[permut]
-
-            return left_multiply(state, sorted_apply_to, sorted_op)
+        out = contraction.left_multiply(state, apply_to, op, d)
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
         # op should be a list of Pauli operators
-        out = state.copy()
-        for i in range(len(apply_to)):
-            ind = d ** apply_to[i]
-            if state.is_ket:
-                # Note index start from the right (sN,...,s3,s2,s1)
-                out = out.reshape((-1, d, ind), order='F')
-                if op[i] == 'X':  # Sigma_X
-                    out = np.flip(out, 1)
-                elif op[i] == 'Y':  # Sigma_Y
-                    out = np.flip(out, 1)
-                    out[:, 0, :] = -1j * out[:, 0, :]
-                    out[:, d - 1, :] = 1j * out[:, d - 1, :]
-                elif op[i] == 'Z':  # Sigma_Z
-                    out[:, d - 1, :] = -out[:, d - 1, :]
-
-                out = out.reshape(state.shape, order='F')
-            else:
-                out = out.reshape((-1, d, d ** (state.number_physical_qudits - 1), d, ind), order='F')
-                if op[i] == 'X':  # Sigma_X
-                    out = np.flip(out, 1)
-                elif op[i] == 'Y':  # Sigma_Y
-                    out = np.flip(out, axis=1)
-                    out[:, 0, :, :, :] = -1j * out[:, 0, :, :, :]
-                    out[:, d - 1, :, :, :] = 1j * out[:, d - 1, :, :, :]
-                elif op[i] == 'Z':  # Sigma_Z
-                    out[:, d - 1, :, :, :] = -out[:, d - 1, :, :, :]
-
-                out = out.reshape(state.shape, order='F')
+        out = _pauli_multiply(state, apply_to, op, side='left')
         return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
 
 
+@contraction.accumulate
 def right_multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -178,6 +198,10 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     # Handle types
     if isinstance(apply_to, int):
@@ -192,89 +216,21 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
             op = tensor_product(op)
     if state.is_ket:
         print('Warning: right multiply functionality currently applies the operator and daggers the s.')
-    n_op = len(apply_to)
     if not pauli:
-        if is_sorted(apply_to):
-            # generate necessary shapes
-            preshape = d * np.ones((2, n_op), dtype=int)
-            preshape[0, 0] = int(state.dimension / (d ** (1 + apply_to[n_op - 1])))
-            if n_op > 1:
-                preshape[0, 1:] = np.flip(d ** np.diff(apply_to)) / 2
-
-            shape3 = np.zeros(2 * n_op + 2, dtype=int)
-            shape3[0] = state.dimension
-            shape3[1:-1] = np.reshape(preshape, (2 * n_op), order='F')
-            shape3[-1] = -1
-
-            shape4 = np.zeros(2 * n_op + 2, dtype=int)
-            shape4[0] = state.dimension
-            shape4[1:n_op + 1] = preshape[0]
-            shape4[n_op + 1] = -1
-            shape4[n_op + 2:] = preshape[1]
-
-            order3 = np.zeros(2 * n_op + 2, dtype=int)
-            order3[0] = 0
-            order3[1:n_op + 2] = 2 * np.arange(n_op + 1) + np.ones(n_op + 1)
-            order3[n_op + 2:] = 2 * np.arange(1, n_op + 1)
-
-            order4 = np.zeros(2 * n_op + 2, dtype=int)
-            order4[0] = 0
-            order4[1] = 1
-            order4[2:] = np.flip(np.arange(2, 2 * n_op + 2).reshape((2, -1), order='C'), axis=0).reshape((-1),
-                                                                                                         order='F')
-
-            # right multiply
-            out = state.reshape(shape3, order='F').transpose(order3)
-            out = np.dot(out.reshape((-1, d ** n_op), order='F'), op.conj().T)
-            out = out.reshape(shape4, order='F').transpose(order4)
-            out = out.reshape(state.shape, order='F')
-            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
+        if state.is_ket:
+            out = contraction.left_multiply(state, apply_to, op, d).conj().T
         else:
-            new_shape = 2 * np.ones(2 * n_op, dtype=int)
-            permut = np.argsort(apply_to)
-            transpose_ord = np.zeros(2 * n_op, dtype=int)
-
-            transpose_ord[:n_op] = (n_op - 1) * np.ones(n_op, dtype=int) - np.flip(permut, axis=0)
-            transpose_ord[n_op:] = (2 * n_op - 1) * np.ones(n_op, dtype=int) - np.flip(permut, axis=0)
-
-            sorted_op = np.reshape(np.transpose(np.reshape(op, new_shape, order='F'), axes=transpose_ord),
-                                   (d ** n_op, d ** n_op), order='F')
-            sorted_apply_to = apply_to[permut]
-
-            return right_multiply(state, sorted_apply_to, sorted_op)
+            out = contraction.right_multiply(state, apply_to, op, d)
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
-        out = state.copy()
-        for i in range(len(apply_to)):
-            ind = d ** apply_to[i]
-            if state.is_ket:
-                # Note index start from the right (sN,...,s3,s2,s1)
-                out = out.reshape((-1, d, ind), order='F')
-                if op[i] == 'X':  # Sigma_X
-                    out = np.flip(out, 1)
-                elif op[i] == 'Y':  # Sigma_Y
-                    out = np.flip(out, 1)
-                    out[:, 0, :] = -1j * out[:, 0, :]
-                    out[:, d - 1, :] = 1j * out[:, d - 1, :]
-                elif op[i] == 'Z':  # Sigma_Z
-                    out[:, d - 1, :] = -out[:, d - 1, :]
-
-                out = out.reshape(state.shape, order='F')
-                out = out.conj().T
-            else:
-                out = out.reshape((-1, d, d ** (state.number_physical_qudits - 1), d, ind), order='F')
-                if op[i] == 'X':  # Sigma_X
-                    out = np.flip(out, axis=3)
-                elif op[i] == 'Y':  # Sigma_Y
-                    out = np.flip(out, axis=3)
-                    out[:, :, :, 0, ] = 1j * out[:, :, :, 0, :]
-                    out[:, :, :, d - 1, ] = -1j * out[:, :, :, d - 1, :]
-                elif op[i] == 'Z':  # Sigma_Z
-                    out[:, :, :, d - 1, :] = -out[:, :, :, d - 1, :]
-
-                out = out.reshape(state.shape, order='F')
+        if state.is_ket:
+            out = _pauli_multiply(state, apply_to, op, side='left').conj().T
+        else:
+            out = _pauli_multiply(state, apply_to, op, side='right')
         return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
 
 
+@contraction.accumulate
 def multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -284,6 +240,10 @@ def multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     # Type handling
     if isinstance(apply_to, int):
@@ -298,25 +258,13 @@ def multiply(state: State, apply_to: Union[int, list], op):
             op = tensor_product(op)
     if not state.is_ket:
         if pauli:
-            out = state.copy()
-            for i in range(len(apply_to)):
-                ind = d ** apply_to[i]
-                out = out.reshape((-1, d, d ** (state.number_physical_qudits - 1), d, ind), order='F')
-                if op[i] == 'X':  # Sigma_X
-                    out = np.flip(out, axis=(1, 3))
-                elif op[i] == 'Y':  # Sigma_Y
-                    out = np.flip(out, axis=(1, 3))
-                    out[:, d - 1, :, 0, :] = -out[:, d - 1, :, 0, :]
-                    out[:, 0, :, d - 1, :] = -out[:, 0, :, d - 1, :]
-                elif op[i] == 'Z':  # Sigma_Z
-                    out[:, d - 1, :, 0, :] = -out[:, d - 1, :, 0, :]
-                    out[:, 0, :, d - 1, :] = -out[:, 0, :, d - 1, :]
-
-            out = out.reshape(state.shape, order='F')
+            out = _pauli_multiply(state, apply_to, op, side='both')
             return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
         else:
             # Note that the conjugate transpose it taken automatically in right_multiply
-            return right_multiply(left_multiply(state, apply_to, op), apply_to, op)
+            # Contract op and its conjugate onto the ket and bra indices in a single pass
+            out = contraction.kraus(state, apply_to, op, d)
+            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
         return left_multiply(state, apply_to, op)
 
@@ -1,8 +1,8 @@
 import numpy as np
 from qsim import tools
-from scipy.linalg import expm
 from typing import Union
 from qsim.codes.quantum_state import State
+from qsim.codes import contraction
 from qsim.tools.tools import int_to_nary
 
 __all__ = ['multiply', 'right_multiply', 'left_multiply', 'rotation']
@@ -30,7 +30,8 @@ def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_invo
     :param is_involutary:
     :param state: input wavefunction or density matrix
     :type state: np.ndarray
-    :param angle: The angle :math:`\\alpha`` to rotate by.
+    :param angle: The angle :math:`\\alpha`` to rotate by. For a batch of kets stacked as columns, this may be an
+        array with one angle per column.
     :type angle: float
     :param op: Operator to act with.
     :type op: np.ndarray
@@ -58,18 +59,24 @@ def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_invo
             elif op[i] == 'Z':
                 temp.append(Z)
         temp = tools.tensor_product(temp)
+        if np.ndim(angle) > 0:
+            # Rotate each ket in a batch by its own angle
+            return contraction.batch_rotation(left_multiply, state, apply_to, angle, temp)
         temp = np.cos(angle) * np.identity(temp.shape[0]) - temp * 1j * np.sin(angle)
         return multiply(state, apply_to, temp)
     else:
+        if np.ndim(angle) > 0:
+            return contraction.batch_rotation(left_multiply, state, apply_to, angle, op)
         if is_involutary:
             op = np.cos(angle) * np.identity(op.shape[0]) - op * 1j * np.sin(angle)
             return multiply(state, apply_to, op)
         elif is_idempotent:
             return multiply(state, apply_to, op)
         else:
-            return multiply(state, apply_to, expm(-1j * angle * op))
+            return multiply(state, apply_to, contraction.exponential(op, angle))
 
 
+@contraction.accumulate
 def left_multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -79,6 +86,10 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     if isinstance(apply_to, int):
         apply_to = [apply_to]
@@ -91,51 +102,13 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
             pauli = True
         else:
             op = tools.tensor_product(op)
-    n_op = len(apply_to)
     if not pauli:
-        if tools.is_sorted(apply_to):
-            # Generate all shapes for left multiplication
-            preshape = d * np.ones((2, n_op), dtype=int)
-            preshape[1, 0] = int(state.dimension / (d ** (1 + apply_to[n_op - 1])))
-            if n_op > 1:
-                preshape[1, 1:] = np.flip(d ** np.diff(apply_to)) / d
-
-            shape1 = np.zeros(2 * n_op + 1, dtype=int)
-            shape2 = np.zeros(2 * n_op + 1, dtype=int)
-            order1 = np.zeros(2 * n_op + 1, dtype=int)
-            order2 = np.zeros(2 * n_op + 1, dtype=int)
-
-            shape1[:-1] = np.flip(preshape, axis=0).reshape((2 * n_op), order='F')
-            shape1[-1] = -1
-            shape2[:-1] = preshape.reshape((-1), order='C')
-            shape2[-1] = -1
-
-            preorder = np.arange(2 * n_op)
-            order1[:-1] = np.flip(preorder.reshape((-1, 2), order='C'), axis=1).reshape((-1), order='F')
-            order2[:-1] = np.flip(preorder.reshape((2, -1), order='C'), axis=0).reshape((-1), order='F')
-            order1[-1] = 2 * n_op
-            order2[-1] = 2 * n_op
-
-            # Now left multiply
-            out = state.reshape(shape1, order='F').transpose(order1)
-            out = np.dot(op, out.reshape((d ** n_op, -1), order='F'))
-            out = out.reshape(shape2, order='F').transpose(order2)
-            out = out.reshape(state.shape, order='F')
-            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
+        if tools.is_diagonal(op):
+            # Diagonal operators act as a broadcast multiply
+            out = contraction.diagonal_multiply(state, apply_to, np.diagonal(op), d)
         else:
-            # Need to reshape the operator given
-            apply_to = np.array(apply_to)
-            new_shape = d * np.ones(2 * n_op, dtype=int)
-            permut = np.argsort(apply_to)
-            transpose_ord = np.zeros(2 * n_op, dtype=int)
-            transpose_ord[:n_op] = (n_op - 1) * np.ones(n_op, dtype=int) - np.flip(permut, axis=0)
-            transpose_ord[n_op:] = (2 * n_op - 1) * np.ones(n_op, dtype=int) - np.flip(permut, axis=0)
-
-            sorted_op = np.reshape(np.transpose(np.reshape(op, new_shape, order='F'), axes=transpose_ord),
-                                   (d ** n_op, d ** n_op), order='F')
-            sorted_apply_to = apply_to[permut]
-
-            return left_multiply(state, sorted_apply_to, sorted_op)
+            out = contraction.left_multiply(state, apply_to, op, d)
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
         # op should be a list of Pauli operators, or
         out = state.copy()
@@ -146,7 +119,7 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
             ind = d ** apply_to[i]
             if state.is_ket:
                 # Note index start from the right (sN,...,s3,s2,s1)
-                out = out.reshape((-1, d, ind), order='F')
+                out = out.reshape((-1, d, ind, state.shape[-1]), order='F')
                 if op[i] == 'X':  # Sigma_X
                     out = np.flip(out, 1)
                 elif op[i] == 'Y':  # Sigma_Y
@@ -171,6 +144,7 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
         return out
 
 
+@contraction.accumulate
 def right_multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -180,6 +154,10 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     if isinstance(apply_to, int):
         apply_to = [apply_to]
@@ -194,54 +172,14 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
             op = tools.tensor_product(op)
     if state.is_ket:
         print('Warning: right multiply functionality currently applies the operator and daggers the s.')
-    n_op = len(apply_to)
     if not pauli:
-        if tools.is_sorted(apply_to):
-            # generate necessary shapes
-            preshape = d * np.ones((2, n_op), dtype=int)
-            preshape[0, 0] = int(state.dimension / (d ** (1 + apply_to[n_op - 1])))
-            if n_op > 1:
-                preshape[0, 1:] = np.flip(d ** np.diff(apply_to)) / d
-
-            shape3 = np.zeros(2 * n_op + 2, dtype=int)
-            shape3[0] = state.dimension
-            shape3[1:-1] = np.reshape(preshape, (2 * n_op), order='F')
-            shape3[-1] = -1
-
-            shape4 = np.zeros(2 * n_op + 2, dtype=int)
-            shape4[0] = state.dimension
-            shape4[1:n_op + 1] = preshape[0]
-            shape4[n_op + 1] = -1
-            shape4[n_op + 2:] = preshape[1]
-
-            order3 = np.zeros(2 * n_op + 2, dtype=int)
-            order3[0] = 0
-            order3[1:n_op + 2] = 2 * np.arange(n_op + 1) + np.ones(n_op + 1, dtype=int)
-            order3[n_op + 2:] = 2 * np.arange(1, n_op + 1)
-
-            order4 = np.zeros(2 * n_op + 2, dtype=int)
-            order4[0] = 0
-            order4[1] = 1
-            order4[2:] = np.flip(np.arange(2, 2 * n_op + 2).reshape((2, -1), order='C'), axis=0).reshape((-1),
-                                                                                                         order='F')
-            # right multiply
-            out = state.reshape(shape3, order='F').transpose(order3)
-            out = np.dot(out.reshape((-1, d ** n_op), order='F'), op.conj().T)
-            out = out.reshape(shape4, order='F').transpose(order4)
-            out = out.reshape(state.shape, order='F')
-            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
+        if state.is_ket:
+            out = left_multiply(state, apply_to, op).conj().T
+        elif tools.is_diagonal(op):
+            out = contraction.diagonal_multiply(state, apply_to, np.diagonal(op), d, left=False, right=True)
         else:
-            new_shape = d * np.ones(2 * n_op)
-            permut = np.argsort(apply_to)
-            transpose_ord = np.zeros(2 * n_op)
-            transpose_ord[:n_op] = (n_op - 1) * np.ones(n_op, dtype=int) - np.flip(permut, axis=0)
-            transpose_ord[n_op:] = (2 * n_op - 1) * np.ones(n_op, dtype=int) - np.flip(permut, axis=0)
-
-            sorted_op = np.reshape(np.transpose(np.reshape(op, new_shape, order='F'), axes=transpose_ord),
-                                   (d ** n_op, d ** n_op), order='F')
-            sorted_apply_to = apply_to[permut]
-
-            return right_multiply(state, sorted_apply_to, sorted_op)
+            out = contraction.right_multiply(state, apply_to, op, d)
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
         out = state.copy()
         # Type handler:
@@ -251,7 +189,7 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
             ind = d ** apply_to[i]
             if state.is_ket:
                 # Note index start from the right (sN,...,s3,s2,s1)
-                out = out.reshape((-1, d, ind), order='F')
+                out = out.reshape((-1, d, ind, state.shape[-1]), order='F')
                 if op[i] == 'X':  # Sigma_X
                     out = np.flip(out, 1)
                 elif op[i] == 'Y':  # Sigma_Y
@@ -277,6 +215,7 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
         return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
 
 
+@contraction.accumulate
 def multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -286,6 +225,10 @@ def multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     if isinstance(apply_to, int):
         apply_to = [apply_to]
@@ -316,9 +259,14 @@ def multiply(state: State, apply_to: Union[int, list], op):
 
             out = out.reshape(state.shape, order='F')
 
+            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
+        elif tools.is_diagonal(op):
+            out = contraction.diagonal_multiply(state, apply_to, np.diagonal(op), d, right=True)
             return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
         else:
-            return right_multiply(left_multiply(state, apply_to, op), apply_to, op)
+            # Contract op and its conjugate onto the ket and bra indices in a single pass
+            out = contraction.kraus(state, apply_to, op, d)
+            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
         return left_multiply(state, apply_to, op)
 
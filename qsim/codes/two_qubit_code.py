@@ -1,8 +1,9 @@
 import numpy as np
+from functools import lru_cache
 from qsim import tools
 from . import qubit
-from scipy.linalg import expm
 from qsim.codes.quantum_state import State
+from qsim.codes import contraction
 from typing import Union
 
 
@@ -23,6 +24,22 @@ code_space_projector = tools.outer_product(logical_basis[0], logical_basis[0]) +
                                                                                                      logical_basis[1])
 
 
+@lru_cache(maxsize=16)
+def _pauli_operator(op: tuple):
+    """Returns the tensor product of the logical Paulis named in ``op``, which should not be modified in place."""
+    temp = []
+    for i in range(len(op)):
+        if op[i] == 'X':
+            temp.append(X)
+        elif op[i] == 'Y':
+            temp.append(Y)
+        elif op[i] == 'Z':
+            temp.append(Z)
+    temp = tools.tensor_product(temp)
+    temp.flags.writeable = False
+    return temp
+
+
 def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_involutary=False, is_idempotent=False):
     """
     Apply a single qubit rotation :math:`e^{-i \\alpha A}` to the input ``codes``.
@@ -32,7 +49,8 @@ def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_invo
     :param is_involutary:
     :param state: input wavefunction or density matrix
     :type state: np.ndarray
-    :param angle: The angle :math:`\\alpha`` to rotate by.
+    :param angle: The angle :math:`\\alpha`` to rotate by. For a batch of kets stacked as columns, this may be an
+        array with one angle per column.
     :type angle: float
     :param op: Operator to act with.
     :type op: np.ndarray
@@ -49,19 +67,15 @@ def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_invo
         else:
             op = tools.tensor_product(op)
     if pauli:
-        # Construct operator to use
-        temp = []
-        for i in range(len(op)):
-            if op[i] == 'X':
-                temp.append(X)
-            elif op[i] == 'Y':
-                temp.append(Y)
-            elif op[i] == 'Z':
-                temp.append(Z)
-        temp = tools.tensor_product(temp)
+        temp = _pauli_operator(tuple(op))
+        if np.ndim(angle) > 0:
+            # Rotate each ket in a batch by its own angle
+            return contraction.batch_rotation(left_multiply, state, apply_to, angle, temp)
         temp = np.cos(angle) * np.identity(temp.shape[0]) - temp * 1j * np.sin(angle)
         return multiply(state, apply_to, temp)
     else:
+        if np.ndim(angle) > 0:
+            return contraction.batch_rotation(left_multiply, state, apply_to, angle, op)
         if is_involutary:
             op = np.cos(angle) * np.identity(op.shape[0]) - op * 1j * np.sin(angle)
             return multiply(state, apply_to, op)
@@ -69,9 +83,10 @@ def rotation(state: State, apply_to: Union[int, list], angle: float, op, is_invo
             op = (np.exp(-1j * angle) - 1) * op + np.identity(op.shape[0])
             return multiply(state, apply_to, op)
         else:
-            return multiply(state, apply_to, expm(-1j * angle * op))
+            return multiply(state, apply_to, contraction.exponential(op, angle))
 
 
+@contraction.accumulate
 def left_multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -81,6 +96,10 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     if isinstance(apply_to, int):
         apply_to = [apply_to]
@@ -93,50 +112,9 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
             pauli = True
         else:
             op = tools.tensor_product(op)
-    n_op = len(apply_to)
     if not pauli:
-        if tools.is_sorted(apply_to):
-            # Generate all shapes for left multiplication
-            preshape = (d**n) * np.ones((2, n_op), dtype=int)
-            preshape[1, 0] = int(state.dimension / ((d**n) ** (1 + apply_to[n_op - 1])))
-            if n_op > 1:
-                preshape[1, 1:] = np.flip((d**n) ** np.diff(apply_to)) / (d**n)
-
-            shape1 = np.zeros(2 * n_op + 1, dtype=int)
-            shape2 = np.zeros(2 * n_op + 1, dtype=int)
-            order1 = np.zeros(2 * n_op + 1, dtype=int)
-            order2 = np.zeros(2 * n_op + 1, dtype=int)
-
-            shape1[:-1] = np.flip(preshape, axis=0).reshape((2 * n_op), order='F')
-            shape1[-1] = -1
-            shape2[:-1] = preshape.reshape((-1), order='C')
-            shape2[-1] = -1
-
-            preorder = np.arange(2 * n_op)
-            order1[:-1] = np.flip(preorder.reshape((-1, 2), order='C'), axis=1).reshape((-1), order='F')
-            order2[:-1] = np.flip(preorder.reshape((2, -1), order='C'), axis=0).reshape((-1), order='F')
-            order1[-1] = 2 * n_op
-            order2[-1] = 2 * n_op
-
-            # Now left multiply
-            out = state.reshape(shape1, order='F').transpose(order1)
-            out = np.dot(op, out.reshape(((d**n) ** n_op, -1), order='F'))
-            out = out.reshape(shape2, order='F').transpose(order2)
-            out = out.reshape(state.shape, order='F')
-            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
-        else:
-            # Need to reshape the operator given
-            new_shape = (d**n) * np.ones(2 * n_op, dtype=int)
-            permut = np.argsort(apply_to)
-            transpose_ord = np.zeros(2 * n_op, dtype=int)
-            transpose_ord[:n_op] = permut
-            transpose_ord[n_op:] = n_op * np.ones(n_op, dtype=int) + permut
-
-            sorted_op = np.reshape(np.transpose(np.reshape(op, new_shape, order='F'), axes=transpose_ord),
-                                   ((d**n) ** n_op, (d**n) ** n_op), order='F')
-            sorted_apply_to = apply_to[permut]
-
-            return left_multiply(state, sorted_apply_to, sorted_op)
+        out = contraction.left_multiply(state, apply_to, op, d ** n)
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
         # op should be a list of Pauli operators, or
         out = state.copy()
@@ -150,6 +128,7 @@ def left_multiply(state: State, apply_to: Union[int, list], op):
         return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
 
 
+@contraction.accumulate
 def right_multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -159,6 +138,10 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     if isinstance(apply_to, int):
         apply_to = [apply_to]
@@ -173,54 +156,12 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
             op = tools.tensor_product(op)
     if state.is_ket:
         print('Warning: right multiply functionality currently applies the operator and daggers the s.')
-    n_op = len(apply_to)
     if not pauli:
-        if tools.is_sorted(apply_to):
-            # generate necessary shapes
-            preshape = (d**n) * np.ones((2, n_op), dtype=int)
-            preshape[0, 0] = int(state.dimension / ((d**n) ** (1 + apply_to[n_op - 1])))
-            if n_op > 1:
-                preshape[0, 1:] = np.flip((d**n) ** np.diff(apply_to)) / (d**n)
-
-            shape3 = np.zeros(2 * n_op + 2, dtype=int)
-            shape3[0] = state.dimension
-            shape3[1:-1] = np.reshape(preshape, (2 * n_op), order='F')
-            shape3[-1] = -1
-
-            shape4 = np.zeros(2 * n_op + 2, dtype=int)
-            shape4[0] = state.dimension
-            shape4[1:n_op + 1] = preshape[0]
-            shape4[n_op + 1] = -1
-            shape4[n_op + 2:] = preshape[1]
-
-            order3 = np.zeros(2 * n_op + 2, dtype=int)
-            order3[0] = 0
-            order3[1:n_op + 2] = 2 * np.arange(n_op + 1) + np.ones(n_op + 1)
-            order3[n_op + 2:] = 2 * np.arange(1, n_op + 1)
-
-            order4 = np.zeros(2 * n_op + 2, dtype=int)
-            order4[0] = 0
-            order4[1] = 1
-            order4[2:] = np.flip(np.arange(2, 2 * n_op + 2).reshape((2, -1), order='C'), axis=0).reshape((-1), order='F')
-
-            # right multiply
-            out = state.reshape(shape3, order='F').transpose(order3)
-            out = np.dot(out.reshape((-1, (d**n) ** n_op), order='F'), op.conj().T)
-            out = out.reshape(shape4, order='F').transpose(order4)
-            out = out.reshape(state.shape, order='F')
-            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
+        if state.is_ket:
+            out = contraction.left_multiply(state, apply_to, op, d ** n).conj().T
         else:
-            new_shape = 2 * np.ones(2 * n_op, dtype=int)
-            permut = np.argsort(apply_to)
-            transpose_ord = np.zeros(2 * n_op, dtype=int)
-            transpose_ord[:n_op] = permut
-            transpose_ord[n_op:] = n_op * np.ones(n_op, dtype=int) + permut
-
-            sorted_op = np.reshape(np.transpose(np.reshape(op, new_shape, order='F'), axes=transpose_ord),
-                                   ((d**n) ** n_op, (d**n) ** n_op), order='F')
-            sorted_apply_to = apply_to[permut]
-
-            return right_multiply(state, sorted_apply_to, sorted_op)
+            out = contraction.right_multiply(state, apply_to, op, d ** n)
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
         out = state.copy()
         for i in range(len(apply_to)):
@@ -234,6 +175,7 @@ def right_multiply(state: State, apply_to: Union[int, list], op):
         return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
 
 
+@contraction.accumulate
 def multiply(state: State, apply_to: Union[int, list], op):
     """
     Apply a multi-qubit operator on several qubits (indexed in apply_to) of the input codes.
@@ -243,6 +185,10 @@ def multiply(state: State, apply_to: Union[int, list], op):
     :type apply_to: list of int
     :param op: Operator to act with.
     :type op: np.ndarray (2-dimensional)
+    :param out: If given, the product is added into this array, which is returned.
+    :type out: np.ndarray
+    :param coefficient: Scalar multiplying the product, defaults to 1.
+    :type coefficient: complex
     """
     if isinstance(apply_to, int):
         apply_to = [apply_to]
@@ -268,6 +214,8 @@ def multiply(state: State, apply_to: Union[int, list], op):
                     out = qubit.left_multiply(out, [n * apply_to[i], n * apply_to[i] + 1], ['Z', 'Z'])
             return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
         else:
-            return right_multiply(left_multiply(state, apply_to, op), apply_to, op)
+            # Contract op and its conjugate onto the ket and bra indices in a single pass
+            out = contraction.kraus(state, apply_to, op, d ** n)
+            return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code)
     else:
         return left_multiply(state, apply_to, op)
\ No newline at end of file
@@ -1,12 +1,109 @@
 import numpy as np
 import networkx as nx
-from qsim.codes import qubit, rydberg
-from qsim.codes.quantum_state import State
+from qsim.codes import qubit, rydberg, contraction
+from qsim.codes.quantum_state import State, complex_dtype, real_dtype
 from qsim import tools
-from scipy.linalg import expm
 import scipy.sparse as sparse
-from scipy.sparse.linalg import expm_multiply
-from qsim.graph_algorithms.graph import Graph, IS_projector
+from scipy.sparse.linalg import expm_multiply, LinearOperator, aslinearoperator
+from qsim.graph_algorithms.graph import Graph, IS_projector, SymmetrySector
+
+
+def _expm_multiply(hamiltonian, state: State, time):
+    """Computes :math:`e^{-iHt}|\\psi\\rangle`. For a batch of kets stacked as columns, ``time`` may be an array
+    with one time per column."""
+    if np.ndim(time) == 0:
+        return expm_multiply(-1j * time * hamiltonian, state)
+    out = np.zeros(state.shape, dtype=state.dtype)
+    for b in range(state.shape[-1]):
+        out[:, b] = expm_multiply(-1j * time[b] * hamiltonian, np.asarray(state)[:, b])
+    return out
+
+
+def _as_precision(array):
+    """Casts a real or complex array to the current precision, keeping it real or complex."""
+    if np.iscomplexobj(array):
+        return array.astype(complex_dtype())
+    return array.astype(real_dtype())
+
+
+def _chunked_diagonal_evolve(hamiltonian, state: State, time):
+    """Computes :math:`e^{-iHt}|\\psi\\rangle` for a diagonal Hamiltonian one chunk of its diagonal at a time.
+    Memory-mapped kets are updated in place."""
+    if not state.is_memmap:
+        state = state.copy()
+    for chunk in contraction.chunks(state.shape[0]):
+        state[chunk] *= np.exp(-1j * time * hamiltonian._diagonal_chunk(chunk))
+    return state
+
+
+def _chunked_diagonal_expectation(hamiltonian, state: State):
+    """Returns :math:`\\langle\\psi|H|\\psi\\rangle` for a diagonal Hamiltonian, one chunk of the ket at a time."""
+    out = 0
+    for chunk in contraction.chunks(state.shape[0]):
+        out = out + np.sum(np.abs(np.asarray(state[chunk])) ** 2 * hamiltonian._diagonal_chunk(chunk), axis=0)
+    out = np.real(out)
+    if state.shape[-1] == 1:
+        return out[0]
+    return out
+
+
+def _diagonal_table(operator):
+    """Returns the diagonal of a diagonal single-qudit operator, dropping a vanishing imaginary part."""
+    diagonal = np.diagonal(operator)
+    if np.all(np.imag(diagonal) == 0):
+        return np.real(diagonal)
+    return diagonal
+
+
+def _exact_dtype(terms):
+    """Returns the narrowest dtype holding every sum of the diagonal terms ``(sites, table, weight)`` exactly: the
+    smallest sufficient integer type if all terms take integer values, and the current precision otherwise."""
+    values = [weight * np.asarray(table) for (_, table, weight) in terms]
+    if any(np.iscomplexobj(value) for value in values):
+        return complex_dtype()
+    if all(np.all(value == np.round(value)) for value in values):
+        bound = sum(np.max(np.abs(value)) for value in values)
+        for dtype in (np.int8, np.int16, np.int32, np.int64):
+            if bound <= np.iinfo(dtype).max:
+                return dtype
+    return real_dtype()
+
+
+def _local_diagonal(terms, n, d, chunk: slice, dtype):
+    """Returns the entries ``chunk`` of the diagonal :math:`\\sum_t w_t T_t[x_{i_1}, x_{i_2}, \\dots]` of a sum of
+    diagonal terms ``(sites, table, weight)`` on ``n`` qudits of dimension ``d`` as a column, where :math:`x_i` is
+    the digit of qudit :math:`i` in the basis index. Digits are read off with bitwise operations for qubits."""
+    # The index must hold powers of d up to the full dimension, whatever the size of the chunk
+    index = np.arange(chunk.start, chunk.stop, dtype=np.int64)
+    out = np.zeros((index.size, 1), dtype=dtype)
+    digits = {}
+    for (sites, table, weight) in terms:
+        # Look up each entry in the flattened table, indexed by the digits of the sites read as a single number
+        lookup = np.zeros(index.size, dtype=np.min_scalar_type(d ** len(sites) - 1))
+        for i in sites:
+            if i not in digits:
+                # Qudit i is digit n - i - 1 of the index
+                if d == 2:
+                    digits[i] = ((index >> (n - i - 1)) & 1).astype(np.uint8)
+                else:
+                    digits[i] = (index // d ** (n - i - 1) % d).astype(np.min_scalar_type(d - 1))
+            lookup *= d
+            lookup += digits[i]
+        out[:, 0] += np.take((weight * np.asarray(table)).astype(dtype).flatten(), lookup)
+    return out
+
+
+def _scale(energy, terms):
+    """Returns ``energy * terms`` in at least the current precision, so narrow integer terms cannot overflow."""
+    return np.multiply(energy, terms, dtype=np.result_type(energy, terms, real_dtype()))
+
+
+def _ket_expectation(state: State, product):
+    """Returns :math:`\\langle\\psi|H|\\psi\\rangle` given ``product`` :math:`=H|\\psi\\rangle`, one value per
+    column for a batch of kets."""
+    if state.shape[-1] == 1:
+        return np.real(np.vdot(state, product))
+    return np.real(np.sum(np.conj(state) * product, axis=0))
 
 
 class HamiltonianDriver(object):
@@ -15,6 +112,7 @@ class HamiltonianDriver(object):
         """Default is that the first element in transition is the higher energy s."""
         self.transition = transition
         self.energies = energies
+        self._propagators = {}
         self.pauli = pauli
         self.code = code
         self.graph = graph
@@ -42,16 +140,12 @@ class HamiltonianDriver(object):
             # Generate sparse mixing Hamiltonian
             assert graph is not None
             assert isinstance(graph, Graph)
-            if code is not qubit:
-                IS, nary_to_index, num_IS = graph.independent_sets_code(self.code)
-            else:
-                # We have already solved for this information
-                IS, nary_to_index, num_IS = graph.independent_sets, graph.binary_to_index, graph.num_independent_sets
+            _, nary = graph.independent_sets_array(self.code)
+            num_IS = nary.shape[0]
             if self.pauli == 'Z':
-                self._diagonal_hamiltonian = np.zeros((num_IS, 1))
-                for k in IS:
-                    self._diagonal_hamiltonian[k, 0] = np.sum(IS[k][2] == self.transition[0]) - np.sum(
-                        IS[k][2] == self.transition[1])
+                self._diagonal_hamiltonian = (np.sum(nary == self.transition[0], axis=1) -
+                                              np.sum(nary == self.transition[1], axis=1)).astype(real_dtype())
+                self._diagonal_hamiltonian = self._diagonal_hamiltonian[:, np.newaxis]
 
                 self._csc_hamiltonian = sparse.csc_matrix((self._diagonal_hamiltonian.T[0],
                                                            (np.arange(len(self._diagonal_hamiltonian)),
@@ -62,42 +156,14 @@ class HamiltonianDriver(object):
                     self._hamiltonian = self._csc_hamiltonian
 
             elif self.pauli == 'X' or self.pauli == 'Y':
-                # For each IS, look at spin flips generated by the laser
-                # Over-allocate space
-                rows = np.zeros(graph.n * num_IS, dtype=int)
-                columns = np.zeros(graph.n * num_IS, dtype=int)
-                entries = np.zeros(graph.n * num_IS, dtype=float)
-                num_terms = 0
-                for i in IS:
-                    for j in range(len(IS[i][2])):
-                        if IS[i][2][j] == self.transition[1]:
-                            # Flip spin at this location
-                            # Get binary representation
-                            temp = IS[i][2].copy()
-                            temp[j] = self.transition[0]
-                            flipped_temp = tools.nary_to_int(temp, base=code.d)
-                            if flipped_temp in nary_to_index:
-                                # This is a valid spin flip
-                                rows[num_terms] = nary_to_index[flipped_temp]
-                                columns[num_terms] = i
-                                if self.pauli == 'X':
-                                    entries[num_terms] = 1
-                                elif self.pauli == 'Y':
-                                    entries[num_terms] = -1j
-                                num_terms += 1
-                # Cut off the excess in the arrays
-                columns = columns[:2 * num_terms]
-                rows = rows[:2 * num_terms]
-                entries = entries[:2 * num_terms]
-                # Populate the second half of the entries according to self.pauli
+                # Each spin flip generated by the laser, together with its conjugate
+                flipped, original, _ = graph.independent_set_flips(self.code, self.transition[1], self.transition[0])
+                rows = np.concatenate([flipped, original])
+                columns = np.concatenate([original, flipped])
                 if self.pauli == 'X':
-                    columns[num_terms:2 * num_terms] = rows[:num_terms]
-                    rows[num_terms:2 * num_terms] = columns[:num_terms]
-                    entries[num_terms:2 * num_terms] = entries[:num_terms]
-                elif self.pauli == 'Y':
-                    columns[num_terms:2 * num_terms] = rows[:num_terms]
-                    rows[num_terms:2 * num_terms] = columns[:num_terms]
-                    entries[num_terms:2 * num_terms] = -1 * entries[:num_terms]
+                    entries = np.ones(rows.size, dtype=real_dtype())
+                else:
+                    entries = np.concatenate([np.full(flipped.size, -1j), np.full(flipped.size, 1j)])
                 # Now, construct the Hamiltonian
                 self._csc_hamiltonian = sparse.csc_matrix((entries, (rows, columns)), shape=(num_IS, num_IS))
                 self._hamiltonian = self._csc_hamiltonian
@@ -120,14 +186,8 @@ class HamiltonianDriver(object):
                 assert self.graph is not None
             except AssertionError:
                 print('self.graph must be not None to generate the Hamiltonian property.')
-            self._hamiltonian = sparse.csr_matrix(((self.code.d * self.code.n) ** self.graph.n,
-                                                   (self.code.d * self.code.n) ** self.graph.n))
-            for i in range(self.graph.n):
-                self._hamiltonian = self._hamiltonian + tools.tensor_product(
-                    [sparse.identity((self.code.d * self.code.n) ** i),
-                     self._operator,
-                     sparse.identity((self.code.d * self.code.n) ** (self.graph.n - i - 1))],
-                    sparse=True)
+            self._hamiltonian = tools.local_operator([((i,), self._operator, 1) for i in range(self.graph.n)],
+                                                     self.graph.n, d=self.code.d ** self.code.n)
         return self.energies[0] * self._hamiltonian
 
     @property
@@ -153,19 +213,15 @@ class HamiltonianDriver(object):
             state_shape = state.shape
             for i in range(state.number_logical_qudits):
                 if self.code.logical_code:
-                    if self.pauli == 'X':
-                        temp = temp + self.code.left_multiply(state, [i], ['X'])
-                    elif self.pauli == 'Y':
-                        temp = temp + self.code.left_multiply(state, [i], ['Y'])
-                    elif self.pauli == 'Z':
-                        temp = temp + self.code.left_multiply(state, [i], ['Z'])
+                    if self.pauli == 'X' or self.pauli == 'Y' or self.pauli == 'Z':
+                        self.code.left_multiply(state, [i], [self.pauli], out=temp)
                 elif not self.code.logical_code:
                     ind = self.code.d ** i
-                    out = np.zeros_like(state, dtype=np.complex128)
+                    out = np.zeros_like(state, dtype=state.dtype)
                     if state.is_ket:
-                        state = state.reshape((-1, self.code.d, ind), order='F')
+                        state = state.reshape((-1, self.code.d, ind, state_shape[-1]), order='F')
                         # Note index start from the right (sN,...,s3,s2,s1)
-                        out = out.reshape((-1, self.code.d, ind), order='F')
+                        out = out.reshape((-1, self.code.d, ind, state_shape[-1]), order='F')
                         if self.pauli == 'X':  # Sigma_X
                             # We want to exchange two indices
                             out[:, [self.transition[0], self.transition[1]], :] = \
@@ -201,7 +257,7 @@ class HamiltonianDriver(object):
                             out[:, self.transition[1], :, :, :] = -1 * out[:, self.transition[1], :, :, :]
                         state = state.reshape(state_shape, order='F')
                         out = out.reshape(state_shape, order='F')
-                    temp = temp + out
+                    temp += out
             return State(self.energies[0] * temp, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
                          graph=self.graph)
         else:
@@ -223,12 +279,8 @@ class HamiltonianDriver(object):
             state_shape = state.shape
             for i in range(state.number_logical_qudits):
                 if self.code.logical_code:
-                    if self.pauli == 'X':
-                        temp = temp + self.code.right_multiply(state, [i], ['X'])
-                    elif self.pauli == 'Y':
-                        temp = temp + self.code.right_multiply(state, [i], ['Y'])
-                    elif self.pauli == 'Z':
-                        temp = temp + self.code.right_multiply(state, [i], ['Z'])
+                    if self.pauli == 'X' or self.pauli == 'Y' or self.pauli == 'Z':
+                        self.code.right_multiply(state, [i], [self.pauli], out=temp)
                 elif not self.code.logical_code:
                     ind = self.code.d ** i
                     out = np.zeros_like(state)
@@ -256,7 +308,7 @@ class HamiltonianDriver(object):
                         state = state.reshape(state_shape, order='F')
                     state = state.reshape(state_shape, order='F')
                     out = out.reshape(state_shape, order='F')
-                    temp = temp + out
+                    temp += out
             return State(self.energies[0] * temp, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
                          graph=self.graph)
         else:
@@ -272,8 +324,8 @@ class HamiltonianDriver(object):
         Use reshape to efficiently implement evolution under :math:`H_B=\\sum_i X_i`
         """
         if not self.IS_subspace:
-            # We don't want to modify the original s
-            out = state.copy()
+            # We don't want to modify the original s, unless it is memory-mapped and rotated in place
+            out = state if state.is_memmap else state.copy()
             for i in range(state.number_logical_qudits):
                 # Note that self._operator is not necessarily involutary
                 if self.pauli == 'X':
@@ -290,7 +342,7 @@ class HamiltonianDriver(object):
                     return State(np.exp(-1j * time * self.hamiltonian) * state, is_ket=state.is_ket,
                                  IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
                 else:
-                    return State(expm_multiply(-1j * time * self.hamiltonian, state),
+                    return State(_expm_multiply(self.hamiltonian, state, time),
                                  is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
             else:
                 if self.hamiltonian.shape[1] == 1:
@@ -298,53 +350,101 @@ class HamiltonianDriver(object):
                     return State(exp_hamiltonian * state * exp_hamiltonian.conj().T,
                                  is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
                 else:
-                    exp_hamiltonian = expm(-1j * time * self.hamiltonian)
-                    return State(exp_hamiltonian @ state @ exp_hamiltonian.conj().T,
+                    return State(tools.evolve_density_matrix(self.hamiltonian, state, time, cache=self._propagators,
+                                                             key=tuple(self.energies)),
                                  is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
 
 
 class HamiltonianMaxCut(object):
-    def __init__(self, G: Graph, code=qubit, energies=(1,), cost_function=True, use_Z2_symmetry=False):
+    def __init__(self, G: Graph, code=qubit, energies=(1,), cost_function=True, use_Z2_symmetry=False,
+                 store_diagonal=True):
         # If MIS is true, create an MIS Hamiltonian. Otherwise, make a MaxCut Hamiltonian
         r"""
-        Generate a vector corresponding to the diagonal of the MaxCut Hamiltonian.
+        Generate a vector corresponding to the diagonal of the MaxCut Hamiltonian. The diagonal is computed from
+        the digits of the basis indices one chunk at a time, and stored in the narrowest dtype which holds it
+        exactly, e.g. ``int8`` for small unweighted graphs. If ``store_diagonal`` is ``False``, it is instead
+        recomputed one chunk at a time whenever it is needed, so that :py:meth:`evolve`, :py:meth:`cost_function` and
+        :py:attr:`optimum` never hold it in memory; this is only supported for codes with a diagonal Z operator, and
+        the Hamiltonian is then not available as a matrix.
         """
         self.code = code
         self.energies = energies
+        self._propagators = {}
         # Make sure all edges have weight attribute; default to 1
 
         self.graph = G
         self.optimization = 'max'
         self.N = self.graph.n
+        self._cost_function = cost_function
+        self._is_diagonal = tools.is_diagonal(self.code.Z)
+        # Diagonal of the Hamiltonian in the standard basis. If the Hamiltonian is not diagonal, this is the
+        # diagonal of the qubit Hamiltonian, which has the same optimum
+        if self._is_diagonal:
+            self._d = self.code.d ** self.code.n
+            z = _diagonal_table(self.code.Z)
+        else:
+            self._d = qubit.d
+            z = _diagonal_table(qubit.Z)
+        if cost_function:
+            table = (1 - np.outer(z, z)) / 2
+        else:
+            table = np.outer(z, z)
+        self._diagonal_terms = [((a, b), table, G.graph[a][b]['weight']) for a, b in self.graph.edges]
+        self._diagonal_dtype = _exact_dtype(self._diagonal_terms)
+        # With the Z2 symmetry, the first node is fixed to the +1 eigenstate of Z, which is the first block of the
+        # diagonal
         if use_Z2_symmetry:
-            c = np.zeros([self.code.d ** (self.code.n * (self.N-1)), 1])
+            self.dimension = self._d ** (self.N - 1)
         else:
-            c = np.zeros([self.code.d ** (self.code.n * self.N), 1])
-        if tools.is_diagonal(self.code.Z):
-            self._is_diagonal = True
-            z = np.expand_dims(np.diagonal(self.code.Z), axis=0).T
-
-            def my_eye(n):
-                return np.ones((np.asarray(self.code.d ** self.code.n) ** n, 1))
+            self.dimension = self._d ** self.N
+        self._stored_diagonal = None
+        self._left_acting_hamiltonian = None
+        self._right_acting_hamiltonian = None
+        if not store_diagonal:
+            assert self._is_diagonal
+            self._hamiltonian = None
+            self._optimum = None
+            return
+        if self._is_diagonal:
+            c = np.zeros((self.dimension, 1), dtype=self._diagonal_dtype)
+            for chunk in contraction.chunks(self.dimension):
+                c[chunk] = self._diagonal_chunk(chunk)
+            self._stored_diagonal = c
+            self._optimum = real_dtype()(np.max(c))
+            c = sparse.csr_matrix((_as_precision(c.flatten()), np.arange(self.dimension),
+                                   np.arange(self.dimension + 1)), shape=(self.dimension, self.dimension))
         else:
-            self._is_diagonal = False
-            # Compute the optimum first. We don't care that this takes extra time, since it only needs to run once
-            z = np.expand_dims(np.diagonal(qubit.Z), axis=0).T
+            self._optimum = real_dtype()(max(np.max(self._diagonal_chunk(chunk)) for chunk in
+                                             contraction.chunks(self.dimension)))
+            if not use_Z2_symmetry:
+                # Assemble all edge terms as a sparse matrix in one pass
+                zz = np.kron(self.code.Z, self.code.Z)
+                terms = []
+                for a, b in self.graph.edges:
+                    if cost_function:
+                        terms += [((a, b), zz, -1 / 2 * G.graph[a][b]['weight']),
+                                  ((), np.ones((1, 1)), 1 / 2 * G.graph[a][b]['weight'])]
+                    else:
+                        terms.append(((a, b), zz, G.graph[a][b]['weight']))
+                c = tools.local_operator(terms, self.N, d=self.code.d ** self.code.n)
+            else:
+                c = sparse.csr_matrix((self.code.d ** (self.code.n * self.N), self.code.d ** (self.code.n * self.N)))
+                z = sparse.csr_matrix(self.code.Z)
 
-            def my_eye(n):
-                return np.ones((np.asarray(qubit.d) ** n, 1))
+                def my_eye(n):
+                    return sparse.csr_matrix(np.ones(np.asarray(z.shape[0]) ** n),
+                                             (np.asarray(z.shape[0]) ** n, np.asarray(z.shape[0]) ** n))
 
-            for a, b in self.graph.edges:
-                if b < a:
-                    a, b = b, a
-                if use_Z2_symmetry:
+                for a, b in self.graph.edges:
+                    if b < a:
+                        a, b = b, a
                     if cost_function:
                         if a == min(self.graph.nodes):
                             c = c - 1 / 2 * G.graph[a][b]['weight'] * (tools.tensor_product(
-                                [my_eye(b-1), z, my_eye(self.N - b - 1)]) - my_eye(self.N-1))
+                                [my_eye(b - 1), z, my_eye(self.N - b - 1)]) - my_eye(self.N - 1))
                         else:
                             c = c - 1 / 2 * G.graph[a][b]['weight'] * (tools.tensor_product(
-                                [my_eye(a-1), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)]) - my_eye(self.N-1))
+                                [my_eye(a - 1), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)]) - my_eye(self.N - 1))
                     else:
                         if a == min(self.graph.nodes):
                             c = c + G.graph[a][b]['weight'] * (tools.tensor_product(
@@ -352,74 +452,14 @@ class HamiltonianMaxCut(object):
                         else:
                             c = c + G.graph[a][b]['weight'] * (tools.tensor_product(
                                 [my_eye(a - 1), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)]))
-                else:
-                    if cost_function:
-                        c = c - 1 / 2 * G.graph[a][b]['weight'] * (tools.tensor_product(
-                            [my_eye(a), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)]) - my_eye(self.N))
-                    else:
-                        c = c + G.graph[a][b]['weight'] * tools.tensor_product(
-                            [my_eye(a), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)])
-            self._optimum = np.max(c).real
-            c = sparse.csr_matrix((self.code.d ** (self.code.n * self.N), self.code.d ** (self.code.n * self.N)))
-
-            z = sparse.csr_matrix(self.code.Z)
-
-            def my_eye(n):
-                return sparse.csr_matrix(np.ones(np.asarray(z.shape[0]) ** n),
-                                         (np.asarray(z.shape[0]) ** n, np.asarray(z.shape[0]) ** n))
-
-        for a, b in self.graph.edges:
-            if b < a:
-                a, b = b, a
-
-            if cost_function:
-                if use_Z2_symmetry:
-                    if a == min(self.graph.nodes):
-                        c = c - 1 / 2 * G.graph[a][b]['weight'] * (tools.tensor_product(
-                            [my_eye(b - 1), z, my_eye(self.N - b - 1)]) - my_eye(self.N - 1))
-                    else:
-                        c = c - 1 / 2 * G.graph[a][b]['weight'] * (tools.tensor_product(
-                            [my_eye(a - 1), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)]) - my_eye(self.N - 1))
-                else:
-                    c = c - 1 / 2 * G.graph[a][b]['weight'] * (tools.tensor_product(
-                        [my_eye(a), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)],
-                        sparse=(not self._is_diagonal)) - my_eye(
-                        self.N))
-            else:
-                if use_Z2_symmetry:
-                    if a == min(self.graph.nodes):
-                        c = c + G.graph[a][b]['weight'] * (tools.tensor_product(
-                            [my_eye(b - 1), z, my_eye(self.N - b - 1)]))
-                    else:
-                        c = c + G.graph[a][b]['weight'] * (tools.tensor_product(
-                            [my_eye(a - 1), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)]))
-
-                else:
-                    c = c + G.graph[a][b]['weight'] * (tools.tensor_product(
-                        [my_eye(a), z, my_eye(b - a - 1), z, my_eye(self.N - b - 1)],
-                        sparse=(not self._is_diagonal)))
-        if self._is_diagonal:
-            self._diagonal_hamiltonian = c
-            self._optimum = np.max(c).real
-            if use_Z2_symmetry:
-                c = sparse.csr_matrix((c.flatten(), (np.arange(self.code.d ** (self.code.n * (self.N-1))),
-                                                     np.arange(self.code.d ** (self.code.n * (self.N-1))))),
-                                      shape=(self.code.d ** (self.code.n * (self.N-1)),
-                                             self.code.d ** (self.code.n * (self.N-1))))
-            else:
-                c = sparse.csr_matrix((c.flatten(), (np.arange(self.code.d ** (self.code.n * self.N)),
-                                                 np.arange(self.code.d ** (self.code.n * self.N)))),
-                                  shape=(self.code.d ** (self.code.n * self.N),
-                                         self.code.d ** (self.code.n * self.N)))
-        else:
             # c is already the right shape, just convert it to a csc matrix
             c = sparse.csc_matrix(c)
         self._hamiltonian = c
-        self._left_acting_hamiltonian = None
-        self._right_acting_hamiltonian = None
 
     @property
     def hamiltonian(self):
+        if self._hamiltonian is None:
+            raise Exception('The Hamiltonian is not stored as a matrix when store_diagonal is False.')
         return self.energies[0] * self._hamiltonian
 
     @property
@@ -427,6 +467,8 @@ class HamiltonianMaxCut(object):
         if vector_space != 'hilbert' and vector_space != 'liouville':
             raise Exception('Attribute vector_space must be hilbert or liouville')
         if vector_space == 'liouville':
+            if self._hamiltonian is None:
+                raise Exception('The Hamiltonian is not stored as a matrix when store_diagonal is False.')
             if self._left_acting_hamiltonian is None:
                 self._left_acting_hamiltonian = sparse.kron(sparse.identity(self._hamiltonian.shape[0]),
                                                             self._hamiltonian)
@@ -442,16 +484,33 @@ class HamiltonianMaxCut(object):
     def optimum(self):
         # Optimum for non-diagonal Hamiltonians can be found by computing the optimum in the standard basis,
         # which is done in self.__init__()
+        if self._optimum is None:
+            self._optimum = real_dtype()(max(np.max(self._diagonal_chunk(chunk)) for chunk in
+                                             contraction.chunks(self.dimension)))
         return self.energies[0] * self._optimum
 
+    @property
+    def _diagonal_hamiltonian(self):
+        if self._stored_diagonal is None:
+            return self._diagonal_chunk(slice(0, self.dimension))
+        return self._stored_diagonal
+
+    def _diagonal_chunk(self, chunk: slice):
+        """Returns the entries ``chunk`` of the diagonal of the Hamiltonian as a column."""
+        if self._stored_diagonal is not None:
+            return self._stored_diagonal[chunk]
+        return _local_diagonal(self._diagonal_terms, self.N, self._d, chunk, self._diagonal_dtype)
+
     def evolve(self, state: State, time):
         if state.is_ket:
-            if self._is_diagonal:
+            if self._is_diagonal and (state.is_memmap or self._stored_diagonal is None):
+                return _chunked_diagonal_evolve(self, state, time)
+            elif self._is_diagonal:
                 # It's quicker to exponentiate a diagonal array than use expm_multiply
                 return State(np.exp(-1j * time * self._diagonal_hamiltonian) * state, is_ket=state.is_ket,
                              IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
             else:
-                return State(expm_multiply(-1j * time * self.hamiltonian, state), is_ket=state.is_ket,
+                return State(_expm_multiply(self.hamiltonian, state, time), is_ket=state.is_ket,
                              IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
         else:
             if self._is_diagonal:
@@ -459,9 +518,9 @@ class HamiltonianMaxCut(object):
                     1j * time * self._diagonal_hamiltonian).T, is_ket=state.is_ket, IS_subspace=state.IS_subspace,
                              code=state.code, graph=self.graph)
             else:
-                temp = expm(-1j * time * self.hamiltonian)
-                return State(temp @ state @ temp.conj().T, is_ket=state.is_ket, IS_subspace=state.IS_subspace,
-                             code=state.code, graph=self.graph)
+                return State(tools.evolve_density_matrix(self.hamiltonian, state, time, cache=self._propagators,
+                                                         key=tuple(self.energies)),
+                             is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
 
     def left_multiply(self, state: State):
         if self._is_diagonal:
@@ -493,10 +552,12 @@ class HamiltonianMaxCut(object):
         # Need to project into the IS subspace
         # Returns <s|C|s>
         if state.is_ket:
-            if self._is_diagonal:
-                return np.real(np.vdot(state, self._diagonal_hamiltonian * state))
+            if self._is_diagonal and (state.is_memmap or self._stored_diagonal is None):
+                return _chunked_diagonal_expectation(self, state)
+            elif self._is_diagonal:
+                return _ket_expectation(state, self._diagonal_hamiltonian * state)
             else:
-                return np.real(np.vdot(state, self.hamiltonian @ state))
+                return _ket_expectation(state, self.hamiltonian @ state)
         else:
             # Density matrix
             if self._is_diagonal:
@@ -516,7 +577,7 @@ class HamiltonianMaxCut(object):
             # which encode the optimum. Then, make an operator that's the identity in those subspaces
             raise NotImplementedError('Optimum overlap not implemented for non-diagonal Hamiltonians')
         if state.is_ket:
-            return np.real(np.vdot(state, optimum * state))
+            return _ket_expectation(state, optimum * state)
         else:
             # Density matrix
             return np.real(np.squeeze(tools.trace(optimum * state)))
@@ -527,9 +588,14 @@ class HamiltonianMaxCut(object):
 
 
 class HamiltonianMIS(object):
-    def __init__(self, G: Graph, energies=(1, 1), code=qubit, IS_subspace=False):
+    def __init__(self, G: Graph, energies=(1, 1), code=qubit, IS_subspace=False, store_diagonal=True):
         r"""
-        Generate a vector corresponding to the diagonal of the MIS Hamiltonian.
+        Generate a vector corresponding to the diagonal of the MIS Hamiltonian. In the full Hilbert space, the node
+        and edge terms of the diagonal are computed from the digits of the basis indices one chunk at a time, and
+        stored in the narrowest dtypes which hold them exactly. If ``store_diagonal`` is ``False``, they are instead
+        recomputed one chunk at a time whenever they are needed, so that :py:meth:`evolve`, :py:meth:`cost_function`
+        and :py:attr:`optimum` never hold them in memory; this is only supported for codes with a diagonal Q
+        operator, and the Hamiltonian is then not available as a matrix.
         """
         if energies == (1, 1) and IS_subspace:
             energies = (1,)
@@ -537,6 +603,7 @@ class HamiltonianMIS(object):
         self.graph = G
         self.N = self.graph.n
         self.energies = energies
+        self._propagators = {}
         self.IS_subspace = IS_subspace
         self.optimization = 'max'
         if not self.IS_subspace:
@@ -544,15 +611,41 @@ class HamiltonianMIS(object):
             # are changed
 
             if tools.is_diagonal(self.code.Q):
-                self._hamiltonian_edge_terms = np.zeros([1, (self.code.d ** self.code.n) ** self.N])
-                self._hamiltonian_node_terms = np.zeros([1, (self.code.d ** self.code.n) ** self.N])
                 self._is_diagonal = True
-
-                Q = np.expand_dims(np.diagonal(self.code.Q), axis=0)
-
-                def my_eye(n):
-                    return np.ones(np.asarray(self.code.d ** self.code.n) ** n)
+                self._d = self.code.d ** self.code.n
+                q = _diagonal_table(self.code.Q)
+                self._node_terms = [((i,), q, G.graph.nodes[i]['weight']) for i in G.graph.nodes]
+                self._edge_terms = [((i, j), np.outer(q, q), G.graph.edges[(i, j)]['weight']) for i, j in
+                                    G.graph.edges]
+                dimension = self._d ** self.N
+                self.dimension = dimension
+                if store_diagonal:
+                    # Compute both diagonals from the digits of the basis indices, one chunk at a time
+                    node_terms = np.zeros((dimension, 1), dtype=_exact_dtype(self._node_terms))
+                    edge_terms = np.zeros((dimension, 1), dtype=_exact_dtype(self._edge_terms))
+                    for chunk in contraction.chunks(dimension):
+                        node_terms[chunk] = _local_diagonal(self._node_terms, self.N, self._d, chunk,
+                                                            node_terms.dtype)
+                        edge_terms[chunk] = _local_diagonal(self._edge_terms, self.N, self._d, chunk,
+                                                            edge_terms.dtype)
+                    self._optimum_node_terms = node_terms
+                    self._optimum_edge_terms = edge_terms
+                    self._diagonal_hamiltonian_node_terms = node_terms
+                    self._diagonal_hamiltonian_edge_terms = edge_terms
+                    self._hamiltonian_node_terms = sparse.csr_matrix(
+                        (_as_precision(node_terms.flatten()), np.arange(dimension), np.arange(dimension + 1)),
+                        shape=(dimension, dimension))
+                    self._hamiltonian_edge_terms = sparse.csr_matrix(
+                        (_as_precision(edge_terms.flatten()), np.arange(dimension), np.arange(dimension + 1)),
+                        shape=(dimension, dimension))
+                else:
+                    self._diagonal_hamiltonian_node_terms = None
+                    self._diagonal_hamiltonian_edge_terms = None
+                    self._hamiltonian_node_terms = None
+                    self._hamiltonian_edge_terms = None
             else:
+                assert store_diagonal
+                self.dimension = (self.code.d ** self.code.n) ** self.N
                 # TODO: generate a sparse matrix instead
                 self._hamiltonian_edge_terms = np.zeros([(self.code.d ** self.code.n) ** self.N,
                                                          (self.code.d ** self.code.n) ** self.N])
@@ -585,34 +678,17 @@ class HamiltonianMIS(object):
 
                 def my_eye(n):
                     return np.identity(np.asarray(self.code.d ** self.code.n) ** n)
-            for i, j in G.graph.edges:
-                if j < i:
-                    i, j = j, i
-                self._hamiltonian_edge_terms = self._hamiltonian_edge_terms + G.graph.edges[(i, j)]['weight'] * \
-                                               tools.tensor_product(
-                                                   [my_eye(i), Q, my_eye(j - i - 1), Q, my_eye(self.N - j - 1)])
-            for i in G.graph.nodes:
-                self._hamiltonian_node_terms = self._hamiltonian_node_terms + G.graph.nodes[i]['weight'] * \
-                                               tools.tensor_product([my_eye(i), Q, my_eye(self.N - i - 1)])
-            self._hamiltonian_node_terms = self._hamiltonian_node_terms.T
-            self._hamiltonian_edge_terms = self._hamiltonian_edge_terms.T
-            if self._is_diagonal:
-                self._optimum_edge_terms = self._hamiltonian_edge_terms
-                self._optimum_node_terms = self._hamiltonian_node_terms
-                self._diagonal_hamiltonian_edge_terms = self._hamiltonian_edge_terms.copy()
-                self._diagonal_hamiltonian_node_terms = self._hamiltonian_node_terms.copy()
-                self._hamiltonian_node_terms = sparse.csr_matrix(
-                    (self._hamiltonian_node_terms.flatten(), (np.arange(self.code.d ** (self.code.n * self.N)),
-                                                              np.arange(self.code.d ** (self.code.n * self.N)))),
-                    shape=(self.code.d ** (self.code.n * self.N),
-                           self.code.d ** (self.code.n * self.N)))
-                self._hamiltonian_edge_terms = sparse.csr_matrix(
-                    (self._hamiltonian_edge_terms.flatten(), (np.arange(self.code.d ** (self.code.n * self.N)),
-                                                              np.arange(self.code.d ** (self.code.n * self.N)))),
-                    shape=(self.code.d ** (self.code.n * self.N),
-                           self.code.d ** (self.code.n * self.N)))
-                # TODO: what happens to _optimum_node_terms if not _is_diagonal
-            else:
+                for i, j in G.graph.edges:
+                    if j < i:
+                        i, j = j, i
+                    self._hamiltonian_edge_terms = self._hamiltonian_edge_terms + G.graph.edges[(i, j)]['weight'] * \
+                                                   tools.tensor_product(
+                                                       [my_eye(i), Q, my_eye(j - i - 1), Q, my_eye(self.N - j - 1)])
+                for i in G.graph.nodes:
+                    self._hamiltonian_node_terms = self._hamiltonian_node_terms + G.graph.nodes[i]['weight'] * \
+                                                   tools.tensor_product([my_eye(i), Q, my_eye(self.N - i - 1)])
+                self._hamiltonian_node_terms = _as_precision(self._hamiltonian_node_terms.T)
+                self._hamiltonian_edge_terms = _as_precision(self._hamiltonian_edge_terms.T)
                 self._diagonal_hamiltonian_edge_terms = self._hamiltonian_edge_terms.copy()
                 self._diagonal_hamiltonian_node_terms = self._hamiltonian_node_terms.copy()
                 self._hamiltonian_edge_terms = sparse.csr_matrix(self._hamiltonian_edge_terms)
@@ -626,24 +702,12 @@ class HamiltonianMIS(object):
                 raise NotImplementedError("IS subspace only implemented for qubit and Rydberg codes.")
             # Don't generate anything that depends on the entire Hilbert space as to save space
 
-            # These are your independent sets of the original graphs, ordered by node and size
-            if self.code == qubit:
-                node_weights = np.asarray([self.graph.graph.nodes[i]['weight'] for i in range(self.graph.n)])
-                C = np.asarray([[np.sum((1 - self.graph.independent_sets[i][2]) * node_weights) for i in
-                                 self.graph.independent_sets]],
-                               dtype=np.complex128).T
-                self._hamiltonian_node_terms = C
-
-            # Otherwise, we need to include the possibility that we are in one of many ground space states
-            elif self.code == rydberg:
-                # Count the number of elements in the ground space and map to their representation in ternary
-                # Determine how large to make the array
-                independent_sets, nary_to_index, num_IS = self.graph.independent_sets_code(self.code)
-                # Generate Hamiltonian from independent sets
-                node_weights = np.asarray([self.graph.graph.nodes[i]['weight'] for i in range(self.graph.n)])
-                C = np.zeros((num_IS, 1), dtype=np.complex128)
-                for k in independent_sets:
-                    C[k, 0] = np.sum((independent_sets[k][2] == 0) * node_weights)
+            # These are your independent sets of the original graphs, ordered by node and size. In the rydberg code,
+            # nodes outside of the independent set may be in any of the ground states
+            _, nary = self.graph.independent_sets_array(self.code)
+            node_weights = np.asarray([self.graph.graph.nodes[i]['weight'] for i in range(self.graph.n)])
+            C = ((nary == 0) @ node_weights).astype(complex_dtype())[:, np.newaxis]
+            self.dimension = C.shape[0]
             self._diagonal_hamiltonian_node_terms = C
             C = C.flatten()
 
@@ -655,6 +719,8 @@ class HamiltonianMIS(object):
 
     @property
     def hamiltonian(self):
+        if self._hamiltonian_node_terms is None:
+            raise Exception('The Hamiltonian is not stored as a matrix when store_diagonal is False.')
         if not self.IS_subspace:
             return self.energies[0] * self._hamiltonian_node_terms - self.energies[1] * self._hamiltonian_edge_terms
         else:
@@ -665,6 +731,8 @@ class HamiltonianMIS(object):
         if vector_space != 'hilbert' and vector_space != 'liouville':
             raise Exception('Attribute vector_space must be hilbert or liouville')
         if vector_space == 'liouville':
+            if self._hamiltonian_node_terms is None:
+                raise Exception('The Hamiltonian is not stored as a matrix when store_diagonal is False.')
             if self._left_acting_hamiltonian_node_terms is None and not self.IS_subspace:
                 self._left_acting_hamiltonian_edge_terms = sparse.kron(sparse.identity(
                     self._hamiltonian_node_terms.shape[0]), self._hamiltonian_edge_terms)
@@ -692,9 +760,11 @@ class HamiltonianMIS(object):
 
     @property
     def _diagonal_hamiltonian(self):
+        if self._diagonal_hamiltonian_node_terms is None:
+            return self._diagonal_chunk(slice(0, self._d ** self.N))
         if not self.IS_subspace:
-            return self.energies[0] * self._diagonal_hamiltonian_node_terms - self.energies[
-                1] * self._diagonal_hamiltonian_edge_terms
+            return _scale(self.energies[0], self._diagonal_hamiltonian_node_terms) - _scale(
+                self.energies[1], self._diagonal_hamiltonian_edge_terms)
         else:
             return self.energies[0] * self._diagonal_hamiltonian_node_terms
 
@@ -702,18 +772,33 @@ class HamiltonianMIS(object):
     def optimum(self):
         # This needs to be recomputed because the optimum depends on the energies
         # TODO: figure out what to compute if not _is_diagonal
-        if self._is_diagonal:
+        if self._is_diagonal and self._diagonal_hamiltonian_node_terms is None:
+            return max(np.max(self._diagonal_chunk(chunk)) for chunk in contraction.chunks(self._d ** self.N)).real
+        elif self._is_diagonal:
             return np.max(self._diagonal_hamiltonian).real
         else:
             raise NotImplementedError('Optimum unknown for non-diagonal Hamiltonians')
 
+    def _diagonal_chunk(self, chunk: slice):
+        """Returns the entries ``chunk`` of the diagonal of the Hamiltonian as a column."""
+        if self._diagonal_hamiltonian_node_terms is None:
+            return _scale(self.energies[0], _local_diagonal(self._node_terms, self.N, self._d, chunk, real_dtype())) \
+                   - _scale(self.energies[1], _local_diagonal(self._edge_terms, self.N, self._d, chunk, real_dtype()))
+        if not self.IS_subspace:
+            return _scale(self.energies[0], self._diagonal_hamiltonian_node_terms[chunk]) - _scale(
+                self.energies[1], self._diagonal_hamiltonian_edge_terms[chunk])
+        else:
+            return self.energies[0] * self._diagonal_hamiltonian_node_terms[chunk]
+
     def evolve(self, state: State, time):
         if state.is_ket:
-            if self._is_diagonal:
+            if self._is_diagonal and (state.is_memmap or self._diagonal_hamiltonian_node_terms is None):
+                return _chunked_diagonal_evolve(self, state, time)
+            elif self._is_diagonal:
                 return State(np.exp(-1j * time * self._diagonal_hamiltonian) * state, is_ket=state.is_ket,
                              IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
             else:
-                return State(expm_multiply(-1j * time * self.hamiltonian, state), is_ket=state.is_ket,
+                return State(_expm_multiply(self.hamiltonian, state, time), is_ket=state.is_ket,
                              IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
         else:
             if self._is_diagonal:
@@ -721,9 +806,9 @@ class HamiltonianMIS(object):
                     1j * time * self._diagonal_hamiltonian).T, is_ket=state.is_ket, IS_subspace=state.IS_subspace,
                              code=state.code, graph=self.graph)
             else:
-                temp = expm(-1j * time * self.hamiltonian)
-                return State(temp @ state @ temp.conj().T, is_ket=state.is_ket, IS_subspace=state.IS_subspace,
-                             code=state.code, graph=self.graph)
+                return State(tools.evolve_density_matrix(self.hamiltonian, state, time, cache=self._propagators,
+                                                         key=tuple(self.energies)),
+                             is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
 
     def left_multiply(self, state: State):
         if self._is_diagonal:
@@ -754,10 +839,12 @@ class HamiltonianMIS(object):
     def cost_function(self, state: State):
         # Returns <s|C|s>
         if state.is_ket:
-            if self._is_diagonal:
-                return np.real(np.vdot(state, self._diagonal_hamiltonian * state))
+            if self._is_diagonal and (state.is_memmap or self._diagonal_hamiltonian_node_terms is None):
+                return _chunked_diagonal_expectation(self, state)
+            elif self._is_diagonal:
+                return _ket_expectation(state, self._diagonal_hamiltonian * state)
             else:
-                return np.real(np.vdot(state, self.hamiltonian @ state))
+                return _ket_expectation(state, self.hamiltonian @ state)
         else:
             # Density matrix
             if self._is_diagonal:
@@ -776,9 +863,9 @@ class HamiltonianMIS(object):
             raise NotImplementedError('Optimum overlap not implemented for non-diagonal Hamiltonians')
         if state.is_ket:
             if self._is_diagonal:
-                return np.real(np.vdot(state, optimum * state))
+                return _ket_expectation(state, optimum * state)
             else:
-                return np.real(np.vdot(state, self.hamiltonian @ state))
+                return _ket_expectation(state, self.hamiltonian @ state)
         else:
             # Density matrix
             if self._is_diagonal:
@@ -791,6 +878,169 @@ class HamiltonianMIS(object):
         return self.cost_function(state) / self.optimum
 
 
+class HamiltonianPauliSum(object):
+    def __init__(self, terms, N, energies=(1,), code=qubit):
+        r"""
+        Weighted sum of Pauli strings on :math:`N` qubits, :math:`E\sum_kc_kP_k`. Each string is stored by the
+        integer masks of the qubits it acts on with :math:`X` or :math:`Y` (the x-mask) and with :math:`Y` or
+        :math:`Z` (the z-mask), using :math:`Y=iXZ`. Strings with the same x-mask map the basis state
+        :math:`|j\rangle` to the same state :math:`|j\oplus x\rangle`, so each group of strings is applied to a
+        state by a single gather of the rows (or columns) and a multiplication by the summed phases of the group.
+
+        :param terms: Terms ``(sites, paulis, coefficient)`` of the sum, where ``paulis`` is a string of ``'X'``,
+            ``'Y'``, ``'Z'`` and ``'I'`` characters acting on the distinct qubits in ``sites``.
+        :type terms: list
+        :param N: Number of qubits.
+        :type N: int
+        :param energies: Energy :math:`E` multiplying the sum.
+        :type energies: tuple
+        :param code: Code of the qubits. Must be :py:mod:`qsim.codes.qubit`.
+        """
+        assert code is qubit
+        self.code = code
+        self.N = N
+        self.energies = energies
+        self._propagators = {}
+        self.IS_subspace = False
+        self.graph = None
+        x_masks = np.zeros(len(terms), dtype=np.int64)
+        z_masks = np.zeros(len(terms), dtype=np.int64)
+        coefficients = np.zeros(len(terms), dtype=np.complex128)
+        for (k, (sites, paulis, coefficient)) in enumerate(terms):
+            sites = np.atleast_1d(sites)
+            assert len(paulis) == len(sites) and len(set(sites)) == len(sites)
+            num_y = 0
+            for (pauli, site) in zip(paulis, sites):
+                # Qubit i is bit N - i - 1 of the index
+                weight = 1 << (self.N - 1 - int(site))
+                if pauli in 'XY':
+                    x_masks[k] ^= weight
+                if pauli in 'YZ':
+                    z_masks[k] ^= weight
+                num_y += pauli == 'Y'
+            coefficients[k] = 1j ** num_y * coefficient
+        if np.allclose(coefficients.imag, 0):
+            coefficients = coefficients.real
+        # Group the strings by x-mask, which are stored sorted
+        self.x_masks, groups = np.unique(x_masks, return_inverse=True)
+        order = np.argsort(groups, kind='stable')
+        self.z_masks = z_masks[order]
+        self.coefficients = coefficients[order]
+        self._group_bounds = np.concatenate([[0], np.cumsum(np.bincount(groups, minlength=self.x_masks.size))])
+        self._hamiltonian = None
+        self._hamiltonian_energies = None
+
+    @property
+    def dtype(self):
+        return np.result_type(self.coefficients, *self.energies, real_dtype())
+
+    def _phases(self, group, indices):
+        """Returns the entries :math:`\\langle j\\oplus x|H|j\\rangle/E` for the basis states :math:`j` in
+        ``indices``, where :math:`x` is the x-mask of ``group``."""
+        phases = np.zeros(indices.shape, dtype=self.dtype)
+        for k in range(self._group_bounds[group], self._group_bounds[group + 1]):
+            phases += self.coefficients[k] * (1 - 2 * tools.bit_parity(indices & self.z_masks[k], width=self.N))
+        return phases
+
+    def diagonal(self):
+        """Returns the diagonal of the Hamiltonian, as a one-dimensional array."""
+        indices = np.arange(2 ** self.N, dtype=np.int64)
+        if self.x_masks.size == 0 or self.x_masks[0] != 0:
+            return np.zeros(indices.size, dtype=self.dtype)
+        return self.energies[0] * self._phases(0, indices)
+
+    def tocsr(self):
+        """Returns the Hamiltonian as a CSR matrix."""
+        indices = np.arange(2 ** self.N, dtype=np.int64)
+        rows, columns, data = [], [], []
+        for (group, x_mask) in enumerate(self.x_masks):
+            # H[j ^ x, j] is the phase of j
+            rows.append(indices ^ x_mask)
+            columns.append(indices)
+            data.append(self.energies[0] * self._phases(group, indices))
+        if len(data) == 0:
+            return sparse.csr_matrix((indices.size, indices.size), dtype=self.dtype)
+        hamiltonian = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+                                        shape=(indices.size, indices.size)).tocsr()
+        hamiltonian.eliminate_zeros()
+        return hamiltonian
+
+    @property
+    def hamiltonian(self):
+        if self._hamiltonian is None or self._hamiltonian_energies != tuple(self.energies):
+            self._hamiltonian = self.tocsr()
+            self._hamiltonian_energies = tuple(self.energies)
+        return self._hamiltonian
+
+    def _left_product(self, state):
+        indices = np.arange(2 ** self.N, dtype=np.int64)
+        out = np.zeros(state.shape, dtype=np.result_type(state, self.dtype))
+        for (group, x_mask) in enumerate(self.x_masks):
+            # (H psi)[j] = H[j, j ^ x] psi[j ^ x], where H[j, j ^ x] is the phase of j ^ x
+            flipped = indices ^ x_mask
+            out += self._phases(group, flipped)[:, np.newaxis] * state[flipped]
+        return self.energies[0] * out
+
+    def _right_product(self, state):
+        indices = np.arange(2 ** self.N, dtype=np.int64)
+        out = np.zeros(state.shape, dtype=np.result_type(state, self.dtype))
+        for (group, x_mask) in enumerate(self.x_masks):
+            # (rho H)[:, j] = rho[:, j ^ x] H[j ^ x, j]
+            out += state[:, indices ^ x_mask] * self._phases(group, indices)[np.newaxis, :]
+        return self.energies[0] * out
+
+    def left_multiply(self, state: State):
+        return State(self._left_product(np.asarray(state)), is_ket=state.is_ket, IS_subspace=state.IS_subspace,
+                     code=state.code, graph=state.graph)
+
+    def right_multiply(self, state: State):
+        if state.is_ket:
+            return State(self._right_product(np.asarray(state).conj().T).conj().T, is_ket=state.is_ket,
+                         IS_subspace=state.IS_subspace, code=state.code, graph=state.graph)
+        return State(self._right_product(np.asarray(state)), is_ket=state.is_ket, IS_subspace=state.IS_subspace,
+                     code=state.code, graph=state.graph)
+
+    @property
+    def linear_operator(self):
+        """The Hamiltonian as a :py:class:`scipy.sparse.linalg.LinearOperator`, applied group by group without
+        storing the matrix."""
+        dimension = 2 ** self.N
+
+        def matmat(v):
+            return self._left_product(np.asarray(v).reshape(dimension, -1))
+
+        def rmatmat(v):
+            return self._right_product(np.asarray(v).reshape(dimension, -1).conj().T).conj().T
+
+        return LinearOperator((dimension, dimension), matvec=matmat, rmatvec=rmatmat, matmat=matmat,
+                              rmatmat=rmatmat, dtype=self.dtype)
+
+    def evolve(self, state: State, time, matrix_free=False):
+        """Evolves a state for a time ``time``. If ``matrix_free`` is ``True``, kets are evolved with
+        :py:attr:`linear_operator` instead of the stored Hamiltonian."""
+        if not state.is_ket:
+            return State(tools.evolve_density_matrix(self.hamiltonian, state, time, cache=self._propagators,
+                                                     key=tuple(self.energies)),
+                         is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=state.graph)
+        if matrix_free:
+            out = expm_multiply(-1j * time * self.linear_operator, np.asarray(state),
+                                traceA=-1j * time * np.sum(self.diagonal()))
+        else:
+            out = _expm_multiply(self.hamiltonian, state, time)
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=state.graph)
+
+    def cost_function(self, state: State):
+        if state.is_ket:
+            return _ket_expectation(state, self._left_product(np.asarray(state)))
+        indices = np.arange(2 ** self.N, dtype=np.int64)
+        # tr(H rho) is the sum over j of H[j, j ^ x] rho[j ^ x, j]
+        cost = 0
+        for (group, x_mask) in enumerate(self.x_masks):
+            flipped = indices ^ x_mask
+            cost += np.sum(self._phases(group, flipped) * np.asarray(state)[flipped, indices])
+        return np.real(self.energies[0] * cost)
+
+
 class HamiltonianGlobalPauli(object):
     def __init__(self, pauli: str = 'X', code=qubit):
         self.code = code
@@ -804,11 +1054,21 @@ class HamiltonianGlobalPauli(object):
         self.hamiltonian = None
 
     def evolve(self, state: State, alpha):
+        all_qubits = list(range(state.number_logical_qudits))
+        if self.code is qubit:
+            if self.hamiltonian is None or self.hamiltonian.N != state.number_logical_qudits:
+                self.hamiltonian = HamiltonianPauliSum([(all_qubits, self.pauli * len(all_qubits), 1)],
+                                                       len(all_qubits))
+            # The Pauli string squares to the identity, so exp(-i alpha P) = cos(alpha) - i sin(alpha) P
+            state = np.cos(alpha) * state - 1j * np.sin(alpha) * self.hamiltonian.left_multiply(state)
+            if not state.is_ket:
+                state = np.cos(alpha) * state + 1j * np.sin(alpha) * self.hamiltonian.right_multiply(state)
+            return state
         if self.hamiltonian is None:
             """Initialize the Hamiltonian only once, as it is costly."""
-            # TODO: make this a sparse matrix!
             self.hamiltonian = tools.tensor_product([self._operator] * state.number_logical_qudits)
-        return self.code.multiply(np.cos(alpha) * np.identity(state.dimension) - 1j * np.sin(alpha) * self.hamiltonian)
+        return self.code.multiply(state, all_qubits, np.cos(alpha) * np.identity(self.hamiltonian.shape[0]) -
+                                  1j * np.sin(alpha) * self.hamiltonian)
 
     def left_multiply(self, state: State):
         all_qubits = list(range(state.number_logical_qudits))
@@ -832,142 +1092,234 @@ class HamiltonianBookatzPenalty(object):
         return state
 
     def left_multiply(self, state: State):
-        out = np.zeros_like(state, dtype=np.complex128)
+        out = np.zeros_like(state, dtype=state.dtype)
         for i in range(state.number_logical_qudits):
-            out = out + self.code.left_multiply(state, [i], self.projector)
-        return State(self.energies[0] * out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
+            self.code.left_multiply(state, [i], self.projector, out=out, coefficient=self.energies[0])
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
                      graph=self.graph)
 
     def right_multiply(self, state: State):
-        out = np.zeros_like(state, dtype=np.complex128)
+        out = np.zeros_like(state, dtype=state.dtype)
         for i in range(state.number_logical_qudits):
-            out = out + self.code.right_multiply(state, [i], self.projector)
-        return State(self.energies[0] * out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
+            self.code.right_multiply(state, [i], self.projector, out=out, coefficient=self.energies[0])
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
                      graph=self.graph)
 
 
-class HamiltonianMarvianPenalty(object):
-    def __init__(self, Nx, Ny):
-        super().__init__()
+class HamiltonianMarvianPenalty(HamiltonianPauliSum):
+    def __init__(self, Nx, Ny, energies=(1,)):
+        """Gauge penalty Hamiltonian of a lattice of :math:`N_x\\times N_y` logical qubits of three physical qubits
+        each, as a :py:class:`HamiltonianPauliSum`."""
         self.Nx = Nx
         self.Ny = Ny
-        self.N = 3 * Nx * Ny
-        # Generate Hamiltonian
-        # Two by two geometry (can be generalized in the future)
-        hp = np.zeros([2 ** self.N, 2 ** self.N])
-        for i in range(int(self.Nx * self.Ny)):
+        terms = []
+        for i in range(int(Nx * Ny)):
             # Add gauge interactions within a single logical qubit
-            hp = hp + tools.tensor_product(
-                [tools.identity(i * 3), tools.Z(), tools.Z(),
-                 tools.identity(self.N - i * 3 - 2)]) + tools.tensor_product(
-                [tools.identity(i * 3 + 1), tools.X(), tools.X(), tools.identity(self.N - i * 3 - 3)])
-        # Between rows
-        for j in range(self.Ny):
+            terms += [((i * 3, i * 3 + 1), 'ZZ', -1), ((i * 3 + 1, i * 3 + 2), 'XX', -1)]
+        # Two by two geometry (can be generalized in the future)
+        for j in range(Ny):
             # j is the number of rows
-            for k in range(self.Nx):
+            for k in range(Nx):
                 # k is the number of columns
+                first = j * Nx * 3 + k * 3
                 # Need to deal with edge effects
-                # Add gauge interactions within a single logical qubit
-                if k != self.Nx - 1:
+                if k != Nx - 1:
                     # Along the same row
-                    hp = hp + tools.tensor_product(
-                        [tools.identity(j * self.Nx * 3 + k * 3), tools.X(), tools.identity(2), tools.X(),
-                         tools.identity(self.N - (j * self.Nx * 3 + k * 3) - 4)]) + \
-                         tools.tensor_product(
-                             [tools.identity(j * self.Nx * 3 + k * 3 + 2), tools.Z(), tools.identity(2), tools.Z(),
-                              tools.identity(self.N - (j * self.Nx * 3 + k * 3 + 2) - 4)])
+                    terms += [((first, first + 3), 'XX', -1), ((first + 2, first + 5), 'ZZ', -1)]
+                if j != Ny - 1:
                     # Along the same column
-                if j != self.Ny - 1:
-                    hp = hp + tools.tensor_product(
-                        [tools.identity(j * self.Nx * 3 + k * 3), tools.X(), tools.identity(3 * self.Nx - 1),
-                         tools.X(),
-                         tools.identity(self.N - (j * self.Nx * 3 + k * 3) - 3 * self.Nx - 1)]) + \
-                         tools.tensor_product(
-                             [tools.identity(j * self.Nx * 3 + k * 3 + 2), tools.Z(),
-                              tools.identity(3 * self.Nx - 1),
-                              tools.Z(), tools.identity(self.N - (j * self.Nx * 3 + k * 3 + 2) - 3 * self.Nx - 1)])
-        self.hamiltonian = -1 * hp
+                    terms += [((first, first + 3 * Nx), 'XX', -1), ((first + 2, first + 2 + 3 * Nx), 'ZZ', -1)]
+        super().__init__(terms, 3 * Nx * Ny, energies=energies)
+
+
+def _excitation_sector(n, excitations):
+    """Returns the sorted indices of the :math:`n` qubit basis states with ``excitations`` qubits in the excited state
+    :math:`|0\\rangle`."""
+    # sectors[k] holds the states of the last i qubits with k excitations
+    sectors = [np.zeros(1, dtype=np.int64)] + [np.zeros(0, dtype=np.int64)] * excitations
+    for i in range(n):
+        # Prepend a qubit, which is excited in the first (smaller) half of the new states
+        sectors = [np.concatenate([sectors[k - 1] if k > 0 else np.zeros(0, dtype=np.int64), sectors[k] + 2 ** i])
+                   for k in range(excitations + 1)]
+    return sectors[excitations]
 
 
 class HamiltonianHeisenberg(object):
-    def __init__(self, G: nx.Graph, energies=(1, 1, 0), code=qubit):
+    def __init__(self, G: Graph, energies=(1, 1, 0), code=qubit, excitations=None):
+        r"""
+        Heisenberg Hamiltonian :math:`\sum_{(i,j)}J_xX_iX_j+J_yY_iY_j+J_QQ_iQ_j` on the edges of a graph, where
+        :math:`Q` projects onto the excited state and the energies are :math:`(J_x, J_y, J_Q)`. For qubits, the
+        Hamiltonian is assembled directly in CSR format from the bit flips generated by each edge. It is cached, and
+        only rebuilt when the energies change. :py:attr:`linear_operator` applies it without storing it.
+
+        :param G: Graph whose edges carry the interactions.
+        :type G: Graph
+        :param energies: Energies :math:`(J_x, J_y, J_Q)`.
+        :type energies: tuple
+        :param code: Code of the qudits.
+        :param excitations: If given, restricts the Hamiltonian to the basis states :py:attr:`basis` with this many
+            qubits in the excited state, which the Hamiltonian conserves when :math:`J_x=J_y`. States passed in must
+            then be in this basis. Only supported for qubits.
+        :type excitations: int
+        """
         self.code = code
         self.graph = G
-        self.N = self.graph.number_of_nodes()
+        self.N = self.graph.n
         self.energies = energies
-        self.hamiltonian = None
-        self.IS_projector = IS_projector(self.graph, self.code)
+        self._propagators = {}
+        self.excitations = excitations
+        if excitations is not None:
+            assert code is qubit
+            self.basis = _excitation_sector(self.N, excitations)
+            self.dimension = self.basis.size
+        else:
+            self.basis = None
+            self.dimension = (self.code.d ** self.code.n) ** self.N
+        self._hamiltonian = None
+        self._hamiltonian_energies = None
+        self._IS_projector = None
+
+    def _check_energies(self):
+        if self.excitations is not None and not np.isclose(self.energies[0], self.energies[1]):
+            raise Exception('The number of excitations is only conserved if energies[0] == energies[1].')
+
+    def _edge_maps(self):
+        """Yields, for each edge and every basis state, whether both nodes are excited, and the column and value of
+        the entry of the :math:`XX` plus :math:`YY` term in the row of that state."""
+        indices = np.arange(self.dimension, dtype=np.int64) if self.basis is None else self.basis
+        for (i, j) in self.graph.edges:
+            # Qubit i is bit N - i - 1 of the index, and is excited if the bit is zero
+            bit_i = (indices >> (self.N - i - 1)) & 1
+            bit_j = (indices >> (self.N - j - 1)) & 1
+            columns = indices ^ ((1 << (self.N - i - 1)) | (1 << (self.N - j - 1)))
+            # XX and YY agree on the flip-flop terms, and cancel on the terms flipping both qubits up or down
+            values = np.where(bit_i != bit_j, self.energies[0] + self.energies[1], self.energies[0] - self.energies[1])
+            if self.basis is not None:
+                columns = np.searchsorted(self.basis, columns)
+                columns[columns == self.dimension] = 0
+                values = np.where(self.basis[columns] == indices ^ ((1 << (self.N - i - 1)) |
+                                                                     (1 << (self.N - j - 1))), values, 0)
+            yield (bit_i | bit_j) == 0, columns, values
+
+    def _diagonal(self):
+        """Returns the diagonal of the :math:`QQ` terms, for qubits."""
+        diagonal = np.zeros(self.dimension, dtype=np.result_type(self.energies[2], real_dtype()))
+        if self.energies[2] != 0:
+            for (both_excited, _, _) in self._edge_maps():
+                diagonal += self.energies[2] * both_excited
+        return diagonal
+
+    @property
+    def hamiltonian(self):
+        self._check_energies()
+        if self._hamiltonian is None or self._hamiltonian_energies != tuple(self.energies):
+            if self.code is qubit:
+                # Each row has one diagonal entry and one entry per edge, and no two of them share a column
+                rows = [np.arange(self.dimension)]
+                columns = [np.arange(self.dimension)]
+                data = [self._diagonal()]
+                for (_, edge_columns, values) in self._edge_maps():
+                    nonzero = np.nonzero(values)[0]
+                    rows.append(nonzero)
+                    columns.append(edge_columns[nonzero])
+                    data.append(values[nonzero])
+                hamiltonian = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))),
+                                                shape=(self.dimension, self.dimension)).tocsr()
+                hamiltonian.eliminate_zeros()
+            else:
+                terms = []
+                for (i, j) in self.graph.edges:
+                    terms += [((i, j), np.kron(self.code.X, self.code.X), self.energies[0]),
+                              ((i, j), np.kron(self.code.Y, self.code.Y), self.energies[1]),
+                              ((i, j), np.kron(self.code.Q, self.code.Q), self.energies[2])]
+                hamiltonian = tools.local_operator(terms, self.N, d=self.code.d ** self.code.n)
+            self._hamiltonian = hamiltonian
+            self._hamiltonian_energies = tuple(self.energies)
+        return self._hamiltonian
+
+    @property
+    def linear_operator(self):
+        """The Hamiltonian as a :py:class:`scipy.sparse.linalg.LinearOperator`, which recomputes the bit flips of
+        each edge on every product instead of storing the matrix."""
+        self._check_energies()
+        if self.code is not qubit:
+            return aslinearoperator(self.hamiltonian)
+        energies = tuple(self.energies)
+        dtype = np.result_type(*energies, real_dtype())
+
+        def matmat(v):
+            v = np.asarray(v).reshape(self.dimension, -1)
+            out = self._diagonal()[:, np.newaxis] * v
+            for (_, columns, values) in self._edge_maps():
+                out = out + values[:, np.newaxis] * v[columns]
+            return out
+
+        def rmatmat(v):
+            return matmat(np.asarray(v).conj()).conj()
+
+        return LinearOperator((self.dimension, self.dimension), matvec=matmat, rmatvec=rmatmat, matmat=matmat,
+                              rmatmat=rmatmat, dtype=dtype)
 
     def left_multiply(self, state: State):
-        temp = np.zeros(state.shape, dtype=np.complex128)
+        if self.basis is not None:
+            return State(self.hamiltonian @ state, is_ket=state.is_ket, IS_subspace=state.IS_subspace,
+                         code=state.code, graph=self.graph)
+        temp = np.zeros(state.shape, dtype=state.dtype)
         for edge in self.graph.edges:
             if self.energies[0] != 0:
-                term = self.code.left_multiply(state, [edge[0], edge[1]], ['X', 'X'])
-                temp = temp + self.energies[0] * term
+                self.code.left_multiply(state, [edge[0], edge[1]], ['X', 'X'], out=temp,
+                                        coefficient=self.energies[0])
             if self.energies[1] != 0:
-                term = self.code.left_multiply(state, [edge[0], edge[1]], ['Y', 'Y'])
-                temp = temp + self.energies[1] * term
+                self.code.left_multiply(state, [edge[0], edge[1]], ['Y', 'Y'], out=temp,
+                                        coefficient=self.energies[1])
             if self.energies[2] != 0:
-                term = self.code.left_multiply(state, [edge[0], edge[1]],
-                                               tools.tensor_product([self.code.U, self.code.U]))
-                temp = temp + self.energies[2] * term
+                self.code.left_multiply(state, [edge[0], edge[1]], tools.tensor_product([self.code.Q, self.code.Q]),
+                                        out=temp, coefficient=self.energies[2])
         return State(temp, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
 
     def right_multiply(self, state: State):
-        temp = np.zeros(state.shape, dtype=np.complex128)
+        if self.basis is not None:
+            return State((self.hamiltonian.T @ state.T).T, is_ket=state.is_ket, IS_subspace=state.IS_subspace,
+                         code=state.code, graph=self.graph)
+        temp = np.zeros(state.shape, dtype=state.dtype)
         for edge in self.graph.edges:
             if self.energies[0] != 0:
-                term = self.code.right_multiply(state, [edge[0], edge[1]], ['X', 'X'])
-                temp = temp + self.energies[0] * term
+                self.code.right_multiply(state, [edge[0], edge[1]], ['X', 'X'], out=temp,
+                                         coefficient=self.energies[0])
             if self.energies[1] != 0:
-                term = self.code.right_multiply(state, [edge[0], edge[1]], ['Y', 'Y'])
-                temp = temp + self.energies[2] * term
+                self.code.right_multiply(state, [edge[0], edge[1]], ['Y', 'Y'], out=temp,
+                                         coefficient=self.energies[1])
             if self.energies[2] != 0:
-                term = self.code.right_multiply(state, [edge[0], edge[1]],
-                                                tools.tensor_product([self.code.U, self.code.U]))
-                temp = temp + self.energies[2] * term
+                self.code.right_multiply(state, [edge[0], edge[1]], tools.tensor_product([self.code.Q, self.code.Q]),
+                                         out=temp, coefficient=self.energies[2])
         return State(temp, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
 
-    def evolve(self, state: State, time):
-        if self.hamiltonian is None:
-            """Initialize the Hamiltonian."""
-            # TODO: Don't generate the whole matrix then convert to a sparse matrix!
-            hamiltonian = np.zeros((state.shape[0], state.shape[0]))
-            for (i, j) in self.graph.edges:
-                hamiltonian = hamiltonian + self.energies[0] * \
-                              tools.tensor_product([tools.identity(self.code.n * i, d=self.code.d), self.code.X,
-                                                    tools.identity(self.code.n * (j - i - 1), d=self.code.d),
-                                                    self.code.X,
-                                                    tools.identity(self.code.n * (self.N - j - 1), d=self.code.d)])
-                hamiltonian = hamiltonian + self.energies[1] * \
-                              tools.tensor_product([tools.identity(self.code.n * i, d=self.code.d), self.code.Y,
-                                                    tools.identity(self.code.n * (j - i - 1), d=self.code.d),
-                                                    self.code.Y,
-                                                    tools.identity(self.code.n * (self.N - j - 1), d=self.code.d)])
-                hamiltonian = hamiltonian + self.energies[2] * \
-                              tools.tensor_product([tools.identity(self.code.n * i, d=self.code.d), self.code.U,
-                                                    tools.identity(self.code.n * (j - i - 1), d=self.code.d),
-                                                    self.code.U,
-                                                    tools.identity(self.code.n * (self.N - j - 1), d=self.code.d)])
-            hamiltonian = sparse.csc_matrix(hamiltonian)
-            self.hamiltonian = hamiltonian
-
+    def evolve(self, state: State, time, matrix_free=False):
+        """Evolves a state for a time ``time``. If ``matrix_free`` is ``True``, kets are evolved with
+        :py:attr:`linear_operator` instead of the stored Hamiltonian."""
         if not state.is_ket:
-            exp_hamiltonian = expm(-1j * time * self.hamiltonian)
-            return State(exp_hamiltonian @ state @ exp_hamiltonian.conj().T,
+            return State(tools.evolve_density_matrix(self.hamiltonian, state, time, cache=self._propagators,
+                                                     key=tuple(self.energies)),
                          is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
-        if state.is_ket:
-            return State(expm_multiply(-1j * time * self.hamiltonian, state), is_ket=state.is_ket,
-                         IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
+        if matrix_free and self.code is qubit:
+            out = expm_multiply(-1j * time * self.linear_operator, np.asarray(state),
+                                traceA=-1j * time * np.sum(self._diagonal()))
+        else:
+            out = _expm_multiply(self.hamiltonian, state, time)
+        return State(out, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
 
     def cost_function(self, state: State):
         # Need to project into the IS subspace
         # Returns <s|C|s>
+        if self._IS_projector is None:
+            self._IS_projector = IS_projector(self.graph, self.code)
+            if self.basis is not None:
+                self._IS_projector = self._IS_projector[self.basis]
         if state.is_ket:
-            return np.real(np.vdot(state, self.IS_projector * self.hamiltonian * state))
+            return np.real(np.vdot(state, self._IS_projector * (self.hamiltonian @ state)))
         else:
             # Density matrix
-            return np.real(np.squeeze(tools.trace(self.IS_projector * self.hamiltonian * state)))
+            return np.real(np.squeeze(tools.trace(self._IS_projector * (self.hamiltonian @ state))))
 
 
 class HamiltonianEnergyShift(object):
@@ -994,15 +1346,9 @@ class HamiltonianEnergyShift(object):
             # Generate sparse mixing Hamiltonian
             assert graph is not None
             assert isinstance(graph, Graph)
-            if code is not qubit:
-                IS, nary_to_index, num_IS = graph.independent_sets_code(self.code)
-            else:
-                # We have already solved for this information
-                IS, nary_to_index, num_IS = graph.independent_sets, graph.binary_to_index, graph.num_independent_sets
-            self._diagonal_hamiltonian = np.zeros((num_IS, 1), dtype=np.complex128)
-            for k in IS:
-                self._diagonal_hamiltonian[k, 0] = np.sum(IS[k][2] == self.index)
-                dim = len(self._diagonal_hamiltonian.T[0])
+            _, nary = graph.independent_sets_array(self.code)
+            self._diagonal_hamiltonian = np.sum(nary == self.index, axis=1).astype(complex_dtype())[:, np.newaxis]
+            dim = len(self._diagonal_hamiltonian.T[0])
             self._hamiltonian = sparse.csc_matrix((self._diagonal_hamiltonian.T[0], (np.arange(dim), np.arange(dim))),
                                                   shape=(dim, dim))
         else:
@@ -1034,14 +1380,14 @@ class HamiltonianEnergyShift(object):
             state_shape = state.shape
             for i in range(state.number_logical_qudits):
                 if self.code.logical_code:
-                    temp = temp + self.code.left_multiply(state, [i], self._operator)
+                    self.code.left_multiply(state, [i], self._operator, out=temp)
                 elif not self.code.logical_code:
                     ind = self.code.d ** i
-                    out = np.zeros_like(state, dtype=np.complex128)
+                    out = np.zeros_like(state, dtype=state.dtype)
                     if state.is_ket:
-                        state = state.reshape((-1, self.code.d, ind), order='F')
+                        state = state.reshape((-1, self.code.d, ind, state_shape[-1]), order='F')
                         # Note index start from the right (sN,...,s3,s2,s1)
-                        out = out.reshape((-1, self.code.d, ind), order='F')
+                        out = out.reshape((-1, self.code.d, ind, state_shape[-1]), order='F')
                         out[:, self.index, :] = state[:, self.index, :]
                         state = state.reshape(state_shape, order='F')
                         out = out.reshape(state_shape, order='F')
@@ -1053,7 +1399,7 @@ class HamiltonianEnergyShift(object):
                         out[:, self.index, :, :, :] = state[:, self.index, :, :, :]
                         state = state.reshape(state_shape, order='F')
                         out = out.reshape(state_shape, order='F')
-                    temp = temp + out
+                    temp += out
             return State(self.energies[0] * temp, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
                          graph=self.graph)
         else:
@@ -1072,7 +1418,7 @@ class HamiltonianEnergyShift(object):
             state_shape = state.shape
             for i in range(state.number_logical_qudits):
                 if self.code.logical_code:
-                    temp = temp + self.code.right_multiply(state, [i], self._operator)
+                    self.code.right_multiply(state, [i], self._operator, out=temp)
                 else:
                     ind = self.code.d ** i
                     out = np.zeros_like(state)
@@ -1085,7 +1431,7 @@ class HamiltonianEnergyShift(object):
                     out[:, :, :, self.index, :] = state[:, :, :, self.index, :]
                     state = state.reshape(state_shape, order='F')
                     out = out.reshape(state_shape, order='F')
-                    temp = temp + out
+                    temp += out
             return State(self.energies[0] * temp, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
                          graph=self.graph)
         else:
@@ -1113,3 +1459,167 @@ class HamiltonianEnergyShift(object):
                 exp_hamiltonian = np.exp(-1j * time * self.energies[0] * self._diagonal_hamiltonian)
                 return State(exp_hamiltonian * state * exp_hamiltonian.conj().T,
                              is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
+
+
+class HamiltonianSector(object):
+    def __init__(self, hamiltonian, sector: SymmetrySector, energies=None):
+        """Restriction of an independent set subspace Hamiltonian, such as :py:class:`HamiltonianMIS` or
+        :py:class:`HamiltonianDriver` with ``IS_subspace=True``, to a symmetry sector. States passed in must
+        already be in the sector basis, see :py:meth:`SymmetrySector.project_state`.
+
+        :param hamiltonian: Hamiltonian to restrict. It must commute with the symmetry group of the sector.
+        :param sector: Symmetry sector to restrict to.
+        :type sector: SymmetrySector
+        :param energies: Energies of the restricted Hamiltonian, defaults to those of ``hamiltonian``.
+        :type energies: tuple
+        """
+        assert hamiltonian.IS_subspace
+        self.sector = sector
+        self.graph = sector.graph
+        self.code = sector.code
+        self.IS_subspace = True
+        if energies is None:
+            energies = hamiltonian.energies
+        self.energies = energies
+        self._propagators = {}
+        # Project the Hamiltonian at unit energy, so that the energies can be changed by a schedule
+        previous = hamiltonian.energies
+        hamiltonian.energies = (1,) + tuple(previous[1:])
+        try:
+            self._hamiltonian = sector.project(hamiltonian.hamiltonian)
+        finally:
+            hamiltonian.energies = previous
+
+    @property
+    def hamiltonian(self):
+        return self.energies[0] * self._hamiltonian
+
+    def left_multiply(self, state: State):
+        return State(self.hamiltonian @ state, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
+                     graph=self.graph)
+
+    def right_multiply(self, state: State):
+        if state.is_ket:
+            return State((state.conj().T @ self.hamiltonian).conj().T, is_ket=state.is_ket,
+                         IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
+        return State((self.hamiltonian.conj().T @ state.conj().T).conj().T, is_ket=state.is_ket,
+                     IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
+
+    def evolve(self, state: State, time):
+        if state.is_ket:
+            return State(_expm_multiply(self.hamiltonian, state, time), is_ket=state.is_ket,
+                         IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
+        return State(tools.evolve_density_matrix(self.hamiltonian, state, time, cache=self._propagators,
+                                                 key=tuple(self.energies)),
+                     is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
+
+    def cost_function(self, state: State):
+        # Returns <s|H|s>
+        if state.is_ket:
+            return _ket_expectation(state, self.hamiltonian @ state)
+        return np.real(np.squeeze(tools.trace(self.hamiltonian @ state)))
+
+
+class HamiltonianSum(object):
+    def __init__(self, hamiltonians):
+        """Sum of Hamiltonians whose energies change over time, e.g. under the schedules of
+        :py:class:`SimulateAdiabatic`. The sparsity patterns of all terms are merged once, and each energy of each
+        term keeps its own data array on the merged pattern, so the summed Hamiltonian is rebuilt from the current
+        energies of the terms by a single linear combination into a preallocated buffer. Every term must be linear
+        in its energies.
+
+        :param hamiltonians: Terms of the sum. Each must have a ``hamiltonian`` attribute and an ``energies``
+            attribute.
+        :type hamiltonians: list
+        """
+        self.hamiltonians = list(hamiltonians)
+        assert len(self.hamiltonians) > 0
+        self._propagators = {}
+        self.IS_subspace = all(getattr(h, 'IS_subspace', False) for h in self.hamiltonians)
+        self.graph = getattr(self.hamiltonians[0], 'graph', None)
+        self.code = getattr(self.hamiltonians[0], 'code', qubit)
+        # Whether any term is stored as a dense array
+        self.dense = False
+        # (term, energy) pairs, in the order of the rows of self._data
+        self._components = []
+        components = []
+        for (k, h) in enumerate(self.hamiltonians):
+            if not hasattr(h, 'energies'):
+                # Terms without energies enter the sum with a fixed unit coefficient
+                self._add_component(components, h.hamiltonian, k, None)
+                continue
+            previous = h.energies
+            try:
+                for j in range(len(previous)):
+                    h.energies = tuple(int(i == j) for i in range(len(previous)))
+                    self._add_component(components, h.hamiltonian, k, j)
+            finally:
+                h.energies = previous
+        dim = self.hamiltonians[0].hamiltonian.shape[0]
+        self.shape = (dim, dim)
+        # Merge the sparsity patterns, labeling each entry by its position in the row-major flattened matrix
+        merged = sparse.csr_matrix(self.shape, dtype=np.int32)
+        for component in components:
+            assert component.shape == self.shape
+            merged = merged + sparse.csr_matrix((np.ones(component.nnz, dtype=np.int32), component.indices,
+                                                 component.indptr), shape=self.shape)
+        merged.sort_indices()
+        pattern = np.repeat(np.arange(dim, dtype=np.int64), np.diff(merged.indptr)) * dim + merged.indices
+        keys = [np.repeat(np.arange(dim, dtype=np.int64), np.diff(component.indptr)) * dim + component.indices
+                for component in components]
+        dtype = np.result_type(*[component.dtype for component in components], np.float64)
+        self._data = np.zeros((len(components), pattern.size), dtype=dtype)
+        for (c, component) in enumerate(components):
+            self._data[c, np.searchsorted(pattern, keys[c])] = component.data
+        self._data = _as_precision(self._data)
+        self._matrix = sparse.csr_matrix((np.zeros(pattern.size, dtype=self._data.dtype), merged.indices,
+                                          merged.indptr), shape=self.shape)
+
+    def _add_component(self, components, component, k, j):
+        self.dense = self.dense or isinstance(component, np.ndarray)
+        if not sparse.issparse(component) and hasattr(component, 'tocsr'):
+            component = component.tocsr()
+        component = sparse.csr_matrix(component)
+        component.sum_duplicates()
+        component.eliminate_zeros()
+        if component.nnz > 0:
+            components.append(component)
+            self._components.append((k, j))
+
+    @property
+    def coefficients(self):
+        """Current energy of each data array of the sum."""
+        return np.array([1 if j is None else self.hamiltonians[k].energies[j] for (k, j) in self._components])
+
+    @property
+    def hamiltonian(self):
+        """The summed Hamiltonian at the current energies of the terms. The returned matrix shares its buffer with
+        the sum, and is overwritten the next time this attribute is accessed."""
+        coefficients = self.coefficients
+        if np.iscomplexobj(coefficients) and not np.iscomplexobj(self._data):
+            self._data = self._data.astype(complex_dtype())
+            self._matrix.data = np.zeros(self._data.shape[1], dtype=self._data.dtype)
+        if coefficients.size == 0:
+            self._matrix.data[...] = 0
+        else:
+            np.dot(coefficients.astype(self._data.dtype), self._data, out=self._matrix.data)
+        return self._matrix
+
+    def left_multiply(self, state: State):
+        return State(self.hamiltonian @ state, is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code,
+                     graph=state.graph)
+
+    def right_multiply(self, state: State):
+        if state.is_ket:
+            return State((state.conj().T @ self.hamiltonian).conj().T, is_ket=state.is_ket,
+                         IS_subspace=state.IS_subspace, code=state.code, graph=state.graph)
+        return State((self.hamiltonian.conj().T @ state.conj().T).conj().T, is_ket=state.is_ket,
+                     IS_subspace=state.IS_subspace, code=state.code, graph=state.graph)
+
+    def evolve(self, state: State, time):
+        if state.is_ket:
+            return State(_expm_multiply(self.hamiltonian, state, time), is_ket=state.is_ket,
+                         IS_subspace=state.IS_subspace, code=state.code, graph=state.graph)
+        return State(tools.evolve_density_matrix(self.hamiltonian, state, time, cache=self._propagators,
+                                                 key=tuple(self.coefficients)),
+                     is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=state.graph)
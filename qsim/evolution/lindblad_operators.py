@@ -1,13 +1,52 @@
-from qsim.tools import tools
 import numpy as np
-from qsim.codes import qubit
+from qsim.codes import qubit, contraction
 from qsim.codes.quantum_state import State
 import scipy.sparse as sparse
 from qsim.graph_algorithms.graph import Graph
-from scipy.linalg import expm
+from qsim import tools
 from scipy.sparse.linalg import expm_multiply
 
 
+def _norm_squared(state):
+    """Returns the squared norm of a ket, or of each column of a batch of kets."""
+    if state.shape[-1] == 1:
+        return np.vdot(state, state).real
+    return np.sum(np.abs(state) ** 2, axis=0)
+
+
+def _dissipator(jump_operators):
+    """Returns the superoperator of the dissipator :math:`\\sum_j L_j\\rho L_j^\\dagger-\\frac{1}{2}\\{L_j^TL_j,\\rho\\}`
+    on a single qudit, acting on row-major vectorized density matrices."""
+    identity = np.identity(jump_operators[0].shape[0])
+    out = np.zeros((identity.shape[0] ** 2, identity.shape[0] ** 2), dtype=np.complex128)
+    for jump_operator in jump_operators:
+        jump_product = jump_operator.T @ jump_operator
+        out += np.kron(jump_operator, jump_operator.conj())
+        out -= 1 / 2 * np.kron(jump_product, identity)
+        out -= 1 / 2 * np.kron(identity, jump_product.conj())
+    return out
+
+
+def _add_dissipator(state, out, apply_to, jump_operators):
+    """Adds the dissipator of ``jump_operators`` on each qudit of ``apply_to`` to ``out``. The dissipator is fused into a
+    single superoperator only for qudits of dimension at most ``contraction.superoperator_dimension``; otherwise each
+    jump operator is applied from the left and right in turn."""
+    d = jump_operators.shape[-1]
+    if d <= contraction.superoperator_dimension:
+        dissipator = _dissipator(jump_operators)
+        for i in range(len(apply_to)):
+            out += contraction.superoperator_multiply(state, [apply_to[i]], dissipator, d)
+        return out
+    for i in range(len(apply_to)):
+        for jump_operator in jump_operators:
+            jump_product = jump_operator.T @ jump_operator
+            out += contraction.right_multiply(contraction.left_multiply(state, [apply_to[i]], jump_operator, d),
+                                              [apply_to[i]], jump_operator, d)
+            out -= 1 / 2 * contraction.left_multiply(state, [apply_to[i]], jump_product, d)
+            out -= 1 / 2 * contraction.right_multiply(state, [apply_to[i]], jump_product, d)
+    return out
+
+
 class LindbladJumpOperator(object):
     def __init__(self, jump_operators: np.ndarray, rates, code=qubit, graph=None, IS_subspace=False):
         # Assume jump operators and rates are the same length
@@ -20,6 +59,8 @@ class LindbladJumpOperator(object):
         self.graph = graph
         self._nh_hamiltonian = None
         self._evolution_operator = None
+        # Dense non-hermitian propagators, by rates and time
+        self._propagators = {}
 
     @property
     def jump_operators(self):
@@ -34,7 +75,7 @@ class LindbladJumpOperator(object):
                 out = np.zeros((num_IS, num_IS))
                 for j in range(len(self.jump_operators)):
                     out = out - self.jump_operators[j].conj().T @ self.jump_operators[j]
-                self._nh_hamiltonian = out
+                self._nh_hamiltonian = np.asarray(out)
             else:
                 raise NotImplementedError
         return 1j * self.rates[0] / 2 * self._nh_hamiltonian
@@ -56,26 +97,22 @@ class LindbladJumpOperator(object):
             raise NotImplementedError
         return self.rates[0] * self._evolution_operator
 
-    def liouvillian(self, state: State, apply_to=None):
+    def liouvillian(self, state: State, apply_to=None, out=None):
+        """Computes the dissipative part of the Lindbladian acting on ``state``. If ``out`` is given, the result is
+        added into it in place."""
         if apply_to is None:
             apply_to = list(range(state.number_physical_qudits))
-        out = np.zeros(state.shape)
+        if out is None:
+            out = np.zeros(state.shape, dtype=state.dtype)
+        jump_operators = self.jump_operators
         if self.IS_subspace:
-            for i in range(len(self.jump_operators)):
-                out = out + self.jump_operators[i] @ state @ self.jump_operators[i].T - 1 / 2 * self.jump_operators[
-                    i].T @ self.jump_operators[i] @ state - 1 / 2 * state @ self.jump_operators[i].T @ \
-                      self.jump_operators[i]
+            for i in range(len(jump_operators)):
+                out += jump_operators[i] @ state @ jump_operators[i].T
+                out -= 1 / 2 * jump_operators[i].T @ jump_operators[i] @ state
+                out -= 1 / 2 * state @ jump_operators[i].T @ jump_operators[i]
 
         else:
-            for i in range(len(apply_to)):
-                for j in range(len(self.jump_operators)):
-                    out = out + self.code.multiply(state, [apply_to[i]],
-                                                   self.jump_operators[j]) - 1 / 2 * \
-                          self.code.left_multiply(state, [apply_to[i]], self.jump_operators[j].T @ self.jump_operators[
-                              j]) - 1 / 2 * self.code.right_multiply(
-                        state, [apply_to[i]],
-                        self.jump_operators[j].T @
-                        self.jump_operators[j])
+            out = _add_dissipator(state, out, apply_to, jump_operators)
         return State(out, is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace, graph=self.graph)
 
     def jump_rate(self, state: State, apply_to=None):
@@ -90,13 +127,13 @@ class LindbladJumpOperator(object):
             for j in range(len(self.jump_operators)):
                 for i in apply_to:
                     out = self.code.left_multiply(state, i, self.jump_operators[j])
-                    jump_rates.append(np.vdot(out, out).real)
+                    jump_rates.append(_norm_squared(out))
                     # IMPORTANT: add in a factor of sqrt(rates) for normalization purposes later
                     jumped_states.append(out)
         else:
             for j in range(len(self.jump_operators)):
                 out = self.jump_operators[j] @ state
-                jump_rates.append(np.vdot(out, out).real)
+                jump_rates.append(_norm_squared(out))
                 # IMPORTANT: add in a factor of sqrt(rates) for normalization purposes later
                 jumped_states.append(State(out, is_ket=state.is_ket, code=state.code,
                                            IS_subspace=state.IS_subspace, graph=state.graph))
@@ -110,18 +147,16 @@ class LindbladJumpOperator(object):
             apply_to = list(range(state.number_physical_qudits))
         if isinstance(apply_to, int):
             apply_to = [apply_to]
-        out = np.zeros(state.shape)
+        out = np.zeros(state.shape, dtype=state.dtype)
         if not self.IS_subspace:
-            for j in range(len(self.jump_operators)):
+            jump_operators = self.jump_operators
+            for j in range(len(jump_operators)):
+                jump_product = jump_operators[j].conj().T @ jump_operators[j]
                 for i in apply_to:
-                    out = out - 1j * self.code.left_multiply(state, i,
-                                                             self.jump_operators[
-                                                                 j].conj().T @
-                                                             self.jump_operators[j])
+                    self.code.left_multiply(state, i, jump_product, out=out, coefficient=-1j)
         else:
             for j in range(len(self.jump_operators)):
-                out = out - 1j * self.jump_operators[j].conj().T @ \
-                      self.jump_operators[j] @ state
+                out -= 1j * self.jump_operators[j].conj().T @ self.jump_operators[j] @ state
         return State(out / 2, is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace, graph=self.graph)
 
     def evolve(self, state: State, time):
@@ -136,9 +171,9 @@ class LindbladJumpOperator(object):
             return State(expm_multiply(-1j * time * self.nh_hamiltonian, state), is_ket=state.is_ket,
                          IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
         else:
-            temp = expm(-1j * time * self.nh_hamiltonian)
-            return State(temp @ state @ temp.conj().T, is_ket=state.is_ket, IS_subspace=state.IS_subspace,
-                         code=state.code, graph=self.graph)
+            return State(tools.evolve_density_matrix(self.nh_hamiltonian, state, time, hermitian=False,
+                                                     cache=self._propagators, key=tuple(self.rates)),
+                         is_ket=state.is_ket, IS_subspace=state.IS_subspace, code=state.code, graph=self.graph)
 
 
 class SpontaneousEmission(LindbladJumpOperator):
@@ -162,38 +197,15 @@ class SpontaneousEmission(LindbladJumpOperator):
             # Generate sparse mixing Hamiltonian
             assert graph is not None
             assert isinstance(graph, Graph)
-            if code is not qubit:
-                IS, nary_to_index, num_IS = graph.independent_sets_code(self.code)
-            else:
-                # We have already solved for this information
-                IS, nary_to_index, num_IS = graph.independent_sets, graph.binary_to_index, graph.num_independent_sets
-            self._jump_operators = []
+            _, nary = graph.independent_sets_array(self.code)
+            num_IS = nary.shape[0]
             # For each atom, consider the states spontaneous emission can generate transitions between
-            # Over-allocate space
+            rows, columns, nodes = graph.independent_set_flips(self.code, self.transition[0], self.transition[1])
+            self._jump_operators = []
             for j in range(graph.n):
-                rows = np.zeros(num_IS, dtype=int)
-                columns = np.zeros(num_IS, dtype=int)
-                entries = np.zeros(num_IS, dtype=int)
-                num_terms = 0
-                for i in IS:
-                    if IS[i][2][j] == self.transition[0]:
-                        # Flip spin at this location
-                        # Get binary representation
-                        temp = IS[i][2].copy()
-                        temp[j] = self.transition[1]
-                        flipped_temp = tools.nary_to_int(temp, base=code.d)
-                        if flipped_temp in nary_to_index:
-                            # This is a valid spin flip
-                            rows[num_terms] = nary_to_index[flipped_temp]
-                            columns[num_terms] = i
-                            entries[num_terms] = 1
-                            num_terms += 1
-                # Cut off the excess in the arrays
-                columns = columns[:num_terms]
-                rows = rows[:num_terms]
-                entries = entries[:num_terms]
-                # Now, append the jump operator
-                jump_operator = sparse.csc_matrix((entries, (rows, columns)), shape=(num_IS, num_IS))
+                on_node = nodes == j
+                jump_operator = sparse.csc_matrix((np.ones(np.sum(on_node), dtype=int),
+                                                   (rows[on_node], columns[on_node])), shape=(num_IS, num_IS))
                 self._jump_operators.append(jump_operator)
 
         super().__init__(np.asarray(self._jump_operators), rates, code=code, graph=graph, IS_subspace=IS_subspace)
@@ -235,25 +247,24 @@ class SpontaneousEmission(LindbladJumpOperator):
                     raise NotImplementedError
             return 1j * self.rates[0] / 2 * self._evolution_operator
 
-    def liouvillian(self, state: State, apply_to=None):
+    def liouvillian(self, state: State, apply_to=None, out=None):
+        """Computes the dissipative part of the Lindbladian acting on ``state``. If ``out`` is given, the result is
+        added into it in place."""
         if apply_to is None:
             apply_to = list(range(state.number_physical_qudits))
-        out = np.zeros(state.shape)
+        if out is None:
+            out = np.zeros(state.shape, dtype=state.dtype)
         if isinstance(apply_to, int):
             apply_to = [apply_to]
+        jump_operators = self.jump_operators
         if self.IS_subspace:
             for i in range(self.graph.n):
-                out = out + self.jump_operators[i] @ state @ self.jump_operators[i].T - 1 / 2 * self.jump_operators[
-                    i].T @ self.jump_operators[i] @ state - 1 / 2 * state @ self.jump_operators[i].T @ \
-                      self.jump_operators[i]
+                out += jump_operators[i] @ state @ jump_operators[i].T
+                out -= 1 / 2 * jump_operators[i].T @ jump_operators[i] @ state
+                out -= 1 / 2 * state @ jump_operators[i].T @ jump_operators[i]
 
         else:
-            for i in range(len(apply_to)):
-                out = out + self.code.multiply(state, [apply_to[i]],
-                                               self.jump_operators[0]) - 1 / 2 * \
-                      self.code.left_multiply(state, [apply_to[i]], self.jump_operators[0].T @ self.jump_operators[0]) \
-                      - 1 / 2 * self.code.right_multiply(state, [apply_to[i]],
-                                                         self.jump_operators[0].T @ self.jump_operators[0])
+            out = _add_dissipator(state, out, apply_to, jump_operators[:1])
         return State(out, is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace, graph=state.graph)
 
     def jump_rate(self, state: State, apply_to=None):
@@ -268,13 +279,13 @@ class SpontaneousEmission(LindbladJumpOperator):
             for j in range(len(self.jump_operators)):
                 for i in apply_to:
                     out = self.code.left_multiply(state, i, self.jump_operators[j])
-                    jump_rates.append(np.vdot(out, out).real)
+                    jump_rates.append(_norm_squared(out))
                     # IMPORTANT: add in a factor of sqrt(rates) for normalization purposes later
                     jumped_states.append(out)
         else:
             for j in range(len(self.jump_operators)):
                 out = self.jump_operators[j] @ state
-                jump_rates.append(np.vdot(out, out).real)
+                jump_rates.append(_norm_squared(out))
                 # IMPORTANT: add in a factor of sqrt(rates) for normalization purposes later
                 jumped_states.append(out)
 
@@ -287,16 +298,16 @@ class SpontaneousEmission(LindbladJumpOperator):
             apply_to = list(range(state.number_physical_qudits))
         if isinstance(apply_to, int):
             apply_to = [apply_to]
-        out = np.zeros(state.shape)
+        out = np.zeros(state.shape, dtype=state.dtype)
         if not self.IS_subspace:
-            for j in range(len(self.jump_operators)):
+            jump_operators = self.jump_operators
+            for j in range(len(jump_operators)):
+                jump_product = jump_operators[j].conj().T @ jump_operators[j]
                 for i in apply_to:
-                    out = out - 1j * self.code.left_multiply(state, i,
-                                                             self.jump_operators[j].conj().T @
-                                                             self.jump_operators[j])
+                    self.code.left_multiply(state, i, jump_product, out=out, coefficient=-1j)
         else:
             for j in range(len(self.jump_operators)):
-                out = out - 1j * self.jump_operators[j].conj().T @ (self.jump_operators[j] @ state)
+                out -= 1j * self.jump_operators[j].conj().T @ (self.jump_operators[j] @ state)
         return State(out / 2, is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace)
 
 
@@ -322,61 +333,27 @@ class LindbladPauliOperator(LindbladJumpOperator):
             # Generate sparse mixing Hamiltonian
             assert graph is not None
             assert isinstance(graph, Graph)
-            if code is not qubit:
-                IS, nary_to_index, num_IS = graph.independent_sets_code(self.code)
-            else:
-                # We have already solved for this information
-                IS, nary_to_index, num_IS = graph.independent_sets, graph.binary_to_index, graph.num_independent_sets
+            _, nary = graph.independent_sets_array(self.code)
+            num_IS = nary.shape[0]
+            if self.pauli == 'X' or self.pauli == 'Y':
+                # Spin flips generated by the laser
+                flipped, original, nodes = graph.independent_set_flips(self.code, self.transition[1],
+                                                                       self.transition[0])
             self._jump_operators = []
-            # For each atom, consider the states spontaneous emission can generate transitions between
-            # Over-allocate space
             for j in range(graph.n):
                 if self.pauli == 'Z':
-                    entries = np.zeros(num_IS, dtype=int)
                     columns = np.arange(0, num_IS, 1, dtype=int)
                     rows = np.arange(0, num_IS, 1, dtype=int)
-                    for k in IS:
-                        if IS[k][2][j] == self.transition[0]:
-                            entries[k] = 1
-                        elif IS[k][2][j] == self.transition[1]:
-                            entries[k] = -1
-
+                    entries = (nary[:, j] == self.transition[0]).astype(int) - (nary[:, j] == self.transition[1])
                 elif self.pauli == 'X' or self.pauli == 'Y':
-                    # For each IS, look at spin flips generated by the laser
-                    # Over-allocate space
-                    rows = np.zeros(graph.n * num_IS, dtype=int)
-                    columns = np.zeros(graph.n * num_IS, dtype=int)
-                    entries = np.zeros(graph.n * num_IS, dtype=np.complex128)
-                    num_terms = 0
-                    for i in IS:
-                        if IS[i][2][j] == self.transition[1]:
-                            # Flip spin at this location
-                            # Get binary representation
-                            temp = IS[i][2].copy()
-                            temp[j] = self.transition[0]
-                            flipped_temp = tools.nary_to_int(temp, base=code.d)
-                            if flipped_temp in nary_to_index:
-                                # This is a valid spin flip
-                                rows[num_terms] = nary_to_index[flipped_temp]
-                                columns[num_terms] = i
-                                if self.pauli == 'X':
-                                    entries[num_terms] = 1
-                                elif self.pauli == 'Y':
-                                    entries[num_terms] = -1j
-                                num_terms += 1
-                    # Cut off the excess in the arrays
-                    columns = columns[:2 * num_terms]
-                    rows = rows[:2 * num_terms]
-                    entries = entries[:2 * num_terms]
-                    # Populate the second half of the entries according to self.pauli
-                    if self.pauli == 'X':
-                        columns[num_terms:2 * num_terms] = rows[:num_terms]
-                        rows[num_terms:2 * num_terms] = columns[:num_terms]
-                        entries[num_terms:2 * num_terms] = entries[:num_terms]
-                    elif self.pauli == 'Y':
-                        columns[num_terms:2 * num_terms] = rows[:num_terms]
-                        rows[num_terms:2 * num_terms] = columns[:num_terms]
-                        entries[num_terms:2 * num_terms] = -1 * entries[:num_terms]
+                    on_node = nodes == j
+                    # The second half of the entries are the conjugate transitions
+                    rows = np.concatenate([flipped[on_node], original[on_node]])
+                    columns = np.concatenate([original[on_node], flipped[on_node]])
+                    entries = np.ones(rows.size, dtype=np.complex128)
+                    if self.pauli == 'Y':
+                        entries[:rows.size // 2] = -1j
+                        entries[rows.size // 2:] = 1j
                 else:
                     raise Exception('self.pauli must be X, Y, or Z')
 
@@ -423,25 +400,24 @@ class LindbladPauliOperator(LindbladJumpOperator):
                     raise NotImplementedError
             return 1j * self.rates[0] / 2 * self._evolution_operator
 
-    def liouvillian(self, state: State, apply_to=None):
+    def liouvillian(self, state: State, apply_to=None, out=None):
+        """Computes the dissipative part of the Lindbladian acting on ``state``. If ``out`` is given, the result is
+        added into it in place."""
         if apply_to is None:
             apply_to = list(range(state.number_physical_qudits))
-        out = np.zeros(state.shape)
+        if out is None:
+            out = np.zeros(state.shape, dtype=state.dtype)
         if isinstance(apply_to, int):
             apply_to = [apply_to]
+        jump_operators = self.jump_operators
         if self.IS_subspace:
             for i in range(self.graph.n):
-                out = out + self.jump_operators[i] @ state @ self.jump_operators[i].T - 1 / 2 * self.jump_operators[
-                    i].T @ self.jump_operators[i] @ state - 1 / 2 * state @ self.jump_operators[i].T @ \
-                      self.jump_operators[i]
+                out += jump_operators[i] @ state @ jump_operators[i].T
+                out -= 1 / 2 * jump_operators[i].T @ jump_operators[i] @ state
+                out -= 1 / 2 * state @ jump_operators[i].T @ jump_operators[i]
 
         else:
-            for i in range(len(apply_to)):
-                out = out + self.code.multiply(state, [apply_to[i]],
-                                               self.jump_operators[0]) - 1 / 2 * \
-                      self.code.left_multiply(state, [apply_to[i]], self.jump_operators[0].T @ self.jump_operators[0]) \
-                      - 1 / 2 * self.code.right_multiply(state, [apply_to[i]],
-                                                         self.jump_operators[0].T @ self.jump_operators[0])
+            out = _add_dissipator(state, out, apply_to, jump_operators[:1])
         return State(out, is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace, graph=state.graph)
 
     def jump_rate(self, state: State, apply_to=None):
@@ -456,13 +432,13 @@ class LindbladPauliOperator(LindbladJumpOperator):
             for j in range(len(self.jump_operators)):
                 for i in apply_to:
                     out = self.code.left_multiply(state, i, self.jump_operators[j])
-                    jump_rates.append(np.vdot(out, out).real)
+                    jump_rates.append(_norm_squared(out))
                     # IMPORTANT: add in a factor of sqrt(rates) for normalization purposes later
                     jumped_states.append(out)
         else:
             for j in range(len(self.jump_operators)):
                 out = self.jump_operators[j] @ state
-                jump_rates.append(np.vdot(out, out).real)
+                jump_rates.append(_norm_squared(out))
                 # IMPORTANT: add in a factor of sqrt(rates) for normalization purposes later
                 jumped_states.append(out)
 
@@ -475,15 +451,15 @@ class LindbladPauliOperator(LindbladJumpOperator):
             apply_to = list(range(state.number_physical_qudits))
         if isinstance(apply_to, int):
             apply_to = [apply_to]
-        out = np.zeros(state.shape)
+        out = np.zeros(state.shape, dtype=state.dtype)
         if not self.IS_subspace:
-            for j in range(len(self.jump_operators)):
+            jump_operators = self.jump_operators
+            for j in range(len(jump_operators)):
+                jump_product = jump_operators[j].conj().T @ jump_operators[j]
                 for i in apply_to:
-                    out = out - 1j * self.code.left_multiply(state, i,
-                                                             self.jump_operators[j].conj().T @
-                                                             self.jump_operators[j])
+                    self.code.left_multiply(state, i, jump_product, out=out, coefficient=-1j)
         else:
             for j in range(len(self.jump_operators)):
-                out = out - 1j * self.jump_operators[j].conj().T @ (self.jump_operators[j] @ state)
+                out -= 1j * self.jump_operators[j].conj().T @ (self.jump_operators[j] @ state)
         return State(out / 2, is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace)
 
@@ -1,7 +1,7 @@
 from qsim.tools import tools
 import numpy as np
 from qsim.codes.quantum_state import State
-from qsim.codes import qubit
+from qsim.codes import qubit, contraction
 from typing import Union
 from scipy import sparse
 from qsim.graph_algorithms.graph import Graph
@@ -69,12 +69,6 @@ class QuantumChannel(object):
         if isinstance(apply_to, int):
             apply_to = [apply_to]
 
-        if state.code.logical_code:
-            # Assume that logical codes are composed of qubits
-            code = self.code
-        else:
-            code = state.code
-
         if self.IS_subspace:
             povm = self.povm(p)
             temp = state.copy()
@@ -89,22 +83,16 @@ class QuantumChannel(object):
         # Handle apply_to recursively
         # Only apply to one qudit
         else:
-            # Empty s to store the output
-            out = State(np.zeros_like(state), is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace,
-                        graph=state.graph)
-
+            # Sum over the povm elements in a single contraction with the superoperator of the channel. The local
+            # dimension is that of the povm, so logical codes are acted on as their physical qubits.
+            povm = np.asarray(self.povm(p))
             if len(apply_to) == 1:
-                povm = self.povm(p)
-                for j in range(len(povm)):
-                    out = out + code.multiply(state, apply_to, povm[j])
-                return out
+                out = contraction.kraus(state, apply_to, povm, povm.shape[-1])
             else:
                 last_element = apply_to.pop()
                 recursive_solution = self.channel(state, p, apply_to=apply_to)
-                povm = self.povm(p)
-                for j in range(len(povm)):
-                    out = out + code.multiply(recursive_solution, [last_element], povm[j])
-                return out
+                out = contraction.kraus(recursive_solution, [last_element], povm, povm.shape[-1])
+            return State(out, is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace, graph=state.graph)
 
     def evolve(self, state: State, time, threshold=.05, apply_to: Union[int, list] = None):
         if state.is_ket:
@@ -249,12 +237,10 @@ class AmplitudeDampingChannel(QuantumChannel):
 
         # Initially generate all indices which should correspond to terms that look like \sqrt{p} and \sqrt{1-p}
         if self.IS_subspace:
-            if self.code is not qubit:
-                IS, nary_to_index, num_IS = graph.independent_sets_code(self.code)
-            else:
-                # We have already solved for this information
-                IS, nary_to_index, num_IS = graph.independent_sets, graph.binary_to_index, graph.num_independent_sets
-
+            _, nary = graph.independent_sets_array(self.code)
+            num_IS = nary.shape[0]
+            # Transitions from the higher energy state which remain in the independent set subspace
+            rows, columns, nodes = graph.independent_set_flips(self.code, self.transition[0], self.transition[1])
             self._povm_coherence = []
             self._povm_population_decay = []
             self._povm_population_stable = []
@@ -262,58 +248,13 @@ class AmplitudeDampingChannel(QuantumChannel):
             self._last_povm = None
 
             for j in range(self.graph.n):
-                num_terms_coherence = 0
-                num_terms_population_decay = 0
-                num_terms_population_stable = 0
-                num_terms = 0
-                rows_coherence = np.zeros(graph.n * num_IS, dtype=int)
-                columns_coherence = np.zeros(graph.n * num_IS, dtype=int)
-                rows_population_decay = np.zeros(num_IS, dtype=int)
-                columns_population_decay = np.zeros(num_IS, dtype=int)
-                rows_population_stable = np.zeros(num_IS, dtype=int)
-                columns_population_stable = np.zeros(num_IS, dtype=int)
-                for i in IS:
-                    num_terms += 1
-                    # For each spin
-                    if IS[i][2][j] == self.transition[0]:
-                        # Higher energy state
-                        # Assign population terms
-                        columns_population_decay[num_terms_population_decay] = i
-                        rows_population_decay[num_terms_population_decay] = i
-                        num_terms_population_decay += 1
-
-                        # Flip spin at this location
-                        # Get binary representation
-                        temp = IS[i][2].copy()
-                        temp[j] = self.transition[1]
-                        flipped_temp = tools.nary_to_int(temp, base=code.d)
-                        if flipped_temp in nary_to_index:
-                            # This is a valid spin flip
-                            rows_coherence[num_terms_coherence] = nary_to_index[flipped_temp]
-                            columns_coherence[num_terms_coherence] = i
-                            num_terms_coherence += 1
-                    else:
-                        rows_population_stable[num_terms_population_stable] = i
-                        columns_population_stable[num_terms_population_stable] = i
-                        num_terms_population_stable += 1
-                # Cut off the excess in the arrays
-                columns_coherence = columns_coherence[:num_terms_coherence]
-                rows_coherence = rows_coherence[:num_terms_coherence]
-                columns_population_decay = columns_population_decay[: num_terms_population_decay]
-                rows_population_decay = rows_population_decay[: num_terms_population_decay]
-                columns_population_stable = columns_population_stable[: num_terms_population_stable]
-                rows_population_stable = rows_population_stable[: num_terms_population_stable]
-                self._povm_coherence.append(sparse.csc_matrix((np.ones(num_terms_coherence, dtype=np.complex128),
-                                                               (rows_coherence, columns_coherence)),
-                                                              shape=(num_terms, num_terms)))
-                self._povm_population_decay.append(
-                    sparse.csc_matrix((np.ones(num_terms_population_decay, dtype=np.complex128),
-                                       (rows_population_decay, columns_population_decay)),
-                                      shape=(num_terms, num_terms)))
-                self._povm_population_stable.append(
-                    sparse.csc_matrix((np.ones(num_terms_population_stable, dtype=np.complex128),
-                                       (rows_population_stable, columns_population_stable)),
-                                      shape=(num_terms, num_terms)))
+                on_node = nodes == j
+                decays = nary[:, j] == self.transition[0]
+                self._povm_coherence.append(sparse.csc_matrix((np.ones(np.sum(on_node), dtype=np.complex128),
+                                                               (rows[on_node], columns[on_node])),
+                                                              shape=(num_IS, num_IS)))
+                self._povm_population_decay.append(sparse.diags(decays.astype(np.complex128), format='csc'))
+                self._povm_population_stable.append(sparse.diags((~decays).astype(np.complex128), format='csc'))
 
         def povm(p):
             if not self.IS_subspace:
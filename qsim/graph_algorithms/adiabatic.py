@@ -4,7 +4,7 @@ from scipy.integrate._ivp.ivp import OdeResult
 
 from qsim.tools.tools import outer_product, is_valid_state
 from qsim.codes import qubit
-from qsim.evolution.hamiltonian import HamiltonianMIS, HamiltonianDriver, HamiltonianMaxCut
+from qsim.evolution.hamiltonian import HamiltonianMIS, HamiltonianDriver, HamiltonianMaxCut, HamiltonianSum
 from qsim.graph_algorithms.graph import Graph
 from qsim.codes.quantum_state import State
 from qsim.schrodinger_equation import SchrodingerEquation
@@ -43,6 +43,14 @@ class SimulateAdiabatic(object):
             elif self.noise_model == 'monte_carlo':
                 return time * 50
 
+    def _summed_hamiltonians(self):
+        """Returns the Hamiltonians to integrate. In the independent set subspace, the schedules only change the
+        energies of sparse matrices, so the Hamiltonians are merged into a single :py:class:`HamiltonianSum` whose
+        coefficients follow the energies of the terms."""
+        if self.IS_subspace:
+            return [HamiltonianSum(self.hamiltonian)]
+        return self.hamiltonian
+
     def rydberg_MIS_schedule(self, t, tf, coefficients=None, verbose=False):
         if coefficients is None:
             coefficients = [1, 1]
@@ -108,7 +116,8 @@ class SimulateAdiabatic(object):
                                                                        schedule=lambda t: schedule(t, time),
                                                                        full_output=full_output, verbose=verbose)
             else:
-                master_equation = LindbladMasterEquation(hamiltonians=self.hamiltonian, jump_operators=self.noise)
+                master_equation = LindbladMasterEquation(hamiltonians=self._summed_hamiltonians(),
+                                                         jump_operators=self.noise)
                 results, info = master_equation.run_ode_solver(initial_state, 0, time, num=num,
                                                                schedule=lambda t: schedule(t, time), method=method,
                                                                full_output=full_output, verbose=verbose)
@@ -121,6 +130,7 @@ class SimulateAdiabatic(object):
                                                                             verbose=verbose, full_output=full_output,
                                                                             schedule=lambda t: schedule(t, time))
             else:
+                schrodinger_equation = SchrodingerEquation(hamiltonians=self._summed_hamiltonians())
                 results, info = schrodinger_equation.run_ode_solver(initial_state, 0, time, num=num, verbose=verbose,
                                                                     schedule=lambda t: schedule(t, time), method=method,
                                                                     full_output=full_output)
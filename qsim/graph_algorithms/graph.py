@@ -1,6 +1,8 @@
 import numpy as np
+import scipy.sparse as sparse
 from qsim.tools import tools
-from qsim.codes import qubit
+from qsim.codes import qubit, contraction
+from qsim.codes.quantum_state import State
 import matplotlib.pyplot as plt
 import networkx as nx
 from networkx.algorithms import approximation
@@ -31,6 +33,7 @@ class Graph(object):
         self.independent_sets = None
         self.binary_to_index = None
         self.mis_size = None
+        self._independent_set_arrays = {}
         # Populate initialized attributes
         self.generate_independent_sets()
 
@@ -44,65 +47,52 @@ class Graph(object):
         self.num_independent_sets = sum(1 for _ in backup) + 1  # We add one to include the empty set
         # Generate a list of integers corresponding to the independent sets in binary
         indices = np.zeros(self.num_independent_sets, dtype=int)
+        # All spins down should be at the end
         indices[-1] = 2 ** self.n - 1
         k = self.num_independent_sets - 2
         self.mis_size = 0
-        IS = dict.fromkeys(np.arange(self.num_independent_sets))
-        # All spins down should be at the end
-        IS[self.num_independent_sets - 1] = (2 ** self.n - 1, 0, np.ones(self.n, dtype=int))
+        sizes = np.zeros(self.num_independent_sets, dtype=int)
         for i in independent_sets:
             indices[k] = 2 ** self.n - sum(2 ** j for j in i) - 1
-            IS[k] = (indices[k], len(i), tools.int_to_nary(indices[k], size=self.n))
+            sizes[k] = len(i)
             if len(i) > self.mis_size:
                 self.mis_size = len(i)
             k -= 1
+        nary = tools.ints_to_nary(indices, self.n).astype(int)
+        IS = dict(zip(np.arange(self.num_independent_sets), zip(indices, sizes, nary)))
         binary_to_index = dict.fromkeys(indices)
         for j in range(self.num_independent_sets):
             binary_to_index[indices[j]] = j
         self.binary_to_index = binary_to_index
         self.independent_sets = IS
+        self._independent_set_arrays = {}
         return IS, binary_to_index, self.num_independent_sets
 
     def independent_sets_code(self, code):
         assert not code is qubit
         # You do NOT need to count the number in ground, this is just n-# excited
         # Count the number of elements in the ground space and map to their representation in ternary
-        # Determine how large to make the array
-        num_IS = 0
-        for i in self.independent_sets:
-            # Count the number of ones
-            num_ground = self.n - self.independent_sets[i][1]
-            num_IS += (code.d - 1) ** num_ground
-        # Now, we need to generate a way to map between the restricted indices and the original
-        # indices
-        IS = dict.fromkeys(np.arange(num_IS))
-        indices = np.zeros(num_IS, dtype=int)
-        nary_reprs = np.zeros((num_IS, self.n))
-        IS_sizes = np.zeros(num_IS, dtype=int)
-        counter = 0
-        # TODO: deal with the all one's string
+        # Assign every combination of the states 1, ..., d - 1 to the nodes outside of each independent set
+        nary_reprs = []
+        IS_sizes = []
         for i in self.independent_sets:
-            # Generate binary representation of IS
             IS_index, IS_size, IS_binary = self.independent_sets[i]
-            # Count the number of ones and generate all combinations of 1's and 2's
-            num_ground = self.n - IS_size
-            where_excited = np.where(IS_binary == 0)[0]
-            # noinspection PyTypeChecker
-            states_generator = product(range(1, code.d), repeat=num_ground)
-            for j in states_generator:
-                ind = 0
-                bit_string = np.zeros(self.n)
-                # Construct the bit string itself
-                for k in range(self.n):
-                    if np.any(where_excited == k):
-                        pass
-                    else:
-                        bit_string[k] = j[ind]
-                        ind += 1
-                nary_reprs[counter, :] = bit_string
-                IS_sizes[counter] = IS_size
-                indices[counter] = tools.nary_to_int(bit_string, base=code.d)
-                counter += 1
+            where_ground = np.where(IS_binary != 0)[0]
+            num_ground = where_ground.size
+            bit_strings = np.ones(((code.d - 1) ** num_ground, self.n), dtype=int)
+            bit_strings[:, IS_binary == 0] = 0
+            if code.d > 2:
+                bit_strings[:, where_ground] += tools.ints_to_nary(np.arange((code.d - 1) ** num_ground), num_ground,
+                                                                   base=code.d - 1)
+            nary_reprs.append(bit_strings)
+            IS_sizes.append(np.full(bit_strings.shape[0], IS_size))
+        nary_reprs = np.concatenate(nary_reprs)
+        IS_sizes = np.concatenate(IS_sizes).astype(int)
+        indices = tools.nary_to_ints(nary_reprs, base=code.d).astype(int)
+        # The n-ary representations are returned as floats, as they always have been
+        nary_reprs = nary_reprs.astype(float)
+        num_IS = indices.size
+        IS = dict.fromkeys(np.arange(num_IS))
         # Get the sorted order for the indices
         order = np.argsort(indices)
         # Finally, populate the dictionary
@@ -117,6 +107,51 @@ class Graph(object):
             counter += 1
         return IS, nary_to_index, num_IS
 
+    def independent_sets_array(self, code=qubit):
+        """Returns the independent set basis of a code as arrays, in the order of its indices.
+
+        :param code: Code whose independent set basis is returned, defaults to qubit.
+        :return: A tuple ``(labels, nary)``, where ``labels[k]`` is the integer representation of independent set
+            ``k`` in base ``code.d`` and ``nary[k]`` its digits, one per node.
+        """
+        key = (code is qubit, code.d)
+        if key not in self._independent_set_arrays:
+            if code is qubit:
+                IS, num_IS = self.independent_sets, self.num_independent_sets
+            else:
+                IS, _, num_IS = self.independent_sets_code(code)
+            labels = np.array([IS[k][0] for k in range(num_IS)], dtype=np.int64)
+            nary = np.array([IS[k][2] for k in range(num_IS)], dtype=int).reshape(num_IS, self.n)
+            self._independent_set_arrays[key] = (labels, nary)
+        return self._independent_set_arrays[key]
+
+    def independent_set_flips(self, code, source, target):
+        """Finds every single-node transition from level ``source`` to level ``target`` which maps an independent set
+        to another independent set.
+
+        :param code: Code whose independent set basis is used.
+        :param source: Level of the node before the transition.
+        :type source: int
+        :param target: Level of the node after the transition.
+        :type target: int
+        :return: A tuple ``(rows, columns, nodes)`` of index arrays. Transition ``t`` acts on node ``nodes[t]`` and
+            maps independent set ``columns[t]`` to independent set ``rows[t]``. Transitions are ordered by column,
+            then by node.
+        """
+        labels, nary = self.independent_sets_array(code)
+        order = np.argsort(labels)
+        sorted_labels = labels[order]
+        columns, nodes = np.nonzero(nary == source)
+        if code.d == 2:
+            flipped = labels[columns] ^ (np.int64(1) << (self.n - 1 - nodes).astype(np.int64))
+        else:
+            powers = np.int64(code.d) ** np.arange(self.n - 1, -1, -1, dtype=np.int64)
+            flipped = labels[columns] + (target - source) * powers[nodes]
+        positions = np.searchsorted(sorted_labels, flipped)
+        positions[positions == labels.size] = 0
+        valid = sorted_labels[positions] == flipped
+        return order[positions[valid]], columns[valid], nodes[valid]
+
 
 class GraphMonteCarlo(object):
     def __init__(self, graph: nx.Graph):
@@ -315,6 +350,114 @@ def ring_graph(n, node_weight=1, edge_weight=1, return_mis=False):
     return Graph(g)
 
 
+def ring_symmetries(n):
+    """Returns the translation :math:`i\\to i+1` and reflection :math:`i\\to -i` (mod :math:`n`) of the nodes of
+    :py:func:`ring_graph` as node permutations, for use with :py:class:`SymmetrySector`."""
+    nodes = np.arange(n)
+    return [(nodes + 1) % n, (-nodes) % n]
+
+
+def torus_symmetries(y, x):
+    """Returns the two lattice translations of a periodic :math:`x\\times y` grid whose nodes have been relabeled
+    from ``nx.grid_2d_graph(x, y, periodic=True)`` in node order, as node permutations."""
+    nodes = np.arange(x * y).reshape(x, y)
+    return [np.roll(nodes, -1, axis=0).flatten(), np.roll(nodes, -1, axis=1).flatten()]
+
+
+class SymmetrySector(object):
+    def __init__(self, graph: Graph, generators, characters=None, code=qubit, tol=1e-10):
+        """Basis of the subspace of independent sets on which a group of graph automorphisms acts with a fixed
+        one-dimensional character, e.g. a momentum and parity sector of a ring.
+
+        :param graph: Graph whose independent sets span the full space.
+        :type graph: Graph
+        :param generators: Node permutations generating the symmetry group. Permutation ``p`` maps node ``i`` to
+            node ``p[i]``.
+        :type generators: list
+        :param characters: Eigenvalue of each generator in the sector, defaults to one for every generator. For a
+            ring with generators :py:func:`ring_symmetries`, momentum :math:`k` and parity :math:`\\pm 1` is
+            ``[np.exp(2j * np.pi * k / n), 1]``.
+        :type characters: list
+        :param code: Code whose independent set basis is used, defaults to qubit.
+        :param tol: Orbits whose projection into the sector has a norm below ``tol`` are dropped.
+        :type tol: float
+        """
+        self.graph = graph
+        self.code = code
+        if characters is None:
+            characters = [1] * len(generators)
+        assert len(characters) == len(generators)
+        self.generators = [np.asarray(p, dtype=int) for p in generators]
+        self.characters = [complex(c) for c in characters]
+        self.group, self.group_characters = self._generate_group()
+        indices, nary = graph.independent_sets_array(code)
+        num_IS = indices.size
+        order = np.argsort(indices)
+        powers = code.d ** np.arange(graph.n)[::-1]
+        # images[g, j] is the index of the independent set j acted on by group element g
+        images = np.zeros((len(self.group), num_IS), dtype=int)
+        permuted = np.zeros(nary.shape, dtype=int)
+        for (g, p) in enumerate(self.group):
+            permuted[:, p] = nary
+            images[g] = order[np.searchsorted(indices, permuted @ powers, sorter=order)]
+        # Orbits are labeled by their smallest index
+        self.representatives = np.unique(np.min(images, axis=0))
+        # Column r is sum_g conj(chi(g)) U_g |r>, which has eigenvalue chi(g) under every U_g
+        rows = images[:, self.representatives].flatten()
+        cols = np.tile(np.arange(self.representatives.size), len(self.group))
+        data = np.repeat(np.conj(self.group_characters), self.representatives.size)
+        basis = sparse.csc_matrix((data, (rows, cols)), shape=(num_IS, self.representatives.size))
+        norms = np.sqrt(np.asarray(abs(basis).power(2).sum(axis=0)).flatten())
+        keep = norms > tol
+        self.representatives = self.representatives[keep]
+        self.norms = norms[keep]
+        self.basis = basis[:, keep] @ sparse.diags(1 / self.norms)
+        self.dimension = self.representatives.size
+
+    def _generate_group(self):
+        """Closes the generators under composition, tracking the character of every group element."""
+        identity = tuple(range(self.graph.n))
+        group = {identity: 1}
+        frontier = [identity]
+        while len(frontier) > 0:
+            new_frontier = []
+            for element in frontier:
+                for (p, c) in zip(self.generators, self.characters):
+                    composed = tuple(p[list(element)])
+                    character = group[element] * c
+                    if composed not in group:
+                        group[composed] = character
+                        new_frontier.append(composed)
+                    elif not np.isclose(group[composed], character):
+                        raise Exception('characters do not define a one-dimensional representation of the group')
+            frontier = new_frontier
+        return [np.array(g) for g in group], np.array([group[g] for g in group])
+
+    def project(self, operator):
+        """Returns :math:`V^\\dagger A V`, the restriction of an operator :math:`A` on the independent set subspace
+        to the sector, where the columns of :math:`V` are the sector basis vectors. The operator must commute with
+        the symmetry group."""
+        return sparse.csr_matrix(self.basis.conj().T @ operator @ self.basis)
+
+    def project_state(self, state):
+        """Restricts a ket or density matrix on the independent set subspace to the sector."""
+        if state.is_ket:
+            out = self.basis.conj().T @ np.asarray(state)
+        else:
+            out = self.basis.conj().T @ (self.basis.conj().T @ np.asarray(state).conj().T).conj().T
+        return State(np.asarray(out), is_ket=state.is_ket, code=self.code, IS_subspace=True,
+                     graph=self.graph)
+
+    def lift_state(self, state):
+        """Embeds a ket or density matrix in the sector back into the independent set subspace."""
+        if state.is_ket:
+            out = self.basis @ np.asarray(state)
+        else:
+            out = self.basis @ (self.basis @ np.asarray(state).conj().T).conj().T
+        return State(np.asarray(out), is_ket=state.is_ket, code=self.code, IS_subspace=True,
+                     graph=self.graph)
+
+
 def degree_fails_graph(return_mis=False):
     g = nx.Graph()
     g.add_weighted_edges_from(
@@ -328,9 +471,9 @@ def IS_projector(graph, code):
     """Returns a projector (represented as a column vector or matrix) into the space of independent sets for
     general codes."""
     n = graph.n
-    # Check if U is diagonal
-    if tools.is_diagonal(code.U):
-        U = np.diag(code.U)
+    # Check if Q is diagonal
+    if tools.is_diagonal(code.Q):
+        Q = np.diag(code.Q)
         proj = np.ones(code.d ** n)
         for i, j in graph.edges:
             if i > j:
@@ -339,21 +482,26 @@ def IS_projector(graph, code):
                 i = j
                 j = temp
             temp = tools.tensor_product(
-                [np.ones(code.d ** i), U, np.ones(code.d ** (j - i - 1)), U,
+                [np.ones(code.d ** i), Q, np.ones(code.d ** (j - i - 1)), Q,
                  np.ones(code.d ** (n - j - 1))])
             proj = proj * (np.ones(code.d ** n) - temp)
         return np.array([proj]).T
     else:
-        # TODO: make this output a sparse matrix
-        proj = np.identity(code.d ** n)
+        # The edge terms commute, so the projector is the product of I - Q_i Q_j over the edges. Apply it to a few
+        # columns of the identity at a time, keeping only their diagonal entries
+        dimension = code.d ** n
+        edge_terms = []
         for i, j in graph.edges:
             if i > j:
                 # Requires i < j
-                temp = i
-                i = j
-                j = temp
-            temp = tools.tensor_product(
-                [tools.identity(i, d=code.d), code.U, tools.identity(j - i - 1, d=code.d), code.U,
-                 tools.identity(n - j - 1, d=code.d)])
-            proj = proj @ (np.identity(code.d ** n) - temp)
-        return np.array([np.diagonal(proj)]).T
+                i, j = j, i
+            edge_terms.append(tools.KronOperator([i, code.Q, j - i - 1, code.Q, n - j - 1], d=code.d))
+        proj = np.zeros(dimension, dtype=np.result_type(code.Q, float))
+        for chunk in contraction.chunks(dimension, max(1, contraction.chunk_size // dimension)):
+            rows = np.arange(chunk.start, chunk.stop)
+            columns = np.zeros((dimension, rows.size), dtype=proj.dtype)
+            columns[rows, np.arange(rows.size)] = 1
+            for temp in edge_terms:
+                columns = columns - temp @ columns
+            proj[chunk] = columns[rows, np.arange(rows.size)]
+        return np.array([proj]).T
@@ -1,4 +1,4 @@
-from scipy.optimize import minimize, OptimizeResult, brute, basinhopping
+from scipy.optimize import minimize, OptimizeResult, brute, basinhopping, fmin
 import numpy as np
 from timeit import default_timer as timer
 
@@ -38,6 +38,14 @@ class SimulateQAOA(object):
         self._hamiltonian = val
         self._depth = len(val)
 
+    @property
+    def _dimension(self):
+        """Dimension of the states. Cost Hamiltonians which need not store their matrix, such as
+        :py:class:`HamiltonianMaxCut` and :py:class:`HamiltonianMIS`, report it as their ``dimension``."""
+        if hasattr(self.cost_hamiltonian, 'dimension'):
+            return self.cost_hamiltonian.dimension
+        return self.cost_hamiltonian.hamiltonian.shape[0]
+
     @property
     def depth(self):
         return self._depth
@@ -64,7 +72,7 @@ class SimulateQAOA(object):
         if self.code.logical_code and initial_state is None:
             initial_state = State(tensor_product([self.code.logical_basis[1]] * self.N), code=self.code)
         elif initial_state is None:
-            initial_state = State(np.zeros((self.cost_hamiltonian.hamiltonian.shape[0], 1)), code=self.code)
+            initial_state = State(np.zeros((self._dimension, 1)), code=self.code)
             initial_state[-1, -1] = 1
         if not (self.noise_model is None or self.noise_model == 'monte_carlo'):
             # Initial s should be a density matrix
@@ -138,14 +146,23 @@ class SimulateQAOA(object):
         return F, Fgrad
 
     def run(self, param, initial_state=None):
+        """Returns the expected cost after running QAOA with parameters ``param``. If ``param`` has shape
+        ``(depth, B)``, the ``B`` parameter points are simulated together as a batch of kets and an array of ``B``
+        costs is returned."""
+        param = np.asarray(param)
         if self.code.logical_code and initial_state is None:
             initial_state = State(tensor_product([self.code.logical_basis[1]] * self.N), code=self.code)
         elif initial_state is None:
-            initial_state = State(np.zeros((self.cost_hamiltonian.hamiltonian.shape[0], 1)), code=self.code)
+            initial_state = State(np.zeros((self._dimension, 1)), code=self.code)
             initial_state[-1, -1] = 1
         if not (self.noise_model is None or self.noise_model == 'monte_carlo'):
             # Initial s should be a density matrix
             initial_state = State(outer_product(initial_state, initial_state), code=self.code)
+        if param.ndim > 1:
+            assert self.noise_model is None
+            initial_state = State(np.tile(np.asarray(initial_state), (1, param.shape[1])), is_ket=True,
+                                  code=initial_state.code, IS_subspace=initial_state.IS_subspace,
+                                  graph=initial_state.graph)
         s = initial_state
         for j in range(self.depth):
             s = self.hamiltonian[j].evolve(s, param[j])
@@ -306,10 +323,11 @@ class SimulateQAOA(object):
                                approximation_ratio=f_val / opt_c)
                 for p, f_val, param in zip(np.arange(1, self.p + 1), Fvals, params)]
 
-    def find_parameters_brute(self, n=20, verbose=True, initial_state=None, ranges=None):
+    def find_parameters_brute(self, n=20, verbose=True, initial_state=None, ranges=None, batch_size=None):
         r"""
         Given a graph, find QAOA parameters that minimizes C=\sum_{<ij>} w_{ij} Z_i Z_j by brute-force methods
-        by evaluating on a grid
+        by evaluating on a grid. Without noise, up to ``batch_size`` grid points are simulated at once as a batch of
+        kets.
         """
         # Ranges of values to search over
         if ranges is None:
@@ -323,7 +341,17 @@ class SimulateQAOA(object):
         else:
             opt_c = self.cost_hamiltonian.optimum
             f = lambda param: self.run(param)
-        results = brute(f, ranges, Ns=n, full_output=True)
+        if self.noise_model is None:
+            # Evaluate the same grid as scipy.optimize.brute in batches, then polish the best point with fmin
+            grid = np.meshgrid(*[np.linspace(r[0], r[1], n) for r in ranges], indexing='ij')
+            points = np.reshape(grid, (self.depth, -1))
+            if batch_size is None:
+                batch_size = max(1, 2 ** 20 // self._dimension)
+            values = np.concatenate([np.atleast_1d(f(points[:, i:i + batch_size]))
+                                     for i in range(0, points.shape[1], batch_size)])
+            results = fmin(f, points[:, np.argmin(values)], full_output=True, disp=False)
+        else:
+            results = brute(f, ranges, Ns=n, full_output=True)
 
         if self.cost_hamiltonian.optimization == 'max':
             f_val = -1 * np.real(results[1])
@@ -13,6 +13,14 @@ from qsim.tools import tools
 __all__ = ['LindbladMasterEquation']
 
 
+def _repair(states, repair):
+    """Makes the density matrices in a trajectory valid in place, either all of them or only the last one."""
+    if repair == 'all':
+        states[...] = tools.make_valid_states(states)
+    elif repair == 'final':
+        states[-1, ...] = tools.make_valid_states(states[-1, ...])
+
+
 class LindbladMasterEquation(object):
     def __init__(self, hamiltonians=None, jump_operators=None):
         # Jump operators is a list of LindbladNoise objects
@@ -25,17 +33,24 @@ class LindbladMasterEquation(object):
         self.jump_operators = jump_operators
 
     def evolution_generator(self, s: State):
-        res = State(np.zeros(s.shape), is_ket=s.is_ket, code=s.code, IS_subspace=s.IS_subspace, graph=s.graph)
+        res = State(np.zeros(s.shape, dtype=s.dtype), is_ket=s.is_ket, code=s.code, IS_subspace=s.IS_subspace,
+                    graph=s.graph)
+        # Accumulate every term into res in place
         for i in range(len(self.hamiltonians)):
-            res = res - 1j * (self.hamiltonians[i].left_multiply(s) - self.hamiltonians[i].right_multiply(s))
+            commutator = self.hamiltonians[i].left_multiply(s)
+            commutator -= self.hamiltonians[i].right_multiply(s)
+            commutator *= -1j
+            res += commutator
         for i in range(len(self.jump_operators)):
-            res = res + self.jump_operators[i].liouvillian(s)
+            self.jump_operators[i].liouvillian(s, out=res)
         return res
 
     def run_ode_solver(self, state: State, t0, tf, num=50, schedule=lambda t: None, times=None, method='RK45',
-                       full_output=True, verbose=False):
+                       full_output=True, verbose=False, repair='all'):
         """
 
+        :param repair: Which saved density matrices to make valid with :py:func:`tools.make_valid_states`: ``'all'``
+            (the default), ``'final'`` for only the last one, or ``'off'``.
         :param verbose:
         :param method:
         :param times:
@@ -48,6 +63,7 @@ class LindbladMasterEquation(object):
         :return:
         """
         assert not state.is_ket
+        assert repair in ('all', 'final', 'off')
         # Save s properties
         is_ket = state.is_ket
         code = state.code
@@ -78,8 +94,7 @@ class LindbladMasterEquation(object):
                     print('Fraction of integrator results normalized:',
                           len(np.argwhere(np.isclose(norms, np.ones(norms.shape)) == 1)) / len(norms))
                     print('Final state norm - 1:', norms[-1] - 1)
-                for i in range(z.shape[0]):
-                    z[i, ...] = tools.make_valid_state(z[i, ...], is_ket=False)
+                _repair(z, repair)
                 return z, infodict
             else:
                 if times is None:
@@ -98,7 +113,8 @@ class LindbladMasterEquation(object):
                     print('Fraction of integrator results normalized:',
                           len(np.argwhere(np.isclose(norms, np.ones(norms.shape)) == 1)) / len(norms))
                     print('Final state norm - 1:', norms[-1] - 1)
-                s = np.array([tools.make_valid_state(s, is_ket=False)])
+                s = np.array([s])
+                _repair(s, repair)
                 return s, infodict
         else:
             state_shape = state_asarray.shape
@@ -115,9 +131,7 @@ class LindbladMasterEquation(object):
                 print('Fraction of integrator results normalized:',
                       len(np.argwhere(np.isclose(norms, np.ones(norms.shape)) == 1)) / len(norms))
                 print('Final state norm - 1:', norms[-1] - 1)
-
-            for i in range(res.y.shape[0]):
-                res.y[i, ...] = tools.make_valid_state(res.y[i, ...], is_ket=False)
+            _repair(res.y, repair)
             return res.y, res
 
     def run_trotterized_solver(self, state: State, t0, tf, num=50, schedule=lambda t: None, times=None,
@@ -131,7 +145,7 @@ class LindbladMasterEquation(object):
             times = np.linspace(0, 1, num=int(num)) * (tf - t0) + t0
         n = len(times)
         if full_output:
-            z = np.zeros((n, state.shape[0], state.shape[1]), dtype=np.complex128)
+            z = np.zeros((n, state.shape[0], state.shape[1]), dtype=state.dtype)
         infodict = {'t': times}
         s = state.copy()
 
@@ -202,10 +216,58 @@ class LindbladMasterEquation(object):
 
         assert len(times) > 1
         if full_output:
-            outputs = np.zeros((iterations, len(times), s.shape[0], s.shape[1]), dtype=np.complex128)
+            outputs = np.zeros((iterations, len(times), s.shape[0], s.shape[1]), dtype=s.dtype)
         else:
-            outputs = np.zeros((iterations, s.shape[0], s.shape[1]), dtype=np.complex128)
+            outputs = np.zeros((iterations, s.shape[0], s.shape[1]), dtype=s.dtype)
         dt = times[1] - times[0]
+        if method == 'trotterize' and all(isinstance(jump_operator, LindbladJumpOperator) for jump_operator in
+                                          self.jump_operators):
+            # Propagate all trajectories at once, one per column of a batch of kets
+            out = State(np.tile(np.asarray(s), (1, iterations)), is_ket=is_ket, code=code, IS_subspace=IS_subspace,
+                        graph=graph)
+            jump_times = [[] for _ in range(iterations)]
+            jump_indices = [[] for _ in range(iterations)]
+            num_jumps = [0] * iterations
+            for (j, time) in zip(range(times.shape[0]), times):
+                # Update energies
+                schedule(time)
+                jumped = np.zeros(iterations, dtype=bool)
+                if len(self.jump_operators) != 0:
+                    jumped_states = []
+                    jump_probabilities = []
+                    for jump_operator in self.jump_operators:
+                        js, jp = jump_operator.jump_rate(out, list(range(out.number_physical_qudits)))
+                        jumped_states.append(np.reshape(js, (-1, out.shape[0], iterations)))
+                        jump_probabilities.append(np.reshape(jp, (-1, iterations)) * dt)
+                    jumped_states = np.concatenate(jumped_states)
+                    jump_probabilities = np.concatenate(jump_probabilities)
+                    jump_probability = np.sum(jump_probabilities, axis=0)
+                    jumped = np.random.uniform(size=iterations) < jump_probability
+                for hamiltonian in self.hamiltonians:
+                    out = hamiltonian.evolve(out, dt)
+                for jump_operator in self.jump_operators:
+                    # Non-hermitian evolve
+                    out = jump_operator.nh_evolve(out, dt)
+                out = np.array(out, dtype=s.dtype)
+                for k in np.argwhere(jumped).flatten():
+                    num_jumps[k] += 1
+                    jump_times[k].append(time)
+                    if verbose:
+                        print('Trajectory', k, 'jumped with probability', jump_probability[k], 'at time', time)
+                    jump_index = np.random.choice(list(range(len(jump_probabilities))),
+                                                  p=jump_probabilities[:, k] / jump_probability[k])
+                    jump_indices[k].append(jump_index)
+                    out[:, k] = jumped_states[jump_index, :, k] * np.sqrt(dt / jump_probabilities[jump_index, k])
+                # Normalize every trajectory
+                out = out / np.linalg.norm(out, axis=0)
+                if full_output:
+                    outputs[:, j, :, 0] = out.T
+                out = State(out, is_ket=is_ket, code=code, IS_subspace=IS_subspace, graph=graph)
+            if not full_output:
+                outputs[:, :, 0] = out.T
+            return outputs, {'t': times, 'jump_times': jump_times, 'num_jumps': num_jumps,
+                             'jump_indices': jump_indices}
+
         for k in range(iterations):
             jump_time = []
             jump_indices_iter = []
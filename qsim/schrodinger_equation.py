@@ -2,8 +2,8 @@ from qsim.codes.quantum_state import State
 from odeintw import odeintw
 import numpy as np
 import scipy.integrate
-from scipy.sparse import csr_matrix
 from scipy.sparse.linalg import expm_multiply, eigsh
+from qsim.evolution.hamiltonian import HamiltonianSum
 
 __all__ = ['SchrodingerEquation']
 
@@ -14,19 +14,27 @@ class SchrodingerEquation(object):
         if hamiltonians is None:
             hamiltonians = []
         self.hamiltonians = hamiltonians
+        self._hamiltonian_sum = None
+
+    def _summed_hamiltonian(self):
+        """Returns a :py:class:`HamiltonianSum` of the Hamiltonians, which is reused until the list of Hamiltonians
+        changes."""
+        if self._hamiltonian_sum is None or self._hamiltonian_sum.hamiltonians != list(self.hamiltonians):
+            self._hamiltonian_sum = HamiltonianSum(self.hamiltonians)
+        return self._hamiltonian_sum
 
     def evolution_generator(self, state: State):
-        res = State(np.zeros(state.shape), is_ket=state.is_ket, code=state.code, IS_subspace=state.IS_subspace, graph=state.graph)
+        res = State(np.zeros(state.shape, dtype=state.dtype), is_ket=state.is_ket, code=state.code,
+                    IS_subspace=state.IS_subspace, graph=state.graph)
         for i in range(len(self.hamiltonians)):
-            res = res - 1j * self.hamiltonians[i].left_multiply(state)
+            term = self.hamiltonians[i].left_multiply(state)
+            term *= -1j
+            res += term
         return res
 
     def evolve(self, state: State, time):
         assert state.is_ket
-        sparse_hamiltonian = csr_matrix((state.dimension, state.dimension))
-        for i in range(len(self.hamiltonians)):
-            sparse_hamiltonian = sparse_hamiltonian + self.hamiltonians[i].hamiltonian
-        return expm_multiply(-1j * time * sparse_hamiltonian, state)
+        return expm_multiply(-1j * time * self._summed_hamiltonian().hamiltonian, state)
 
     def run_ode_solver(self, state: State, t0, tf, num=50, schedule=lambda t: None, times=None, method='RK45',
                        full_output=True, verbose=False):
@@ -115,7 +123,7 @@ class SchrodingerEquation(object):
             times = np.linspace(t0, tf, num=num)
         n = len(times)
         if full_output:
-            z = np.zeros((n, state.shape[0], state.shape[1]), dtype=np.complex128)
+            z = np.zeros((n, state.shape[0], state.shape[1]), dtype=state.dtype)
         infodict = {'t': times}
         s = state.copy()
         for (i, t) in zip(range(n), times):
@@ -141,22 +149,11 @@ class SchrodingerEquation(object):
 
     def eig(self, k=2, which='S', return_eigenvectors=True):
         # Construct a LinearOperator for the Hamiltonians
-        linear_operator = False
-        ham = None
-        for h in self.hamiltonians:
-            if not hasattr(h, 'hamiltonian'):
-                linear_operator = True
-            else:
-                if ham is None:
-                    ham = h.hamiltonian
-                else:
-                    ham = ham + h.hamiltonian
+        linear_operator = not all(hasattr(h, 'hamiltonian') for h in self.hamiltonians)
         if not linear_operator:
-            if isinstance(ham, np.ndarray) or k == 'all':
-                try:
-                    eigvals, eigvecs = np.linalg.eigh(ham.todense())
-                except:
-                    eigvals, eigvecs = np.linalg.eigh(np.asarray(ham))
+            ham = self._summed_hamiltonian().hamiltonian
+            if self._summed_hamiltonian().dense or k == 'all':
+                eigvals, eigvecs = np.linalg.eigh(ham.toarray())
 
             else:
                 # Hamiltonian is a sparse matrix
@@ -183,18 +180,9 @@ class SchrodingerEquation(object):
     def ground_state(self, which='S'):
         """Returns the ground state and ground state energy"""
         # Construct a LinearOperator for the Hamiltonians
-        linear_operator = False
-        ham = None
-        for h in self.hamiltonians:
-            if not hasattr(h, 'hamiltonian'):
-                linear_operator = True
-            else:
-                if ham is None:
-                    ham = h.hamiltonian
-                else:
-                    ham = ham + h.hamiltonian
-
+        linear_operator = not all(hasattr(h, 'hamiltonian') for h in self.hamiltonians)
         if not linear_operator:
+            ham = self._summed_hamiltonian().hamiltonian
             if which == 'S':
                 w = 'SA'
             else:
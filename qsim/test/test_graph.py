@@ -1,5 +1,11 @@
 import unittest
+import types
+import numpy as np
 from qsim.graph_algorithms import graph
+from qsim.evolution import hamiltonian
+from qsim.codes.quantum_state import State
+from qsim.codes import qubit, rydberg, contraction
+from qsim import tools
 from qsim.test import tools_test
 
 
@@ -9,6 +15,73 @@ class TestGraph(unittest.TestCase):
         self.assertTrue(g.num_independent_sets == 13)
         self.assertTrue(g.mis_size == 2)
 
+    def test_IS_projector(self):
+        g = graph.line_graph(4)
+        # A code whose excited state projector is not diagonal
+        rotation = np.array([[np.cos(.3), -np.sin(.3)], [np.sin(.3), np.cos(.3)]])
+        code = types.SimpleNamespace(d=2, Q=rotation @ qubit.Q @ rotation.T)
+        expected = np.identity(2 ** g.n)
+        for (i, j) in g.edges:
+            factors = [np.identity(2)] * g.n
+            factors[i] = code.Q
+            factors[j] = code.Q
+            expected = expected @ (np.identity(2 ** g.n) - tools.tensor_product(factors))
+        self.assertTrue(np.allclose(graph.IS_projector(g, code), np.diagonal(expected)[:, np.newaxis]))
+        chunk_size = contraction.chunk_size
+        contraction.chunk_size = 8
+        try:
+            self.assertTrue(np.allclose(graph.IS_projector(g, code), np.diagonal(expected)[:, np.newaxis]))
+        finally:
+            contraction.chunk_size = chunk_size
+
+    def test_symmetry_sector(self):
+        n = 10
+        g = graph.ring_graph(n)
+        # Momentum sectors partition the independent sets
+        dimensions = [graph.SymmetrySector(g, graph.ring_symmetries(n)[:1], [np.exp(2j * np.pi * k / n)]).dimension
+                      for k in range(n)]
+        self.assertTrue(sum(dimensions) == g.num_independent_sets)
+        # Evolve the translation and reflection invariant empty set in the zero momentum, even parity sector
+        sector = graph.SymmetrySector(g, graph.ring_symmetries(n))
+        mis = hamiltonian.HamiltonianMIS(g, IS_subspace=True)
+        driver = hamiltonian.HamiltonianDriver(IS_subspace=True, graph=g)
+        psi = np.zeros((g.num_independent_sets, 1))
+        psi[-1] = 1
+        psi = State(psi, IS_subspace=True, graph=g)
+        full = driver.evolve(mis.evolve(psi, 0.4), 0.7)
+        reduced = sector.project_state(psi)
+        reduced = hamiltonian.HamiltonianSector(mis, sector).evolve(reduced, 0.4)
+        reduced = hamiltonian.HamiltonianSector(driver, sector).evolve(reduced, 0.7)
+        self.assertTrue(reduced.shape[0] == sector.dimension < g.num_independent_sets)
+        self.assertTrue(np.allclose(sector.lift_state(reduced), full))
+
+    def test_independent_sets_code(self):
+        g = graph.line_graph(4)
+        IS, nary_to_index, num_IS = g.independent_sets_code(rydberg)
+        self.assertTrue(num_IS == sum((rydberg.d - 1) ** (g.n - g.independent_sets[i][1])
+                                      for i in g.independent_sets))
+        for k in range(num_IS):
+            index, size, nary = IS[k]
+            # Digits are floats and sizes are ints, as before the representations were vectorized
+            self.assertTrue(nary.dtype == float and isinstance(size, (int, np.integer)))
+            self.assertTrue(index == tools.nary_to_int(nary, base=rydberg.d) and nary_to_index[index] == k)
+            self.assertTrue(size == np.sum(nary == 0))
+            self.assertTrue(k == 0 or IS[k - 1][0] < index)
+
+    def test_independent_set_flips(self):
+        g = graph.line_graph(5)
+        for code in [qubit, rydberg]:
+            labels, nary = g.independent_sets_array(code)
+            rows, columns, nodes = g.independent_set_flips(code, 1, 0)
+            # Every transition lowers one node and stays in the independent set subspace
+            self.assertTrue(np.all(nary[columns, nodes] == 1) and np.all(nary[rows, nodes] == 0))
+            changed = nary[rows] != nary[columns]
+            self.assertTrue(np.all(np.sum(changed, axis=1) == 1))
+            # Every excitation of a node whose neighbors are in the ground state is found
+            free = [(k, j) for k in range(labels.size) for j in range(g.n) if nary[k, j] == 1 and
+                    all(nary[k, i] != 0 for i in g.graph.neighbors(j))]
+            self.assertTrue(sorted(free) == sorted(zip(columns.tolist(), nodes.tolist())))
+
 
 if __name__ == '__main__':
     unittest.main()
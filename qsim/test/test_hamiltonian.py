@@ -1,10 +1,11 @@
 import numpy as np
 import unittest
+from scipy import sparse
 
 from qsim.graph_algorithms.graph import line_graph
 from qsim import tools
 from qsim.evolution import hamiltonian
-from qsim.codes import rydberg
+from qsim.codes import rydberg, contraction
 from qsim.test import tools_test
 from qsim.codes.quantum_state import State
 
@@ -124,6 +125,106 @@ class TestHamiltonian(unittest.TestCase):
         psi0 = State(tools.outer_product(psi0, psi0), code=rydberg)
         self.assertTrue(tools.is_hermitian(hl.evolve(psi0, 1)))
 
+    def test_diagonal_storage(self):
+        # Unweighted diagonals are stored exactly in narrow integer types
+        hc = hamiltonian.HamiltonianMaxCut(g)
+        hq = hamiltonian.HamiltonianMIS(g, energies=(1, 100))
+        self.assertTrue(hc._diagonal_hamiltonian.dtype == np.int8)
+        self.assertTrue(hq._diagonal_hamiltonian_edge_terms.dtype == np.int8)
+        self.assertTrue(hq._diagonal_hamiltonian[0, 0] == -894)
+        # Diagonals computed in small chunks agree with a single chunk, also for qutrits
+        chunk_size = contraction.chunk_size
+        contraction.chunk_size = 8
+        try:
+            chunked = hamiltonian.HamiltonianMIS(line_graph(8), code=rydberg)
+        finally:
+            contraction.chunk_size = chunk_size
+        self.assertTrue(np.array_equal(chunked._diagonal_hamiltonian,
+                                       hamiltonian.HamiltonianMIS(line_graph(8), code=rydberg)._diagonal_hamiltonian))
+        # Streamed diagonals agree with stored ones
+        psi = State(np.ones((2 ** g.n, 1), dtype=np.complex128) / 2 ** (g.n / 2))
+        for (stored, streamed) in [(hc, hamiltonian.HamiltonianMaxCut(g, store_diagonal=False)),
+                                   (hamiltonian.HamiltonianMaxCut(g, use_Z2_symmetry=True),
+                                    hamiltonian.HamiltonianMaxCut(g, use_Z2_symmetry=True, store_diagonal=False)),
+                                   (hq, hamiltonian.HamiltonianMIS(g, energies=(1, 100), store_diagonal=False))]:
+            self.assertTrue(stored.optimum == streamed.optimum)
+            if stored.hamiltonian.shape[0] == psi.shape[0]:
+                self.assertTrue(np.isclose(stored.cost_function(psi), streamed.cost_function(psi)))
+                self.assertTrue(np.allclose(stored.evolve(psi, .3), streamed.evolve(psi, .3)))
+
+    def test_streamed_diagonal(self):
+        g = line_graph(5)
+        stored = hamiltonian.HamiltonianMaxCut(g)
+        streamed = hamiltonian.HamiltonianMaxCut(g, store_diagonal=False)
+        psi = State(np.arange(2 ** g.n, dtype=np.complex128)[:, np.newaxis] / np.linalg.norm(np.arange(2 ** g.n)))
+        rho = State(psi @ psi.conj().T, is_ket=False)
+        self.assertRaises(Exception, lambda: streamed.hamiltonian)
+        self.assertTrue(np.allclose(streamed.left_multiply(psi), stored.left_multiply(psi)))
+        self.assertTrue(np.allclose(streamed.right_multiply(rho), stored.right_multiply(rho)))
+        self.assertTrue(np.allclose(streamed.evolve(rho, .3), stored.evolve(rho, .3)))
+        self.assertTrue(np.isclose(streamed.cost_function(rho), stored.cost_function(rho)))
+        self.assertTrue(np.isclose(streamed.optimum_overlap(rho), stored.optimum_overlap(rho)))
+        streamed_mis = hamiltonian.HamiltonianMIS(g, store_diagonal=False)
+        self.assertRaises(Exception, lambda: streamed_mis.hamiltonian)
+        self.assertTrue(np.allclose(streamed_mis.left_multiply(psi), hamiltonian.HamiltonianMIS(g).left_multiply(psi)))
+
+    def test_hamiltonian_sum(self):
+        g = line_graph(5)
+        for IS_subspace in [True, False]:
+            terms = [hamiltonian.HamiltonianDriver(IS_subspace=IS_subspace, graph=g),
+                     hamiltonian.HamiltonianDriver(pauli='Z', IS_subspace=IS_subspace, graph=g),
+                     hamiltonian.HamiltonianMIS(g, IS_subspace=IS_subspace)]
+            total = hamiltonian.HamiltonianSum(terms)
+            # The sum follows the energies of its terms
+            for energies in [(1, 1, 1), (.3, -2, .5), (0, 1j, 2)]:
+                for (term, energy) in zip(terms, energies):
+                    term.energies = (energy,) if IS_subspace or term is not terms[-1] else (energy, 1)
+                expected = sum(sparse.csr_matrix(term.hamiltonian) for term in terms).toarray()
+                self.assertTrue(np.allclose(total.hamiltonian.toarray(), expected))
+
+    def test_heisenberg(self):
+        g = line_graph(5)
+        X = np.array([[0, 1], [1, 0]])
+        Y = np.array([[0, -1j], [1j, 0]])
+        Q = np.diag([1, 0])
+        for energies in [(1, .3, -2), (1, 1, .5)]:
+            expected = 0
+            for (i, j) in g.edges:
+                for (energy, op) in zip(energies, [X, Y, Q]):
+                    ops = [np.identity(2)] * g.n
+                    ops[i] = op
+                    ops[j] = op
+                    expected = expected + energy * tools.tensor_product(ops)
+            h = hamiltonian.HamiltonianHeisenberg(g, energies=energies)
+            self.assertTrue(np.allclose(h.hamiltonian.toarray(), expected))
+            self.assertTrue(np.allclose(h.linear_operator @ np.identity(2 ** g.n), expected))
+            psi = State(np.ones((2 ** g.n, 1), dtype=np.complex128) / 2 ** (g.n / 2))
+            self.assertTrue(np.allclose(h.evolve(psi, .3), h.evolve(psi, .3, matrix_free=True)))
+        # Excitation number sectors are blocks of the full Hamiltonian
+        for excitations in range(g.n + 1):
+            h = hamiltonian.HamiltonianHeisenberg(g, energies=(1, 1, .5), excitations=excitations)
+            self.assertTrue(all(g.n - bin(b).count('1') == excitations for b in h.basis))
+            self.assertTrue(np.allclose(h.hamiltonian.toarray(), expected[np.ix_(h.basis, h.basis)]))
+
+    def test_pauli_sum(self):
+        terms = [((0, 2), 'XZ', .5), ((1, 2), 'YY', -1), ((0,), 'Z', 2), ((1, 2, 3), 'XIY', .3)]
+        paulis = {'X': tools.X(), 'Y': tools.Y(), 'Z': tools.Z(), 'I': np.identity(2)}
+        expected = 0
+        for (sites, ops, coefficient) in terms:
+            factors = [np.identity(2)] * 4
+            for (site, op) in zip(sites, ops):
+                factors[site] = paulis[op]
+            expected = expected + coefficient * tools.tensor_product(factors)
+        h = hamiltonian.HamiltonianPauliSum(terms, 4, energies=(2,))
+        self.assertTrue(np.allclose(h.hamiltonian.toarray(), 2 * expected))
+        self.assertTrue(np.allclose(h.diagonal(), 2 * np.diagonal(expected)))
+        psi = State(np.arange(16, dtype=np.complex128)[:, np.newaxis] / np.linalg.norm(np.arange(16)))
+        rho = State(psi @ psi.conj().T, is_ket=False)
+        self.assertTrue(np.allclose(h.left_multiply(psi), 2 * expected @ psi))
+        self.assertTrue(np.allclose(h.right_multiply(rho), 2 * rho @ expected))
+        self.assertTrue(np.isclose(h.cost_function(rho), h.cost_function(psi)))
+        self.assertTrue(np.allclose(h.evolve(psi, .3), h.evolve(psi, .3, matrix_free=True)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 from qsim.codes import jordan_farhi_shor
+from scipy.linalg import expm
 import numpy as np
 from qsim import tools
 from qsim.codes.quantum_state import State
@@ -44,6 +45,34 @@ class TestJordanFarhiShor(unittest.TestCase):
 
         self.assertTrue(np.allclose(psi0, psi1))
 
+    def test_density_matrix_multiply(self):
+        # Two logical qubit operators on a density matrix are applied from the left and right rather than fused
+        np.random.seed(0)
+        psi0 = np.random.random((jordan_farhi_shor.d ** (jordan_farhi_shor.n * 2), 1)) + 0j
+        psi0 = psi0 / np.linalg.norm(psi0)
+        rho0 = State(tools.outer_product(psi0, psi0), code=jordan_farhi_shor)
+        op = tools.tensor_product([jordan_farhi_shor.X + 1j * jordan_farhi_shor.Y, jordan_farhi_shor.Z])
+        rho1 = jordan_farhi_shor.multiply(rho0, [0, 1], op)
+        self.assertTrue(np.allclose(rho1, op @ rho0 @ op.conj().T))
+
+    def test_rotation(self):
+        # Rotations use a cached eigendecomposition of the generator; compare against expm
+        n = 2
+        np.random.seed(0)
+        psi0 = np.random.random((jordan_farhi_shor.d ** (jordan_farhi_shor.n * n), 1)) + 0j
+        psi0 = State(psi0 / np.linalg.norm(psi0), code=jordan_farhi_shor)
+        rho0 = State(tools.outer_product(psi0, psi0), code=jordan_farhi_shor)
+        op = jordan_farhi_shor.X + jordan_farhi_shor.Z
+        full_op = tools.tensor_product([np.identity(jordan_farhi_shor.d ** jordan_farhi_shor.n), op])
+        for angle in [.3, .3, 1.2]:
+            psi1 = jordan_farhi_shor.rotation(psi0, [1], angle, op)
+            self.assertTrue(np.allclose(psi1, expm(-1j * angle * full_op) @ psi0))
+            rho1 = jordan_farhi_shor.rotation(rho0, [1], angle, op)
+            self.assertTrue(np.allclose(rho1, tools.outer_product(psi1, psi1)))
+        pauli = tools.tensor_product([jordan_farhi_shor.X, jordan_farhi_shor.Z])
+        self.assertTrue(np.allclose(jordan_farhi_shor.rotation(psi0, [0, 1], .7, ['X', 'Z']),
+                                    expm(-1j * .7 * pauli) @ psi0))
+
 
 if __name__ == '__main__':
     unittest.main()
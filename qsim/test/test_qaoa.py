@@ -1,14 +1,16 @@
 import numpy as np
 import unittest
+import os
+import tempfile
 
 from qsim.test.tools_test import sample_graph
 from qsim.tools.tools import equal_superposition, outer_product
 from qsim.graph_algorithms.graph import Graph, ring_graph
-from qsim.codes.quantum_state import State
+from qsim.codes.quantum_state import State, memmap
 import networkx as nx
 from qsim.evolution import quantum_channels, hamiltonian
 from qsim.graph_algorithms import qaoa
-from qsim.codes import two_qubit_code, jordan_farhi_shor
+from qsim.codes import two_qubit_code, jordan_farhi_shor, contraction
 
 # Generate sample graph
 N = 6
@@ -98,6 +100,12 @@ class TestSimulateQAOA(unittest.TestCase):
         F, Fgrad = sim.variational_grad([1, .5], initial_state=psi0)
         self.assertAlmostEqual(F, 5.066062984904651)
 
+        # Several parameter points at once, one per column
+        params = np.array([[1, .2, -3], [.5, .7, 2]])
+        batch = sim_ket.run(params, initial_state=psi0)
+        self.assertTrue(np.allclose(batch, [sim_ket.run(params[:, i], initial_state=psi0) for i in range(3)]))
+        self.assertAlmostEqual(batch[0], 5.066062984904651)
+
         # Higher depth circuit
         sim_noisy.hamiltonian = hamiltonians * 3
         sim_noisy.noise = noises * 6
@@ -107,6 +115,28 @@ class TestSimulateQAOA(unittest.TestCase):
         self.assertTrue(np.allclose(
             Fgrad, np.array([-1.80872061, 4.86011747, 4.19677292, -0.79050022, 2.55669856, 0.94697709])))
 
+    def test_run_memmap(self):
+        # Disk-backed kets are evolved in place one chunk at a time, without storing the cost diagonal
+        hc_chunked = hamiltonian.HamiltonianMaxCut(g, store_diagonal=False)
+        self.assertAlmostEqual(hc_chunked.optimum, hc.optimum)
+        sim_memmap = qaoa.SimulateQAOA(g, cost_hamiltonian=hc_chunked, hamiltonian=[hc_chunked, hb])
+        chunk_size = contraction.chunk_size
+        contraction.chunk_size = 8
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                psi = memmap(os.path.join(directory, 'psi.dat'), psi0.shape)
+                psi[:] = psi0
+                self.assertAlmostEqual(sim_memmap.run([1, .5], initial_state=psi), 5.066062984904651)
+                self.assertTrue(psi.is_memmap)
+                del psi
+        finally:
+            contraction.chunk_size = chunk_size
+        # The grid search sizes its batches without the Hamiltonian matrix
+        sim.hamiltonian = hamiltonians
+        streamed = sim_memmap.find_parameters_brute(n=4, verbose=False)
+        stored = sim.find_parameters_brute(n=4, verbose=False)
+        self.assertTrue(np.isclose(streamed['f_val'], stored['f_val']))
+
     def test_find_optimal_params(self):
         # Test on a known graph
         for p in [1, 2, 3]:
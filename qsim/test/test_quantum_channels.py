@@ -4,7 +4,7 @@ import unittest
 from qsim.evolution import quantum_channels
 from qsim import tools
 from qsim.codes.quantum_state import State
-from qsim.codes import rydberg
+from qsim.codes import rydberg, contraction
 from qsim.graph_algorithms.graph import line_graph
 
 
@@ -72,6 +72,24 @@ class TestDissipation(unittest.TestCase):
         print(psi0)
         #self.assertTrue(np.allclose(psi0, np.array([[0, 0], [0, 1]])))
 
+    def test_kraus(self):
+        # The fused Kraus contraction should agree with summing K rho K^dagger term by term
+        np.random.seed(0)
+        n = 4
+        psi = np.random.random((2 ** n, 1)) + 1j * np.random.random((2 ** n, 1))
+        rho = State(tools.outer_product(psi, psi) / np.linalg.norm(psi) ** 2)
+        ops = [np.random.random((4, 4)) + 1j * np.random.random((4, 4)) for _ in range(3)]
+        # Compare against sequential left and right multiplication, which are tested separately
+        expected = sum(contraction.right_multiply(contraction.left_multiply(rho, [3, 1], op, 2), [3, 1], op, 2)
+                       for op in ops)
+        self.assertTrue(np.allclose(contraction.kraus(rho, [3, 1], ops, 2), expected))
+
+        # A generic channel should agree with the Pauli-specialized depolarizing channel
+        p = .2
+        channel = quantum_channels.QuantumChannel(povm=quantum_channels.DepolarizingChannel().povm)
+        self.assertTrue(np.allclose(channel.channel(rho, p, apply_to=[0, 2]),
+                                    quantum_channels.DepolarizingChannel().channel(rho, p, apply_to=[0, 2])))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,7 +3,10 @@ from qsim.graph_algorithms.graph import Graph
 from qsim.test import tools_test
 import numpy as np
 from qsim.codes import jordan_farhi_shor
-from qsim.codes.quantum_state import State
+from qsim.codes.quantum_state import State, using_precision
+from qsim.evolution import hamiltonian
+from qsim.schrodinger_equation import SchrodingerEquation
+from qsim.graph_algorithms.graph import line_graph
 
 
 class TestState(unittest.TestCase):
@@ -16,6 +19,35 @@ class TestState(unittest.TestCase):
         self.assertTrue(state.number_physical_qudits == 4)
         self.assertTrue(state.number_logical_qudits == 1)
 
+    def test_precision(self):
+        # Single precision simulations should agree with double precision to well within 1e-4
+        graph = line_graph(6)
+
+        def run():
+            laser = hamiltonian.HamiltonianDriver(IS_subspace=True, graph=graph)
+            detuning = hamiltonian.HamiltonianMIS(graph, IS_subspace=True)
+            psi0 = np.zeros((graph.num_independent_sets, 1))
+            psi0[-1, 0] = 1
+            psi0 = State(psi0, IS_subspace=True, graph=graph)
+
+            def schedule(t):
+                laser.energies = (np.sin(np.pi * t / 2),)
+                detuning.energies = (2 * t - 1,)
+
+            se = SchrodingerEquation(hamiltonians=[laser, detuning])
+            psi, info = se.run_trotterized_solver(psi0, 0, 2, num=200, schedule=schedule, full_output=False)
+            return psi[0], detuning.cost_function(State(psi[0], IS_subspace=True, graph=graph))
+
+        psi_double, cost_double = run()
+        with using_precision('single'):
+            psi_single, cost_single = run()
+            self.assertTrue(State(np.zeros((2, 1))).dtype == np.complex64)
+        self.assertTrue(State(np.zeros((2, 1))).dtype == np.complex128)
+        self.assertTrue(psi_single.dtype == np.complex64)
+        self.assertTrue(psi_double.dtype == np.complex128)
+        self.assertTrue(np.allclose(psi_single, psi_double, atol=1e-4))
+        self.assertTrue(np.isclose(cost_single, cost_double, atol=1e-4))
+
 
 if __name__ == '__main__':
     unittest.main()
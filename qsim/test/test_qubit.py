@@ -1,5 +1,5 @@
 import unittest
-from qsim.codes import qubit
+from qsim.codes import qubit, contraction
 import numpy as np
 from qsim import tools
 from qsim.codes.quantum_state import State
@@ -151,7 +151,88 @@ class TestQubit(unittest.TestCase):
         self.assertTrue(np.allclose(psi2, psi3))
         self.assertTrue(np.allclose(psi3, psi4))
 
-
+    def test_pauli_string(self):
+        # Compare many-body Pauli strings against the dense tensor product
+        N = 10
+        np.random.seed(0)
+        paulis = {'X': qubit.X, 'Y': qubit.Y, 'Z': qubit.Z}
+        psi = np.random.random((2 ** N, 1)) + 1j * np.random.random((2 ** N, 1))
+        psi = psi / np.linalg.norm(psi)
+        rho = State(tools.outer_product(psi, psi))
+        psi = State(psi)
+        apply_to = list(range(N))
+        op = list(np.random.choice(['X', 'Y', 'Z'], size=N))
+        full = tools.tensor_product([paulis[o] for o in op])
+        self.assertTrue(np.allclose(qubit.multiply(psi, apply_to, op), full @ psi))
+        self.assertTrue(np.allclose(qubit.left_multiply(rho, apply_to, op), full @ rho))
+        self.assertTrue(np.allclose(qubit.right_multiply(rho, apply_to, op), rho @ full.conj().T))
+        self.assertTrue(np.allclose(qubit.multiply(rho, apply_to, op), full @ rho @ full.conj().T))
+        self.assertTrue(np.allclose(qubit.right_multiply(psi, apply_to, op), (full @ psi).conj().T))
+
+        # Repeated qubits are applied in the order given, so ZX = iY
+        single = qubit.left_multiply(psi, [2, 2], ['X', 'Z'])
+        self.assertTrue(np.allclose(single, 1j * qubit.left_multiply(psi, [2], ['Y'])))
+        self.assertTrue(np.allclose(qubit.multiply(rho, [4, 4], ['Y', 'Y']), rho))
+
+        # The permutation and signs are computed in blocks
+        chunk_size = contraction.chunk_size
+        contraction.chunk_size = 100
+        try:
+            self.assertTrue(np.allclose(qubit.multiply(psi, apply_to, op), full @ psi))
+            self.assertTrue(np.allclose(qubit.multiply(rho, apply_to, op), full @ rho @ full.conj().T))
+        finally:
+            contraction.chunk_size = chunk_size
+
+    def test_unsorted_multiply(self):
+        N = 4
+        np.random.seed(1)
+        op = np.random.random((2 ** 3, 2 ** 3)) + 1j * np.random.random((2 ** 3, 2 ** 3))
+        psi = np.random.random((2 ** N, 1)) + 1j * np.random.random((2 ** N, 1))
+        rho = State(tools.outer_product(psi, psi))
+        psi = State(psi)
+        # Build the dense operator acting on qubits [3, 0, 2] by permuting the qubits of op on [0, 1, 2]
+        full = np.kron(op, np.identity(2)).reshape([2] * 2 * N)
+        full = np.transpose(full, (1, 3, 2, 0, 5, 7, 6, 4)).reshape((2 ** N, 2 ** N))
+        for _ in range(2):
+            # Run twice so that the cached plan and sorted operator are exercised
+            self.assertTrue(np.allclose(qubit.left_multiply(psi, [3, 0, 2], op), full @ psi))
+            self.assertTrue(np.allclose(qubit.left_multiply(rho, [3, 0, 2], op), full @ rho))
+            self.assertTrue(np.allclose(qubit.right_multiply(rho, [3, 0, 2], op), rho @ full.conj().T))
+            self.assertTrue(np.allclose(qubit.multiply(rho, [3, 0, 2], op), full @ rho @ full.conj().T))
+
+    def test_accumulate(self):
+        N = 4
+        np.random.seed(2)
+        psi = np.random.random((2 ** N, 1)) + 1j * np.random.random((2 ** N, 1))
+        rho = State(tools.outer_product(psi, psi))
+        op = np.random.random((2, 2))
+        out = np.zeros(rho.shape, dtype=np.complex128)
+        res = qubit.left_multiply(rho, [1], op, out=out, coefficient=2)
+        res = qubit.right_multiply(rho, [2], ['Y'], out=res, coefficient=-1j)
+        qubit.multiply(rho, [0, 3], ['X', 'Z'], out=out)
+        # The result is accumulated into out in place
+        self.assertTrue(res is out)
+        expected = 2 * qubit.left_multiply(rho, [1], op) - 1j * qubit.right_multiply(rho, [2], ['Y']) + \
+            qubit.multiply(rho, [0, 3], ['X', 'Z'])
+        self.assertTrue(np.allclose(out, expected))
+
+    def test_batch(self):
+        # A batch of kets is acted on column by column
+        N = 4
+        np.random.seed(3)
+        kets = np.random.random((2 ** N, 3)) + 1j * np.random.random((2 ** N, 3))
+        batch = State(kets, is_ket=True)
+        self.assertEqual(batch.batch_size, 3)
+        op = np.random.random((4, 4))
+        angles = np.array([.1, .5, 2])
+        left = qubit.left_multiply(batch, [2, 0], op)
+        pauli = qubit.multiply(batch, [1, 3], ['Y', 'X'])
+        rotated = qubit.rotation(batch, [1], angles, qubit.X)
+        for i in range(3):
+            ket = State(kets[:, [i]])
+            self.assertTrue(np.allclose(left[:, [i]], qubit.left_multiply(ket, [2, 0], op)))
+            self.assertTrue(np.allclose(pauli[:, [i]], qubit.multiply(ket, [1, 3], ['Y', 'X'])))
+            self.assertTrue(np.allclose(rotated[:, [i]], qubit.rotation(ket, [1], angles[i], qubit.X)))
 
 
 if __name__ == '__main__':
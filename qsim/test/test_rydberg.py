@@ -1,5 +1,5 @@
 import unittest
-from qsim.codes import rydberg
+from qsim.codes import rydberg, contraction
 import numpy as np
 from qsim import tools
 from qsim.codes.quantum_state import State
@@ -125,6 +125,30 @@ class TestRydbergEIT(unittest.TestCase):
         psi1 = rydberg.multiply(psi1, [4], 'Z')
         self.assertTrue(np.allclose(psi0, psi1))
 
+    def test_diagonal_operation(self):
+        # Diagonal operators take a broadcast path; check it against dense operators and the general contraction
+        N = 4
+        np.random.seed(0)
+        psi = np.random.random((rydberg.d ** N, 1)) + 1j * np.random.random((rydberg.d ** N, 1))
+        rho = State(tools.outer_product(psi, psi), code=rydberg)
+        psi = State(psi, code=rydberg)
+        projector = np.diag([0, 0, 1])
+        full_projector = tools.tensor_product([np.identity(rydberg.d ** 2), projector, np.identity(rydberg.d)])
+        self.assertTrue(np.allclose(rydberg.left_multiply(psi, [2], projector), full_projector @ psi))
+        self.assertTrue(np.allclose(rydberg.multiply(rho, [2], projector),
+                                    full_projector @ rho @ full_projector.conj().T))
+        op = np.diag(np.random.random(rydberg.d ** 2) + 1j * np.random.random(rydberg.d ** 2))
+        left = contraction.left_multiply(rho, [3, 1], op, rydberg.d)
+        self.assertTrue(np.allclose(rydberg.left_multiply(rho, [3, 1], op), left))
+        self.assertTrue(np.allclose(rydberg.right_multiply(rho, [3, 1], op),
+                                    contraction.right_multiply(rho, [3, 1], op, rydberg.d)))
+        self.assertTrue(np.allclose(rydberg.multiply(rho, [3, 1], op),
+                                    contraction.right_multiply(left, [3, 1], op, rydberg.d)))
+        self.assertTrue(np.allclose(rydberg.left_multiply(psi, [3, 1], op),
+                                    contraction.left_multiply(psi, [3, 1], op, rydberg.d)))
+        # Only the local diagonal is cached, not the full length one
+        self.assertTrue(contraction.diagonal(N, [3, 1], np.diagonal(op), rydberg.d).size == rydberg.d ** 2)
+
     def test_multi_qubit_pauli(self):
         N = 6
         psi0 = State(np.zeros((rydberg.d ** N, 1)), code=rydberg)
@@ -43,5 +43,15 @@ class TestThreeQubitCode(unittest.TestCase):
 
         self.assertTrue(np.allclose(psi0, psi1))
 
+        # Operators on unsorted logical qubits
+        N = 3
+        psi0 = State(tools.tensor_product([three_qubit_code.logical_basis[0]] * N))
+        psi1 = psi0.copy()
+        op = tools.tensor_product([three_qubit_code.X, three_qubit_code.Y, three_qubit_code.Z])
+        psi0 = three_qubit_code.multiply(psi0, [2, 0, 1], op)
+        psi1 = three_qubit_code.multiply(psi1, [0, 1, 2], ['Y', 'Z', 'X'])
+        self.assertTrue(np.allclose(psi0, psi1))
+
+
 if __name__ == '__main__':
     unittest.main()
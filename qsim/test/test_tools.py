@@ -1,6 +1,10 @@
 import unittest
 from qsim import tools
+from qsim.tools import operations
+from qsim.graph_algorithms.graph import ring_graph
 import numpy as np
+import scipy.linalg
+from scipy import sparse
 
 
 class TestTools(unittest.TestCase):
@@ -24,11 +28,66 @@ class TestTools(unittest.TestCase):
         self.assertTrue(
             np.allclose(tools.hadamard(2), np.array([[1, 1, 1, 1], [1, -1, 1, -1], [1, 1, -1, -1], [1, -1, -1, 1]]) / 2))
 
+    def test_ints_to_nary(self):
+        n = np.array([17, 0, 5])
+        self.assertTrue(np.array_equal(tools.ints_to_nary(n, 5), [tools.int_to_nary(i, size=5) for i in n]))
+        self.assertTrue(np.array_equal(tools.ints_to_nary(n, 3, base=3), [[1, 2, 2], [0, 0, 0], [0, 1, 2]]))
+        self.assertTrue(np.array_equal(tools.nary_to_ints(tools.ints_to_nary(n, 4, base=5), base=5), n))
+
+    def test_expectations(self):
+        n = 4
+        paulis = {'I': tools.identity(), 'X': tools.X(), 'Y': tools.Y(), 'Z': tools.Z()}
+        observables = [('Z', (2,)), ('ZZ', (0, 3)), ('XY', (1, 0)), ('YZY', (3, 1, 2)), (1, (2,))]
+        dense = []
+        for (operator, sites) in observables[:4]:
+            factors = [paulis['I']] * n
+            for (pauli, site) in zip(operator, sites):
+                factors[site] = paulis[pauli]
+            dense.append(tools.tensor_product(factors))
+        dense.append(tools.tensor_product([np.identity(4), np.diag([0, 1]), np.identity(2)]))
+        # A trajectory of kets in the independent set subspace of a ring
+        g = ring_graph(n)
+        basis = np.array([g.independent_sets[i][0] for i in range(g.num_independent_sets)])
+        kets = np.random.random((3, basis.size, 1)) + 1j * np.random.random((3, basis.size, 1))
+        full_kets = np.zeros((3, 2 ** n, 1), dtype=np.complex128)
+        full_kets[:, basis] = kets
+        for states, full_states in [(kets, full_kets), (kets @ np.conj(np.swapaxes(kets, -1, -2)),
+                                                        full_kets @ np.conj(np.swapaxes(full_kets, -1, -2)))]:
+            is_ket = states.shape[-1] == 1
+            expected = [[np.real(np.squeeze(operations.expectation(s, op, is_ket=is_ket))) for op in dense]
+                        for s in full_states]
+            self.assertTrue(np.allclose(operations.expectations(states, observables, n=n, basis=basis), expected))
+            self.assertTrue(np.allclose(operations.expectations(full_states, observables), expected))
+
+    def test_operator_equal_freivald(self):
+        operator = tools.KronOperator([1, tools.X(), 3]) + tools.KronOperator([tools.Z(), 2, tools.Y(), 1])
+        matrix = operator.tocsr()
+        self.assertTrue(tools.operator_equal_freivald(lambda s: operator @ s, matrix, 32, seed=0))
+        perturbed = matrix.tolil()
+        perturbed[3, 17] += 1e-3
+        self.assertFalse(tools.operator_equal_freivald(lambda s: operator @ s, perturbed.tocsr(), 32, seed=0))
+        # Maps on density matrices
+        self.assertTrue(tools.operator_equal_freivald(lambda s: operator @ s @ operator.conj().T,
+                                                      lambda s: matrix @ s @ matrix.conj().T, 32, is_ket=False))
+        self.assertFalse(tools.operator_equal_freivald(lambda s: operator @ s @ operator.conj().T,
+                                                       lambda s: matrix @ s @ matrix.T, 32, is_ket=False))
+
     def test_trace(self):
         # Basic test
         self.assertAlmostEqual(1, tools.trace(np.array([[.5, 0], [0, .5]])))
         self.assertAlmostEqual(0, tools.trace(np.array([[1, 1], [1, -1]]) / np.sqrt(2)))
 
+    def test_partial_trace(self):
+        a = np.array([[.25, .1j], [-.1j, .75]])
+        b = np.diag([.2, .3, .5])
+        c = np.array([[.5, .5, 0], [.5, .5, 0], [0, 0, 0]])
+        rho = tools.tensor_product([b, c, b])
+        self.assertTrue(np.allclose(tools.partial_trace(rho, [0, 2], d=3), c))
+        self.assertTrue(np.allclose(tools.partial_trace(rho, [1], d=3), tools.tensor_product([b, b])))
+        # A stack of qubit density matrices
+        trajectory = np.array([tools.tensor_product([a, a]), tools.tensor_product([a.T, a])])
+        self.assertTrue(np.allclose(tools.partial_trace(trajectory, [1]), np.array([a, a.T])))
+
     def test_is_orthonormal(self):
         self.assertTrue(tools.is_orthonormal(np.array([[1, 0], [0, 1]])))
 
@@ -38,7 +97,14 @@ class TestTools(unittest.TestCase):
         b = a * 1j
         a = tools.outer_product(a, a)
         b = tools.outer_product(b, b)
-        assert tools.fidelity(a, b) == 1
+        self.assertAlmostEqual(tools.fidelity(a, b), 1)
+        # Kets, low rank density matrices and a trajectory against a fixed reference
+        c = np.array([[1], [1j]]) / 2 ** .5
+        self.assertAlmostEqual(tools.fidelity(c, a), .5)
+        self.assertAlmostEqual(tools.trace_distance(c, a[:, :1] * 2 ** .5), .5 ** .5)
+        trajectory = np.array([a, np.identity(2) / 2, tools.outer_product(c, c)])
+        self.assertTrue(np.allclose(tools.fidelity(trajectory, c), [.5, .5, 1]))
+        self.assertTrue(np.allclose(tools.trace_distance(trajectory, tools.outer_product(c, c)), [.5 ** .5, .5, 0]))
 
     def test_make_valid_state(self):
         rho = np.array([[1/4, 0], [0, 3/4]], dtype=np.complex128)+1e-4
@@ -46,5 +112,77 @@ class TestTools(unittest.TestCase):
         rho = tools.make_valid_state(rho)
         assert tools.is_valid_state(rho)
 
+    def test_state_report(self):
+        rho = np.array([[.75, .25j], [-.25j, .25]])
+        report = tools.state_report(rho)
+        self.assertTrue(report['valid'])
+        self.assertAlmostEqual(report['purity'], np.trace(rho @ rho).real)
+        # A trajectory with a non-positive and a non-Hermitian slice
+        trajectory = np.array([rho, np.diag([1.1, -.1]), rho + np.array([[0, .1], [0, 0]])])
+        report = tools.state_report(trajectory)
+        self.assertTrue(np.array_equal(report['valid'], [True, False, False]))
+        self.assertAlmostEqual(report['min_eigenvalue'][1], -.1)
+        self.assertAlmostEqual(report['hermiticity_residual'][2], .1)
+        self.assertTrue(tools.state_report(np.array([[.6], [.8j]]), is_ket=True)['valid'])
+        # Trace and norm errors are allowed up to the np.isclose tolerance
+        self.assertTrue(tools.state_report(rho * (1 + 1e-6))['valid'])
+        self.assertFalse(tools.state_report(rho * (1 + 1e-4))['valid'])
+        self.assertTrue(tools.state_report(np.array([[.6], [.8j]]) * (1 + 1e-6), is_ket=True)['valid'])
+
+    def test_make_valid_states(self):
+        valid = np.array([[.5, .5j], [-.5j, .5]])
+        states = np.array([valid * 1.01, valid - .01 * np.identity(2), np.diag([1.2, -.2])])
+        out = tools.make_valid_states(states)
+        # Positive slices are only renormalized, the others have their negative eigenvalues clipped
+        self.assertTrue(np.allclose(out[0], valid))
+        for i in range(3):
+            self.assertTrue(np.allclose(out[i], tools.make_valid_state(states[i])))
+        self.assertTrue(np.allclose(tools.make_valid_states(states[2]), np.diag([1, 0])))
+
+    def test_kron_operator(self):
+        a = np.array([[1, 2j], [3, 4]])
+        b = np.array([[0, 1], [1, 0]])
+        operator = tools.KronOperator([1, a, 2]) - 2 * tools.KronOperator([a, 2, b])
+        dense = tools.tensor_product([tools.identity(1), a, tools.identity(2)]) - \
+            2 * tools.tensor_product([a, tools.identity(2), b])
+        self.assertTrue(np.allclose(operator.toarray(), dense))
+
+        self.assertTrue(np.allclose(operator.diagonal(), np.diagonal(dense)))
+        rho = np.arange(16 * 16).reshape((16, 16))
+        self.assertTrue(np.allclose(operator @ rho, dense @ rho))
+        self.assertTrue(np.allclose(rho @ operator, rho @ dense))
+        self.assertTrue(np.allclose(operator @ rho[:, :1], dense @ rho[:, :1]))
+
+    def test_local_operator(self):
+        a = np.array([[1, 2j], [3, 4]])
+        b = np.array([[0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 0, 2], [0, 0, 3, 1]])
+        # Sites out of order, a multiple of the identity and a term repeated on the same site
+        operator = tools.local_operator([((2,), a, 1), ((1, 0), b, -2), ((), np.ones((1, 1)), 5), ((2,), a, 1)], 4)
+        swap = np.array([[1, 0, 0, 0], [0, 0, 1, 0], [0, 1, 0, 0], [0, 0, 0, 1]])
+        dense = 2 * tools.tensor_product([tools.identity(2), a, tools.identity(1)]) + 5 * tools.identity(4) - \
+            2 * tools.tensor_product([swap, tools.identity(2)]) @ tools.tensor_product([b, tools.identity(2)]) @ \
+            tools.tensor_product([swap, tools.identity(2)])
+        self.assertTrue(np.allclose(operator.toarray(), dense))
+
+    def test_evolve_density_matrix(self):
+        np.random.seed(0)
+        a = np.random.normal(size=(16, 16)) + 1j * np.random.normal(size=(16, 16))
+        state = a @ a.conj().T
+        for (hamiltonian, hermitian) in [(a + a.conj().T, True), (a, False)]:
+            propagator = scipy.linalg.expm(-1.3j * hamiltonian)
+            expected = propagator @ state @ propagator.conj().T
+            cache = {}
+            for dimension in [tools.dense_propagator_dimension, 0]:
+                previous = tools.dense_propagator_dimension
+                tools.dense_propagator_dimension = dimension
+                try:
+                    out = tools.evolve_density_matrix(sparse.csr_matrix(hamiltonian), state, 1.3,
+                                                      hermitian=hermitian, cache=cache, key=hermitian)
+                finally:
+                    tools.dense_propagator_dimension = previous
+                self.assertTrue(np.allclose(out, expected))
+            self.assertTrue(len(cache) == 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,7 @@ import math
 from scipy.linalg import expm
 
 __all__ = ['single_qubit_pauli', 'single_qubit_operation', 'single_qubit_rotation', 'all_qubit_rotation',
-           'all_qubit_operation', 'left_multiply', 'right_multiply', 'expectation']
+           'all_qubit_operation', 'left_multiply', 'right_multiply', 'expectation', 'expectations']
 
 
 def left_multiply(state, i: int, op, is_ket=False, d=2):
@@ -263,6 +263,107 @@ def expectation(state, op, is_ket=False):
     else:
         return tools.trace(state @ op)
 
+
+def expectations(states, observables, n=None, d=2, basis=None):
+    """
+    Computes the expectations of many observables on a stack of states in one pass. Diagonal observables are read
+    off a table of their values on the basis states, and off-diagonal Pauli strings are grouped by the qubits they
+    flip, so that each group needs a single gather of the states.
+
+    :param states: Ket of shape :math:`(D, 1)`, density matrix of shape :math:`(D, D)`, or an array of shape
+        :math:`(T, D, 1)` or :math:`(T, D, D)` of them, e.g. a trajectory.
+    :type states: np.array
+    :param observables: List of ``(operator, sites)`` pairs. ``operator`` is either a Pauli string such as ``'ZZ'``
+        or ``'XY'`` acting on the qubits in ``sites``, or an integer :math:`k` for the projector
+        :math:`|k\\rangle\\langle k|` on the single qudit in ``sites``. For example, all :math:`\\langle Z_i
+        \\rangle` are ``[('Z', (i,)) for i in range(n)]`` and all :math:`\\langle Z_iZ_j\\rangle` on a graph are
+        ``[('ZZ', edge) for edge in graph.edges]``.
+    :type observables: list
+    :param n: Number of qudits, inferred from :math:`D` if ``basis`` is not given.
+    :type n: int
+    :param d: Dimension of the qudits, defaults to two. Pauli strings require qubits.
+    :type d: int
+    :param basis: Integer labels of the basis states of a subspace, in the order the states are stored. For the
+        independent set subspace of a graph this is ``[graph.independent_sets[i][0] for i in range(D)]``. Defaults
+        to the full space.
+    :type basis: np.array
+    :return: Real array of shape :math:`(T, \\text{len(observables)})`, or :math:`(\\text{len(observables)},)` for
+        a single state.
+    """
+    states = np.asarray(states)
+    single = states.ndim == 2
+    if single:
+        states = states[np.newaxis]
+    dimension = states.shape[1]
+    is_ket = states.shape[-1] == 1 and dimension > 1
+    full_space = basis is None
+    if full_space:
+        basis = np.arange(dimension)
+        if n is None:
+            n = int(round(math.log(dimension, d)))
+    else:
+        basis = np.asarray(basis, dtype=np.int64)
+        assert n is not None
+    if is_ket:
+        amplitudes = states[..., 0]
+        probabilities = np.abs(amplitudes) ** 2
+    else:
+        probabilities = np.real(np.diagonal(states, axis1=-2, axis2=-1))
+    digits = None
+    out = np.zeros((states.shape[0], len(observables)))
+    diagonal_terms = []
+    values = []
+    flip_groups = {}
+    for (k, (operator, sites)) in enumerate(observables):
+        sites = np.atleast_1d(sites)
+        if isinstance(operator, (int, np.integer)):
+            # Occupation projector
+            if digits is None:
+                digits = tools.ints_to_nary(basis, n, base=d)
+            diagonal_terms.append(k)
+            values.append(digits[:, sites[0]] == operator)
+            continue
+        assert d == 2 and len(operator) == len(sites)
+        x_mask, z_mask, num_y = 0, 0, 0
+        for (pauli, site) in zip(operator, sites):
+            weight = 1 << (n - 1 - int(site))
+            if pauli in 'XY':
+                x_mask |= weight
+            if pauli in 'YZ':
+                z_mask |= weight
+            num_y += pauli == 'Y'
+        if x_mask == 0:
+            diagonal_terms.append(k)
+            values.append(1 - 2 * tools.bit_parity(basis & z_mask, width=n))
+        else:
+            flip_groups.setdefault(x_mask, []).append((k, z_mask, num_y))
+    if len(diagonal_terms) > 0:
+        out[:, diagonal_terms] = probabilities @ np.array(values, dtype=probabilities.dtype).T
+    if not full_space and len(flip_groups) > 0:
+        order = np.argsort(basis)
+    for x_mask in flip_groups:
+        # P|j> = phase(j)|j ^ x_mask>, so tr(P rho) is the sum over j of phase(j) rho[j, j ^ x_mask]
+        flipped = basis ^ x_mask
+        if full_space:
+            rows = basis
+        else:
+            position = np.searchsorted(basis, flipped, sorter=order)
+            position = order[np.minimum(position, basis.size - 1)]
+            rows = np.nonzero(basis[position] == flipped)[0]
+            flipped = position[rows]
+        if is_ket:
+            correlations = amplitudes[:, rows] * np.conj(amplitudes[:, flipped])
+        else:
+            correlations = states[:, rows, flipped]
+        terms = flip_groups[x_mask]
+        phases = np.array([1j ** num_y * (1 - 2 * tools.bit_parity(basis[rows] & z_mask, width=n))
+                           for (_, z_mask, num_y) in terms])
+        out[:, [k for (k, _, _) in terms]] = np.real(correlations @ phases.T)
+    if single:
+        return out[0]
+    return out
+
+
 def measurement_outcomes(self, operator):
     """
     Determines the measurement outcomes on an ``operator`` in the given ``codes``.
@@ -1,6 +1,8 @@
 import numpy as np
 import scipy.linalg
+import scipy.sparse as sparse
 from scipy.sparse import kron
+from scipy.sparse.linalg import expm_multiply
 
 
 def int_to_nary(n, size=None, base=2, pad_with=0):
@@ -38,6 +40,68 @@ def nary_to_int(b, base=2):
     return int(b.dot(base ** np.arange(b.size)[::-1]))
 
 
+def ints_to_nary(n, size, base=2):
+    """Converts an array of non-negative integers to their size-:math:`\\text{size}` base :math:`\\text{base}`
+    representations, most significant digit first, as in :py:func:`int_to_nary`.
+
+    :param n: Array of integers to convert.
+    :type n: np.array
+    :param size: Number of digits.
+    :type size: int
+    :param base: Base of the representation, at most 256, defaults to two.
+    :type base: int
+    :return: Array of shape ``n.shape + (size,)`` and dtype uint8.
+    """
+    assert 2 <= base <= 256
+    n = np.array(n, dtype=np.int64)
+    out = np.zeros(n.shape + (size,), dtype=np.uint8)
+    # Peel off digits from least to most significant, one digit for all integers at a time
+    for j in range(size - 1, -1, -1):
+        if base == 2:
+            out[..., j] = n & 1
+            n >>= 1
+        else:
+            out[..., j] = n % base
+            n //= base
+    return out
+
+
+def nary_to_ints(b, base=2):
+    """Converts an array of base :math:`\\text{base}` representations, most significant digit first, to integers,
+    as in :py:func:`nary_to_int`.
+
+    :param b: Array of shape :math:`(..., \\text{size})` of digits.
+    :type b: np.array
+    :param base: Base of the representation, defaults to two.
+    :type base: int
+    :return: Integer array of shape :math:`(...)`.
+    """
+    b = np.asarray(b)
+    out = np.zeros(b.shape[:-1], dtype=np.int64)
+    for j in range(b.shape[-1]):
+        out *= base
+        out += b[..., j].astype(np.int64)
+    return out
+
+
+def bit_parity(a, width=64):
+    """Computes the parity of the number of set bits (the popcount modulo two) of every entry of :math:`a`.
+
+    :param a: Array of non-negative integers.
+    :type a: np.array
+    :param width: Number of low-order bits which may be set in any entry of :math:`a`, defaults to 64.
+    :type width: int
+    :return: Integer array of the same shape as :math:`a`, with entries zero or one.
+    """
+    a = np.array(a, copy=True)
+    # Fold the bits onto the lowest bit with XOR shifts
+    shift = 1
+    while shift < width:
+        a ^= a >> shift
+        shift *= 2
+    return a & 1
+
+
 def tensor_product(A, sparse=False):
     """
     :param sparse:
@@ -54,6 +118,196 @@ def tensor_product(A, sparse=False):
     return a
 
 
+def local_operator(terms, n, d=2, dtype=None):
+    """Assembles a sum of local operators :math:`\\sum_t c_t A_t` on :math:`n` qudits directly as a sparse matrix,
+    without forming intermediate Kronecker products.
+
+    :param terms: List of ``(sites, operator, coefficient)`` tuples, where ``operator`` is a square array acting on the
+        qudits in ``sites``, in the order listed. An empty ``sites`` with a :math:`1\\times 1` operator is a multiple
+        of the identity.
+    :type terms: list
+    :param n: Number of qudits.
+    :type n: int
+    :param d: Dimension of the qudits, defaults to two for qubits.
+    :type d: int
+    :param dtype: Data type of the output, defaults to that of the operators and coefficients.
+    :return: The operator as a CSR matrix.
+    :rtype: scipy.sparse.csr_matrix
+    """
+    dimension = d ** n
+    index_dtype = np.int32 if dimension <= np.iinfo(np.int32).max else np.int64
+    terms = [(np.atleast_1d(np.asarray(sites, dtype=int)), np.asarray(operator), coefficient)
+             for (sites, operator, coefficient) in terms]
+    if dtype is None:
+        dtype = np.result_type(*[np.asarray(c) for (_, _, c) in terms], *[op for (_, op, _) in terms])
+    # Reserve enough slots in every row for the densest row of each term
+    width = sum(int(np.max(np.count_nonzero(op, axis=1), initial=0)) for (_, op, _) in terms)
+    # Slot j of every row is stored contiguously. Unused slots hold explicit zeros on the diagonal, which are
+    # removed below
+    rows = np.arange(dimension, dtype=index_dtype)
+    columns = np.tile(rows, (width, 1))
+    data = np.zeros((width, dimension), dtype=dtype)
+    slot = 0
+    for (sites, operator, coefficient) in terms:
+        k = sites.size
+        assert operator.shape == (d ** k, d ** k)
+        weights = d ** (n - 1 - sites)
+        # View the basis as blocks of qudits between the sites, so that the rows in which the sites are in a fixed
+        # configuration form a strided view
+        order = np.argsort(sites)
+        shape = []
+        previous = -1
+        for site in sites[order]:
+            shape += [d ** (site - previous - 1), d]
+            previous = site
+        shape.append(d ** (n - previous - 1))
+        for a in range(d ** k):
+            digits = (a // d ** np.arange(k)[::-1]) % d
+            index = [slice(None)] * len(shape)
+            for (position, digit) in zip(2 * np.arange(k) + 1, digits[order]):
+                index[position] = digit
+            index = tuple(index)
+            for (j, b) in enumerate(np.nonzero(operator[a])[0]):
+                shift = int(np.dot((b // d ** np.arange(k)[::-1]) % d - digits, weights))
+                columns[slot + j].reshape(shape)[index] = rows.reshape(shape)[index] + shift
+                data[slot + j].reshape(shape)[index] = coefficient * operator[a, b]
+        slot += int(np.max(np.count_nonzero(operator, axis=1), initial=0))
+    out = sparse.csr_matrix((data.T.reshape(-1), columns.T.reshape(-1),
+                             np.arange(0, dimension * width + 1, width, dtype=index_dtype)),
+                            shape=(dimension, dimension))
+    out.sum_duplicates()
+    out.eliminate_zeros()
+    return out
+
+
+class KronOperator(object):
+    # Make numpy arrays defer to the reflected operators below, e.g. in ``state @ operator``
+    __array_ufunc__ = None
+
+    def __init__(self, factors, d=2, coefficient=1):
+        """Sum of tensor products, stored as lists of factors rather than as the full Kronecker product.
+
+        :param factors: Factors of the tensor product, in order. A square array is an operator on the qudits it
+            spans, and an integer :math:`k` is the identity on :math:`k` qudits.
+        :type factors: list
+        :param d: Dimension of the qudits spanned by identity factors, defaults to two for qubits.
+        :type d: int
+        :param coefficient: Scalar multiplying the tensor product, defaults to one.
+        """
+        self.d = d
+        term = []
+        for factor in factors:
+            if isinstance(factor, (int, np.integer)):
+                if factor == 0:
+                    continue
+                # Merge adjacent identities
+                if len(term) > 0 and isinstance(term[-1], int):
+                    term[-1] += int(factor)
+                else:
+                    term.append(int(factor))
+            else:
+                factor = np.asarray(factor)
+                assert factor.ndim == 2 and factor.shape[0] == factor.shape[1]
+                term.append(factor)
+        self.terms = [(coefficient, term)]
+        dimension = 1
+        for factor in term:
+            dimension *= self._factor_dimension(factor)
+        self.shape = (dimension, dimension)
+
+    def _factor_dimension(self, factor):
+        if isinstance(factor, int):
+            return self.d ** factor
+        return factor.shape[0]
+
+    @classmethod
+    def _from_terms(cls, terms, d, shape):
+        out = cls.__new__(cls)
+        out.d = d
+        out.terms = terms
+        out.shape = shape
+        return out
+
+    @property
+    def dtype(self):
+        return np.result_type(*[np.asarray(c) for (c, _) in self.terms],
+                              *[f for (_, term) in self.terms for f in term if not isinstance(f, int)])
+
+    @property
+    def T(self):
+        return KronOperator._from_terms([(c, [f if isinstance(f, int) else f.T for f in term])
+                                         for (c, term) in self.terms], self.d, self.shape)
+
+    def conj(self):
+        return KronOperator._from_terms([(np.conj(c), [f if isinstance(f, int) else f.conj() for f in term])
+                                         for (c, term) in self.terms], self.d, self.shape)
+
+    def __add__(self, other):
+        if isinstance(other, KronOperator):
+            assert self.shape == other.shape
+            return KronOperator._from_terms(self.terms + other.terms, self.d, self.shape)
+        if np.isscalar(other) and other == 0:
+            return self
+        return NotImplemented
+
+    def __radd__(self, other):
+        # Allows sum() over a list of operators
+        return self.__add__(other)
+
+    def __mul__(self, other):
+        if np.isscalar(other):
+            return KronOperator._from_terms([(other * c, term) for (c, term) in self.terms], self.d, self.shape)
+        return NotImplemented
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __neg__(self):
+        return -1 * self
+
+    def __sub__(self, other):
+        return self + (-1 * other)
+
+    def __matmul__(self, other):
+        """Applies the operator to the columns of :math:`other`, a ket or density matrix, one factor at a time."""
+        other = np.asarray(other)
+        assert other.shape[0] == self.shape[1]
+        columns = other.shape[-1] if other.ndim > 1 else 1
+        out = np.zeros(other.shape, dtype=np.result_type(self.dtype, other.dtype))
+        for (coefficient, term) in self.terms:
+            temp = other
+            left = 1
+            right = self.shape[0]
+            for factor in term:
+                dimension = self._factor_dimension(factor)
+                right = right // dimension
+                if not isinstance(factor, int):
+                    temp = np.matmul(factor, temp.reshape((left, dimension, right * columns)))
+                left = left * dimension
+            out += coefficient * temp.reshape(other.shape)
+        return out
+
+    def __rmatmul__(self, other):
+        return (self.T @ np.asarray(other).T).T
+
+    def tocsr(self):
+        out = sparse.csr_matrix(self.shape, dtype=self.dtype)
+        for (coefficient, term) in self.terms:
+            out = out + coefficient * tensor_product([sparse.identity(self.d ** f) if isinstance(f, int) else f
+                                                      for f in term], sparse=True)
+        return out.tocsr()
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+    def diagonal(self):
+        out = np.zeros(self.shape[0], dtype=self.dtype)
+        for (coefficient, term) in self.terms:
+            out += coefficient * tensor_product([np.ones(self.d ** f) if isinstance(f, int) else np.diagonal(f)
+                                                 for f in term])
+        return out
+
+
 def outer_product(a, b):
     """
     :param a: First numpy array to use in the outer product, should be of the form :math:`|a\\rangle` and have dimension :math:`(k, 1)`
@@ -125,26 +379,42 @@ def trace(a, ind=None, d=2):
     :type ind: list
     :param d: Dimension of the qudit, defaults to two for qubits.
     :type d: int
-    :return: The result of the partial trace. When all indices are traced over, a float is returned; otherwise a numpy array is returned.
+    :return: The trace of the result of the partial trace, as a float.
     """
     # Operator a and basis b
     # If ind is None, trace over all indices
     if ind is None:
         return np.trace(a)
-    # Put indices in reverse order
-    ind = list(ind)
-    ind.sort(reverse=True)
-    # Partial trace
-    for k in ind:
-        N = int(np.log2(a.shape[-1]))
-        a = np.reshape(a, [d ** (N - k - 1), d ** (k + 1), d ** N], order='C')
-        a[:, d ** k:d ** (k + 1), :] = np.roll(a[:, d ** k:d ** (k + 1), :], shift=-2 ** k, axis=2)
-        a = np.reshape(a, [d ** (2 * N - k - 1), d, d ** k], order='C')
-        a = np.delete(a, obj=1, axis=1)
-        a = np.reshape(a, [d ** (2 * N - 2 - 2 * k), d, d ** (2 * k)], order='C')
-        a = np.sum(a, axis=1)
-        a = np.reshape(a, [d ** (N - 1), d ** (N - 1)], order='C')
-    return np.trace(a)
+    return np.trace(partial_trace(a, ind, d=d), axis1=-2, axis2=-1)
+
+
+def partial_trace(a, ind, d=2):
+    """
+    Traces out a set of qudits from an operator, or from a stack of operators such as a trajectory of density
+    matrices, in a single contraction.
+
+    :param a: Operator of shape :math:`(d^N, d^N)`, or an array of shape :math:`(..., d^N, d^N)` of operators.
+    :type a: np.array
+    :param ind: List of qudit indices to trace over.
+    :type ind: list
+    :param d: Dimension of the qudit, defaults to two for qubits.
+    :type d: int
+    :return: The reduced operators, of shape :math:`(..., d^k, d^k)` where :math:`k` qudits remain, acting on the
+        remaining qudits in increasing order.
+    """
+    a = np.asarray(a)
+    N = 0
+    while d ** N < a.shape[-1]:
+        N += 1
+    assert d ** N == a.shape[-1] == a.shape[-2]
+    ind = set(int(i) for i in np.atleast_1d(ind))
+    kept = [i for i in range(N) if i not in ind]
+    # Traced qudits share a subscript between the row and column indices
+    rows = list(range(N))
+    columns = [i if i in ind else N + i for i in range(N)]
+    out = np.einsum(a.reshape(a.shape[:-2] + (d,) * (2 * N)), [Ellipsis] + rows + columns,
+                    [Ellipsis] + kept + [N + i for i in kept])
+    return out.reshape(a.shape[:-2] + (d ** len(kept), d ** len(kept)))
 
 
 def is_orthonormal(B):
@@ -178,6 +448,51 @@ def multiply(state, operator, is_ket=False):
         return operator @ state @ operator.conj().T
 
 
+# Dimension up to which density matrices are evolved with a dense propagator
+dense_propagator_dimension = 2048
+
+
+def evolve_density_matrix(hamiltonian, state, time, hermitian=True, cache=None, key=None):
+    """Computes :math:`e^{-iHt}\\rho e^{iH^\\dagger t}`. For dimensions up to ``dense_propagator_dimension``, the
+    propagator :math:`e^{-iHt}` is formed densely, from the eigendecomposition of :math:`H` if it is Hermitian.
+    Otherwise, it is never formed: :math:`A=e^{-iHt}\\rho` is computed column by column with
+    :py:func:`scipy.sparse.linalg.expm_multiply`, and the result is :math:`(e^{-iHt}A^\\dagger)^\\dagger`, which
+    costs :math:`O(\\text{nnz}(H)D)` per Krylov step rather than :math:`O(D^3)`.
+
+    :param hamiltonian: The (possibly sparse) operator :math:`H`.
+    :param state: Density matrix :math:`\\rho`.
+    :type state: np.array
+    :param time: Time :math:`t`.
+    :type time: float
+    :param hermitian: Whether :math:`H` is Hermitian, defaults to ``True``.
+    :type hermitian: bool
+    :param cache: Dictionary in which dense propagators are stored under ``(key, time)``, so that they are reused
+        while ``key`` (e.g. the energies defining :math:`H`) and :math:`t` are unchanged.
+    :type cache: dict
+    :param key: Hashable label of :math:`H` in ``cache``.
+    :return: The evolved density matrix, as an array.
+    """
+    if hamiltonian.shape[0] > dense_propagator_dimension:
+        temp = expm_multiply(-1j * time * hamiltonian, np.asarray(state))
+        return expm_multiply(-1j * time * hamiltonian, temp.conj().T).conj().T
+    if cache is not None and (key, time) in cache:
+        propagator = cache[(key, time)]
+    else:
+        if sparse.issparse(hamiltonian):
+            hamiltonian = hamiltonian.toarray()
+        if hermitian:
+            eigenvalues, eigenvectors = np.linalg.eigh(hamiltonian)
+            propagator = (eigenvectors * np.exp(-1j * time * eigenvalues)) @ eigenvectors.conj().T
+        else:
+            propagator = scipy.linalg.expm(-1j * time * hamiltonian)
+        if cache is not None:
+            # Keep only a few propagators, e.g. those of the time steps of a schedule
+            if len(cache) >= 8:
+                cache.clear()
+            cache[(key, time)] = propagator
+    return propagator @ np.asarray(state) @ propagator.conj().T
+
+
 def commutator(A, B):
     """
     :return: The commutator of :math:`A` and :math:`B`, given by :math:`[A, B]=AB-BA`.
@@ -208,11 +523,78 @@ def trace_norm(A, B):
     return np.trace(A - B, axis1=1, axis2=2)
 
 
+def _square_root_factor(A, tol=1e-12):
+    """Returns :math:`S` with :math:`A=SS^\\dagger`, of shape :math:`(..., D, r)` where :math:`r` is the rank of
+    :math:`A`. A ket is its own factor; otherwise eigenvectors with eigenvalues below ``tol`` times the largest are
+    dropped."""
+    if A.shape[-1] == 1:
+        return A
+    eigvals, eigvecs = np.linalg.eigh(A)
+    eigvals[eigvals < 0] = 0
+    # Eigenvalues are sorted, so keep the trailing columns that are nonzero anywhere in the batch
+    largest = np.max(eigvals, axis=-1, keepdims=True)
+    rank = np.max(np.sum(eigvals > tol * largest, axis=-1))
+    return eigvecs[..., -rank:] * np.sqrt(eigvals[..., np.newaxis, -rank:])
+
+
+def _reference_last(A, B):
+    """Orders a pair of states so that the second is the one to factor: the one that is not a stack of states
+    if there is one, otherwise a ket if there is one."""
+    if A.ndim < B.ndim or (A.ndim == B.ndim and A.shape[-1] == 1 and B.shape[-1] != 1):
+        return B, A
+    return A, B
+
+
 def fidelity(A, B):
     """
-    :return:  The fidelity between density matrices :math:`A` and :math:`B`, given by :math:`\\text{tr}(\\sqrt{\\sqrt{A}B\\sqrt{A}})`.
+    Computes the fidelity :math:`\\left(\\text{tr}\\sqrt{\\sqrt{A}B\\sqrt{A}}\\right)^2`. Either argument may
+    be a ket of shape :math:`(D, 1)`, a density matrix, or a stack of either such as a trajectory, in which case
+    one fidelity is returned per state. Pure states use the overlap formula, and otherwise only the
+    :math:`r\\times r` matrix :math:`S^\\dagger A S` is diagonalized, where :math:`B = SS^\\dagger` has rank
+    :math:`r`. Against a fixed reference, the reference is decomposed only once.
+
+    :return:  The fidelity between :math:`A` and :math:`B`.
     """
-    return np.trace(scipy.linalg.sqrtm(scipy.linalg.sqrtm(A) @ B @ scipy.linalg.sqrtm(A))) ** 2
+    A, B = _reference_last(np.asarray(A), np.asarray(B))
+    S = _square_root_factor(B)
+    if A.shape[-1] != 1 and B.shape[-1] != 1 and S.shape[-1] == 1:
+        # B is pure, so the fidelity is tr(AB)
+        return np.real(np.sum(A * np.swapaxes(B, -1, -2), axis=(-2, -1)))
+    overlap = np.conj(np.swapaxes(S, -1, -2)) @ A
+    if A.shape[-1] == 1:
+        return np.sum(np.abs(overlap) ** 2, axis=(-2, -1))
+    overlap = overlap @ S
+    eigvals = np.linalg.eigvalsh((overlap + np.conj(np.swapaxes(overlap, -1, -2))) / 2)
+    eigvals[eigvals < 0] = 0
+    return np.sum(np.sqrt(eigvals), axis=-1) ** 2
+
+
+def trace_distance(A, B):
+    """
+    Computes the trace distance :math:`\\frac{1}{2}\\text{tr}|A-B|`, with arguments as in :py:func:`fidelity`.
+    Pairs of kets use :math:`\\sqrt{1-|\\langle a|b\\rangle|^2}`. If :math:`A` and :math:`B` have ranks
+    :math:`r_A+r_B < D`, the nonzero spectrum of :math:`A-B` is computed from the :math:`(r_A+r_B)\\times(r_A+r_B)`
+    Gram matrix of their factors instead of from :math:`A-B` itself.
+
+    :return:  The trace distance between :math:`A` and :math:`B`.
+    """
+    A, B = _reference_last(np.asarray(A), np.asarray(B))
+    if A.shape[-1] == 1 and B.shape[-1] == 1:
+        overlap = np.sum(np.abs(np.conj(np.swapaxes(B, -1, -2)) @ A) ** 2, axis=(-2, -1))
+        return np.sqrt(np.maximum(1 - overlap, 0))
+    S_A = _square_root_factor(A)
+    S_B = _square_root_factor(B)
+    if S_A.shape[-1] + S_B.shape[-1] < A.shape[-2]:
+        # A - B = U J U^dagger has the same nonzero spectrum as J U^dagger U
+        S_B = np.broadcast_to(S_B, S_A.shape[:-2] + S_B.shape[-2:])
+        U = np.concatenate([S_A, S_B], axis=-1)
+        J = np.concatenate([np.ones(S_A.shape[-1]), -np.ones(S_B.shape[-1])])
+        eigvals = np.real(np.linalg.eigvals(J[:, np.newaxis] * (np.conj(np.swapaxes(U, -1, -2)) @ U)))
+    else:
+        A = S_A @ np.conj(np.swapaxes(S_A, -1, -2))
+        B = S_B @ np.conj(np.swapaxes(S_B, -1, -2))
+        eigvals = np.linalg.eigvalsh(A - B)
+    return np.sum(np.abs(eigvals), axis=-1) / 2
 
 
 def is_projector(A):
@@ -241,28 +623,133 @@ def is_pure_state(state):
     return np.isclose(np.trace(state @ state), 1)
 
 
-def operator_equal_freivald(f, g, k=None):
-    """f and g are functions which take in a codes and is_ket argument, and compute the action of a linear operator
-    on that codes."""
-    # Generate a random codes
-    raise NotImplementedError
+def operator_equal_freivald(f, g, dimension, k=20, is_ket=True, rtol=1e-7, atol=1e-10, seed=None):
+    """Randomized check, after Freivalds, that two linear maps agree, using only their action on :math:`k` random
+    kets or density matrices with independent uniform entries in :math:`\\{0, 1\\}`. If the maps differ, each
+    trial detects it with probability at least one half, so the probability of wrongly returning ``True`` is at
+    most :math:`2^{-k}`.
+
+    :param f: Linear map, either a function taking a ket of shape :math:`(D, 1)` (or a density matrix of shape
+        :math:`(D, D)`) and returning an array of the same shape, or a matrix such as a sparse Hamiltonian. Methods
+        which expect a :py:class:`State` can be wrapped, e.g. ``lambda s: hamiltonian.left_multiply(State(s))``.
+    :param g: Linear map to compare against, of the same kind.
+    :param dimension: Dimension :math:`D` of the kets.
+    :type dimension: int
+    :param k: Number of random trials, defaults to 20.
+    :type k: int
+    :param is_ket: Whether the maps act on kets rather than density matrices, defaults to ``True``.
+    :type is_ket: bool
+    :param rtol: Relative tolerance on the norm of the difference of the outputs.
+    :type rtol: float
+    :param atol: Absolute tolerance on the norm of the difference of the outputs.
+    :type atol: float
+    :param seed: Seed for the random inputs.
+    :return: ``False`` if the maps were found to differ, ``True`` otherwise.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (dimension, 1) if is_ket else (dimension, dimension)
+
+    def apply(operator, state):
+        if callable(operator):
+            return np.asarray(operator(state))
+        return np.asarray(operator @ state)
+
+    for _ in range(k):
+        state = rng.integers(0, 2, size=shape).astype(np.complex128)
+        a = apply(f, state)
+        b = apply(g, state)
+        if np.linalg.norm(a - b) > rtol * max(np.linalg.norm(a), np.linalg.norm(b)) + atol:
+            return False
+    return True
 
 
-def is_valid_state(state, is_ket=False, verbose=True):
-    """Returns ``True`` if :py:attr:`codes` is a valid density matrix or a ket."""
+def state_report(states, is_ket=False, rtol=1e-05, atol=1e-08, eigenvalue_tol=1e-7):
+    """Validates a density matrix or ket, or a stack of them such as a trajectory, computing the spectrum of each
+    density matrix only once.
+
+    :param states: Density matrix of shape :math:`(D, D)`, ket of shape :math:`(D, 1)`, or an array of shape
+        :math:`(..., D, D)` or :math:`(..., D, 1)` of them.
+    :type states: np.array
+    :param is_ket: Whether ``states`` are kets rather than density matrices, defaults to ``False``.
+    :type is_ket: bool
+    :param rtol: Relative tolerance, as in ``np.isclose``, on the trace (or norm, for kets) and on Hermiticity.
+    :type rtol: float
+    :param atol: Absolute tolerance, as in ``np.isclose``, on the trace (or norm, for kets) and on Hermiticity.
+    :type atol: float
+    :param eigenvalue_tol: Eigenvalues above :math:`-\\text{eigenvalue_tol}` are not considered negative.
+    :type eigenvalue_tol: float
+    :return: A dictionary with entries ``'trace_error'`` (:math:`|\\text{tr}\\rho-1|`, or :math:`|\\langle\\psi|
+        \\psi\\rangle-1|` for kets), ``'hermiticity_residual'`` (:math:`\\max|\\rho-\\rho^\\dagger|`),
+        ``'min_eigenvalue'``, ``'purity'`` and ``'valid'``, each a float or an array of shape :math:`(...)`.
+    """
+    states = np.asarray(states)
     if is_ket:
-        return np.isclose(np.linalg.norm(state), 1)
+        norms = np.sum(np.abs(states) ** 2, axis=(-2, -1))
+        report = {'trace_error': np.abs(norms - 1), 'hermiticity_residual': np.zeros(norms.shape),
+                  'min_eigenvalue': np.zeros(norms.shape), 'purity': norms ** 2}
+        report['valid'] = np.isclose(np.sqrt(norms), 1, rtol=rtol, atol=atol)
     else:
-        print('Eigenvalues real?', (np.allclose(np.imag(np.linalg.eigvals(state)), np.zeros(state.shape[0]))))
-        print('Eigenvalues positive?', np.all(np.real(np.linalg.eigvals(state)) >= -1e-10))
-        print('Hermitian?', is_hermitian(state))
-        print('Trace 1?', np.isclose(np.absolute(np.trace(state)), 1))
-        if verbose:
-            print('Eigenvalues:', np.linalg.eigvals(state))
-            print('Trace:', np.trace(state))
-        return (np.allclose(np.imag(np.linalg.eigvals(state)), np.zeros(state.shape[0]), atol=1e-06) and
-                np.all(np.real(np.linalg.eigvals(state)) >= -1 * 1e-7) and
-                np.isclose(np.absolute(np.trace(state)), 1) and is_hermitian(state))
+        adjoint = np.conj(np.swapaxes(states, -1, -2))
+        # eigvalsh only reads one triangle, so it is applied to the Hermitian part
+        eigvals = np.linalg.eigvalsh((states + adjoint) / 2)
+        trace = np.trace(states, axis1=-2, axis2=-1)
+        report = {'trace_error': np.abs(trace - 1),
+                  'hermiticity_residual': np.max(np.abs(states - adjoint), axis=(-2, -1)),
+                  'min_eigenvalue': eigvals[..., 0], 'purity': np.sum(eigvals ** 2, axis=-1)}
+        report['valid'] = np.isclose(np.abs(trace), 1, rtol=rtol, atol=atol) & \
+                          (report['hermiticity_residual'] <= atol + rtol * np.max(np.abs(states), axis=(-2, -1))) & \
+                          (report['min_eigenvalue'] >= -eigenvalue_tol)
+    if states.ndim == 2:
+        report = {key: report[key].item() for key in report}
+    return report
+
+
+def is_valid_state(state, is_ket=False, verbose=True):
+    """Returns ``True`` if :py:attr:`codes` is a valid density matrix or a ket. See :py:func:`state_report` for
+    the underlying checks."""
+    report = state_report(state, is_ket=is_ket)
+    if verbose:
+        for key in report:
+            print(key + ':', report[key])
+    return report['valid']
+
+
+def make_valid_states(states, tol=1e-8):
+    """Batched version of :py:func:`make_valid_state` for a density matrix or a stack of density matrices, such as
+    the output of an ODE solver. Every matrix is made Hermitian with unit trace. Matrices that pass a cheap
+    positivity test, either Gershgorin's circle theorem or a Cholesky factorization, are otherwise left as they
+    are, and only the rest are eigendecomposed, in a single batched call, to clip their negative eigenvalues.
+
+    :param states: Density matrix of shape :math:`(D, D)` or array of shape :math:`(..., D, D)`.
+    :type states: np.array
+    :param tol: Eigenvalues above :math:`-\\text{tol}` times the trace are not considered negative.
+    :type tol: float
+    :return: An array of valid density matrices with the same shape as ``states``.
+    """
+    states = np.asarray(states)
+    shape = states.shape
+    states = states.reshape((-1,) + shape[-2:])
+    states = (states + np.conj(np.swapaxes(states, -1, -2))) / 2
+    # A Hermitian matrix whose Gershgorin discs lie above -tol times its trace is positive up to tol
+    diagonal = np.real(np.diagonal(states, axis1=-2, axis2=-1))
+    radii = np.sum(np.abs(states), axis=-1) - np.abs(diagonal)
+    bound = -tol * np.abs(np.sum(diagonal, axis=-1, keepdims=True))
+    invalid = np.any(diagonal - radii < bound, axis=-1) | (np.sum(diagonal, axis=-1) <= 0)
+    identity = np.identity(shape[-1])
+    for i in np.nonzero(invalid)[0]:
+        try:
+            np.linalg.cholesky(states[i] + tol * np.abs(np.trace(states[i])) * identity)
+            invalid[i] = False
+        except np.linalg.LinAlgError:
+            pass
+    valid = ~invalid
+    states[valid] = states[valid] / np.real(np.trace(states[valid], axis1=-2, axis2=-1))[:, np.newaxis, np.newaxis]
+    if np.any(invalid):
+        eigvals, eigvecs = np.linalg.eigh(states[invalid])
+        eigvals[eigvals < 0] = 0
+        eigvals = eigvals / np.sum(eigvals, axis=-1, keepdims=True)
+        states[invalid] = (eigvecs * eigvals[:, np.newaxis, :]) @ np.conj(np.swapaxes(eigvecs, -1, -2))
+    return states.reshape(shape)
 
 
 def is_diagonal(A):